@@ -12,10 +12,22 @@ import json
 import logging
 import os
 import re
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from functools import partial
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from argparse import Namespace
 from utils import *
+from state import STAGE_DOWNLOADED, STAGE_IMPORTED, SyncState, diff_datasets
+from pipeline import remove_file, run_pipeline, skip_release
+from cache import DownloadCache, parse_size, remove_sidecars
+from metrics import RunMetrics
+from origins import OriginsStore
+from shadow import previous_path, publish_file, rollback_file, staging_path
+from streaming import PipeStream
 # import utilities from beacon-python
 # pip install git+https://github.com/CSCfi/beacon-python
 #
@@ -34,7 +46,14 @@ class BeaconExtendedDB(BeaconDB):
     This class is used to hijack beacons internal database class from the "beacon_api.utils" package
     """
 
-    async def get_variant_indices(self, start: int, ref: str, alt: str) -> List[int]:
+    def __init__(self):
+        super().__init__()
+
+        # prepared statement used by get_variant_indices
+        self._variant_indices_statement = None
+
+    async def get_variant_indices(self, start: int, ref: str, alt: str, chromosome: str,
+                                  dataset_id: str) -> List[int]:
         """
         Returns database indices of all occurrences of the given variant
 
@@ -42,16 +61,139 @@ class BeaconExtendedDB(BeaconDB):
                 start (int): start position of the variant
                 ref (str): sequence in the reference
                 alt (str): sequence of the variant
+                chromosome (str): chromosome of the variant as stored by beacon, see beacon_chromosome
+                dataset_id (str): beacon dataset the variant has been imported to
 
             Returns:
                 list of matching indices (possibly empty)
         """
 
         self._conn: asyncpg.Connection
-        rows = await self._conn.fetch(
-            f"SELECT index FROM beacon_data_table where start={start} AND reference='{ref}' and alternate='{alt}'")
+
+        # the statement is prepared once per connection and reused for every lookup
+        if self._variant_indices_statement is None:
+            self._variant_indices_statement = await self._conn.prepare(
+                "SELECT index FROM beacon_data_table WHERE start = $1 AND reference = $2 AND alternate = $3 "
+                "AND chromosome = $4 AND datasetid = $5")
+
+        rows = await self._variant_indices_statement.fetch(start, ref, alt, chromosome, dataset_id)
         return [row["index"] for row in rows]
 
+    async def search_variant(self, start: int, ref: str, alt: str) -> List[Tuple[int, str]]:
+        """
+        Returns database index and beacon dataset of all occurrences of the given variant
+
+            Parameters:
+                start (int): start position of the variant
+                ref (str): sequence in the reference
+                alt (str): sequence of the variant
+
+            Returns:
+                list of (index, beacon dataset id) tuples (possibly empty)
+        """
+        rows = await self._conn.fetch(
+            "SELECT index, datasetid FROM beacon_data_table WHERE start = $1 AND reference = $2 AND alternate = $3",
+            start, ref, alt)
+        return [(row["index"], row["datasetid"]) for row in rows]
+
+    async def ensure_variant_index(self) -> None:
+        """
+        Creates an index on (start, reference, alternate) of the live variants unless it exists already
+
+        search_variant filters on these columns and would scan the whole table without the index. Origin lookups
+        match chromosome and datasetid too and are served by the data_conflict unique index of beacon-python. The
+        index is built concurrently, so searches keep running while the first rebuild or sync creates it.
+        """
+        await self._conn.execute(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS beacon_data_variant_idx "
+            f"ON {LIVE_SCHEMA}.beacon_data_table (start, reference, alternate)")
+
+    async def get_variant_indices_bulk(self, variants: Iterable[Tuple[int, str, str, str, str]]):
+        """
+        Yields database indices of all occurrences of the given variants
+
+        Instead of one query per variant, the variants are copied into a temporary table and resolved with a
+        single join. The matching indices are streamed back through a cursor.
+
+            Parameters:
+                variants (Iterable[Tuple[int, str, str, str, str]]): (start, ref, alt, chromosome, dataset_id) of
+                    each variant, see get_variant_indices
+
+            Returns:
+                Async generator of matching indices
+        """
+        async with self._conn.transaction():
+            await self._conn.execute(
+                "CREATE TEMPORARY TABLE variant_lookup (start integer, reference text, alternate text, "
+                "chromosome text, datasetid text) ON COMMIT DROP")
+            await self._conn.copy_records_to_table(
+                "variant_lookup", records=variants,
+                columns=["start", "reference", "alternate", "chromosome", "datasetid"])
+
+            # let the planner know the size of the lookup table before joining
+            await self._conn.execute("ANALYZE variant_lookup")
+
+            async for row in self._conn.cursor(
+                    "SELECT d.index FROM beacon_data_table d JOIN variant_lookup v "
+                    "ON d.start = v.start AND d.reference = v.reference AND d.alternate = v.alternate "
+                    "AND d.chromosome = v.chromosome AND d.datasetid = v.datasetid"):
+                yield row["index"]
+
+    async def delete_variants(self, indices: List[int], update_counts: bool = False) -> None:
+        """
+        Removes the variants with the given database indices
+
+            Parameters:
+                indices (List[int]): indices of the variants to remove
+                update_counts (bool): subtract the removed variants from beacon_dataset_counts_table
+
+            Returns:
+                Nothing
+        """
+        if not update_counts:
+            await self._conn.execute("DELETE FROM beacon_data_table WHERE index = ANY($1::int[])", indices)
+            return
+
+        # negative counts are added as separate rows, see collapse_dataset_counts
+        await self._conn.execute(
+            "WITH deleted AS (DELETE FROM beacon_data_table WHERE index = ANY($1::int[]) RETURNING datasetid, callcount) "
+            "INSERT INTO beacon_dataset_counts_table (datasetid, callcount, variantcount) "
+            "SELECT datasetid, -COALESCE(SUM(callcount), 0), -COUNT(*) FROM deleted GROUP BY datasetid", indices)
+
+    async def get_variant_watermark(self) -> int:
+        """
+        Returns the highest database index of all variants, variants imported later get higher indices
+        """
+        return await self._conn.fetchval("SELECT COALESCE(MAX(index), 0) FROM beacon_data_table")
+
+    async def delete_untagged_variants(self, watermark: int, tagged: List[int]) -> int:
+        """
+        Removes the variants above the watermark whose index is not in the given list
+
+        Variants are tagged with their dataset in the sync manifest only after their import is complete, so this
+        removes what interrupted imports left behind. A leftover tagged by a complete dataset is kept, it holds a
+        variant of that dataset too (beacon stores each variant once per beacon dataset, see
+        resolve_variant_indices). Like in get_variant_indices_bulk, the tagged indices are copied into a temporary
+        table and the variants are deleted with a single anti join.
+
+            Parameters:
+                watermark (int): highest index before the interrupted imports, see SyncState.incomplete_watermark
+                tagged (List[int]): indices above the watermark to keep
+
+            Returns:
+                number of removed variants
+        """
+        async with self._conn.transaction():
+            await self._conn.execute(
+                "CREATE TEMPORARY TABLE tagged_variants (variant_index integer PRIMARY KEY) ON COMMIT DROP")
+            await self._conn.copy_records_to_table(
+                "tagged_variants", records=((index,) for index in tagged), columns=["variant_index"])
+            await self._conn.execute("ANALYZE tagged_variants")
+            status = await self._conn.execute(
+                "DELETE FROM beacon_data_table d WHERE d.index > $1 AND NOT EXISTS "
+                "(SELECT 1 FROM tagged_variants t WHERE t.variant_index = d.index)", watermark)
+        return int(status.split()[-1])
+
     async def clear_database(self):
         """
         Removes all data from beacons internal database
@@ -62,6 +204,147 @@ class BeaconExtendedDB(BeaconDB):
         await self._conn.execute("DELETE FROM beacon_dataset_table")
         await self._conn.execute("DELETE FROM beacon_dataset_counts_table")
 
+    async def connection(self):
+        """
+        Connects to beacon, looking up tables in the schema given by the BEACON_IMPORT_SCHEMA environment variable
+        first (see use_schema)
+
+        The variable is inherited by region workers, so their connections import into the same schema.
+        """
+        await super().connection()
+        schema = os.environ.get(IMPORT_SCHEMA_VARIABLE)
+        if schema:
+            await self.use_schema(schema)
+
+    async def use_schema(self, schema: str) -> None:
+        """
+        Makes unqualified table names of this connection refer to the given schema, falling back to the live one
+        """
+        schemas = ", ".join(dict.fromkeys([schema, LIVE_SCHEMA]))
+        await self._conn.execute(f"SET search_path TO {schemas}")
+
+    async def get_schema_tables(self, schema: str) -> List[str]:
+        """
+        Returns which beacon tables exist in the given schema
+        """
+        rows = await self._conn.fetch(
+            "SELECT tablename FROM pg_tables WHERE schemaname = $1 AND tablename = ANY($2::text[])",
+            schema, SHADOW_TABLES)
+        return sorted(row["tablename"] for row in rows)
+
+    async def _copy_indexes(self, source: str, target: str, unique: bool) -> None:
+        # indexes backing a constraint are copied with the constraint, see prepare_shadow
+        rows = await self._conn.fetch(
+            "SELECT i.indexdef FROM pg_indexes i WHERE i.schemaname = $1 AND i.tablename = ANY($2::text[]) "
+            "AND NOT EXISTS (SELECT 1 FROM pg_constraint c "
+            "WHERE c.conindid = (quote_ident(i.schemaname) || '.' || quote_ident(i.indexname))::regclass)",
+            source, SHADOW_TABLES)
+        for row in rows:
+            definition: str = row["indexdef"]
+            if definition.startswith("CREATE UNIQUE INDEX") != unique:
+                continue
+            # index names are unqualified in the definition, so the copy is created next to the target table. A
+            # resumed rebuild may have created some of them already
+            definition = definition.replace(" INDEX ", " INDEX IF NOT EXISTS ", 1)
+            await self._conn.execute(definition.replace(f" ON {source}.", f" ON {target}.", 1))
+
+    async def prepare_shadow(self) -> None:
+        """
+        Creates empty staging copies of the live beacon tables for a shadow rebuild
+
+        The copies get the columns, defaults and constraints of the live tables and sequences of their own. Unique
+        indexes are created right away since imports and origin lookups rely on them, the others are left to
+        build_shadow_indexes so they are built once after the import instead of being updated by every insert.
+        """
+        async with self._conn.transaction():
+            await self._conn.execute(f"DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE")
+            await self._conn.execute(f"CREATE SCHEMA {STAGING_SCHEMA}")
+
+            for table in await self.get_schema_tables(LIVE_SCHEMA):
+                live, staging = f"{LIVE_SCHEMA}.{table}", f"{STAGING_SCHEMA}.{table}"
+                await self._conn.execute(f"CREATE TABLE {staging} (LIKE {live} INCLUDING ALL EXCLUDING INDEXES)")
+
+                # serial columns still draw from the sequences owned by the live table
+                sequences = await self._conn.fetch(
+                    "SELECT a.attname, s.relname FROM pg_depend d "
+                    "JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S' "
+                    "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+                    "WHERE d.refobjid = $1::regclass AND d.deptype = 'a'", live)
+                for column, sequence in sequences:
+                    await self._conn.execute(
+                        f'CREATE SEQUENCE {STAGING_SCHEMA}."{sequence}" OWNED BY {staging}."{column}"')
+                    await self._conn.execute(
+                        f'ALTER TABLE {staging} ALTER COLUMN "{column}" '
+                        f'SET DEFAULT nextval(\'{STAGING_SCHEMA}."{sequence}"\'::regclass)')
+
+                constraints = await self._conn.fetch(
+                    "SELECT conname, pg_get_constraintdef(oid) AS definition FROM pg_constraint "
+                    "WHERE conrelid = $1::regclass AND contype IN ('p', 'u')", live)
+                for name, definition in constraints:
+                    await self._conn.execute(f'ALTER TABLE {staging} ADD CONSTRAINT "{name}" {definition}')
+
+            await self._copy_indexes(LIVE_SCHEMA, STAGING_SCHEMA, unique=True)
+
+    async def build_shadow_indexes(self) -> None:
+        """
+        Creates the remaining indexes of the live tables on the staging tables, see prepare_shadow
+        """
+        await self._copy_indexes(LIVE_SCHEMA, STAGING_SCHEMA, unique=False)
+
+    async def _swap_schema(self, incoming: str, outgoing: str) -> None:
+        # must be called inside a transaction, which makes the swap atomic for readers
+        await self._conn.execute(f"SET LOCAL search_path TO {LIVE_SCHEMA}")
+        await self._conn.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+
+        tables = await self.get_schema_tables(incoming)
+        live = await self.get_schema_tables(LIVE_SCHEMA)
+
+        # views refer to tables rather than names, so views on the live tables would follow them out of public
+        views = await self._conn.fetch(
+            "SELECT DISTINCT n.nspname, v.relname, pg_get_viewdef(v.oid) AS definition FROM pg_depend d "
+            "JOIN pg_rewrite r ON r.oid = d.objid JOIN pg_class v ON v.oid = r.ev_class "
+            "JOIN pg_namespace n ON n.oid = v.relnamespace "
+            "WHERE d.refobjid = ANY($1::text[]::regclass[]) AND v.relkind = 'v'",
+            [f"{LIVE_SCHEMA}.{table}" for table in live])
+
+        await self._conn.execute(f"DROP SCHEMA IF EXISTS {outgoing} CASCADE")
+        await self._conn.execute(f"CREATE SCHEMA {outgoing}")
+        for table in live:
+            await self._conn.execute(f"ALTER TABLE {LIVE_SCHEMA}.{table} SET SCHEMA {outgoing}")
+        for table in tables:
+            await self._conn.execute(f"ALTER TABLE {incoming}.{table} SET SCHEMA {LIVE_SCHEMA}")
+        for schema, name, definition in views:
+            await self._conn.execute(f'CREATE OR REPLACE VIEW "{schema}"."{name}" AS {definition}')
+        await self._conn.execute(f"DROP SCHEMA {incoming}")
+
+    async def publish_shadow(self, keep_previous: bool = True) -> None:
+        """
+        Replaces the live beacon tables with the staging tables of a shadow rebuild in a single transaction
+
+            Parameters:
+                keep_previous (bool): keep the replaced tables in the previous schema for rollback_schemas
+
+            Returns:
+                Nothing
+        """
+        async with self._conn.transaction():
+            await self._swap_schema(STAGING_SCHEMA, PREVIOUS_SCHEMA)
+            if not keep_previous:
+                await self._conn.execute(f"DROP SCHEMA {PREVIOUS_SCHEMA} CASCADE")
+
+    async def rollback_schemas(self) -> None:
+        """
+        Restores the tables replaced by the last publish_shadow, the replacing ones become the previous copy
+
+            Raises:
+                RuntimeError if there is no previous copy
+        """
+        async with self._conn.transaction():
+            if not await self.get_schema_tables(PREVIOUS_SCHEMA):
+                raise RuntimeError(f"no previous tables to roll back to in schema {PREVIOUS_SCHEMA}")
+            await self._swap_schema(PREVIOUS_SCHEMA, ROLLBACK_SCHEMA)
+            await self._conn.execute(f"ALTER SCHEMA {ROLLBACK_SCHEMA} RENAME TO {PREVIOUS_SCHEMA}")
+
 
     async def update_dataset_counts(self):
         """
@@ -73,27 +356,218 @@ class BeaconExtendedDB(BeaconDB):
             Returns:
                 Nothing
         """
-        records: List[asyncpg.Record] = await self._conn.fetch(
-            "SELECT datasetid, COUNT(*) as count, SUM(callcount) as callcount FROM beacon_data_table GROUP BY datasetid")
+        async with self._conn.transaction():
+            # clear beacon_dataset_counts table
+            # beacon_init function will add multiple lines for the same dataset, one for each file that is imported
+            await self._conn.execute("DELETE FROM beacon_dataset_counts_table")
 
-        # clear beacon_dataset_counts table
-        # beacon_init function will add multiple lines for the same dataset, one for each file that is imported
-        await self._conn.execute("DELETE FROM beacon_dataset_counts_table")
+            # persist the actual count values
+            await self._conn.execute(
+                "INSERT INTO beacon_dataset_counts_table (datasetid, callcount, variantcount) "
+                "SELECT datasetid, COALESCE(SUM(callcount), 0), COUNT(*) FROM beacon_data_table GROUP BY datasetid")
+
+            # hide the sample count
+            await self._conn.execute("UPDATE beacon_dataset_table SET samplecount = NULL")
+
+    async def lock_dataset_counts(self, dataset_id: str) -> int:
+        """
+        Prepares counting the variants that are about to be imported to a dataset
 
-        # persist the actual count values
-        for dataset in records:
+        Concurrent imports to the same dataset wait for each other, otherwise their counts would overlap.
+
+            Parameters:
+                dataset_id (str): beacon dataset the variants are imported to
+
+            Returns:
+                the highest variant index before the import, to be passed to add_dataset_counts
+        """
+        await self._conn.execute("SELECT pg_advisory_lock(hashtext($1))", dataset_id)
+        return await self._conn.fetchval("SELECT COALESCE(MAX(index), 0) FROM beacon_data_table")
+
+    async def add_dataset_counts(self, dataset_id: str, watermark: int) -> None:
+        """
+        Adds the counts of the variants imported since lock_dataset_counts and releases its lock
+
+        Only rows above the watermark are counted, so this does not scan the whole variant table. The counts
+        are added as a separate row, see collapse_dataset_counts.
+
+            Parameters:
+                dataset_id (str): beacon dataset the variants have been imported to
+                watermark (int): value returned by lock_dataset_counts
+
+            Returns:
+                Nothing
+        """
+        try:
+            await self._conn.execute(
+                "INSERT INTO beacon_dataset_counts_table (datasetid, callcount, variantcount) "
+                "SELECT $1, COALESCE(SUM(callcount), 0), COUNT(*) FROM beacon_data_table "
+                "WHERE index > $2 AND datasetid = $1", dataset_id, watermark)
+        finally:
+            await self._conn.execute("SELECT pg_advisory_unlock(hashtext($1))", dataset_id)
+
+    async def collapse_dataset_counts(self) -> None:
+        """
+        Sums up the rows of beacon_dataset_counts_table to a single row per dataset
+
+        This finalizes the counts maintained by add_dataset_counts and delete_variants without touching
+        the variant table.
+
+            Parameters:
+                None
+
+            Returns:
+                Nothing
+        """
+        async with self._conn.transaction():
+            await self._conn.execute(
+                "CREATE TEMPORARY TABLE dataset_counts ON COMMIT DROP AS "
+                "SELECT datasetid, SUM(callcount) AS callcount, SUM(variantcount) AS variantcount "
+                "FROM beacon_dataset_counts_table GROUP BY datasetid")
+            await self._conn.execute("DELETE FROM beacon_dataset_counts_table")
             await self._conn.execute(
-                f"INSERT INTO beacon_dataset_counts_table(datasetid, callcount, variantcount) " +
-                f"VALUES('{dataset['datasetid']}', {dataset['count']}, {dataset['callcount']})")
+                "INSERT INTO beacon_dataset_counts_table (datasetid, callcount, variantcount) "
+                "SELECT datasetid, callcount, variantcount FROM dataset_counts")
 
-        # hide the sample count
-        await self._conn.execute("UPDATE beacon_dataset_table SET samplecount = NULL")
+            # hide the sample count
+            await self._conn.execute("UPDATE beacon_dataset_table SET samplecount = NULL")
 
 
 
 # global variable for beacon connection
 db: BeaconExtendedDB = BeaconExtendedDB()
 
+# each import worker of the pipeline holds its own beacon connection and event loop in here
+worker = threading.local()
+
+# metrics of the current run, replaced by main for each command
+metrics: RunMetrics = RunMetrics()
+
+# calls of BeaconExtendedDB counted by the metrics
+DATABASE_CALLS = ["load_metadata", "load_datafile", "get_variant_indices", "get_variant_indices_bulk", "delete_variants",
+                  "clear_database", "update_dataset_counts", "lock_dataset_counts", "add_dataset_counts",
+                  "collapse_dataset_counts", "ensure_variant_index", "get_variant_watermark",
+                  "delete_untagged_variants"]
+
+# requests to galaxy counted by the metrics
+GALAXY_CALLS = ["make_get_request", "make_post_request", "make_put_request", "make_delete_request"]
+
+# a shadow rebuild imports into tables of the staging schema, which replace the live tables of the public schema
+# once the import is complete. The replaced tables are kept in the previous schema for the rollback command.
+LIVE_SCHEMA = "public"
+STAGING_SCHEMA = "beacon_staging"
+PREVIOUS_SCHEMA = "beacon_previous"
+ROLLBACK_SCHEMA = "beacon_rollback"
+SHADOW_TABLES = ["beacon_data_table", "beacon_dataset_table", "beacon_dataset_counts_table", "beacon_mate_table"]
+
+# schema the connections of this process and its region workers import into, see BeaconExtendedDB.connection
+IMPORT_SCHEMA_VARIABLE = "BEACON_IMPORT_SCHEMA"
+
+# how long the swap waits for queries holding locks on the live tables before giving up
+SWAP_LOCK_TIMEOUT = "30s"
+
+# variants a streamed import inserts before resolving their origins, see beacon_import
+STREAM_CHUNK_SIZE = 10000
+
+
+def database_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds arguments for the connection to the beacon database to the given parser
+
+        Parameters:
+            parser (ArgumentParser): sub-parser of a command using the database
+
+        Returns:
+            Nothing.
+    """
+    parser.add_argument("-H", "--db-host", type=str, metavar="", default="localhost", dest="database_host",
+                        help="hostname/IP of the beacon database")
+    parser.add_argument("-P", "--db-port", type=str, metavar="", default="5432", dest="database_port",
+                        help="port of the beacon database")
+    parser.add_argument("-U", "--db-user", type=str, metavar="", default="beacon", dest="database_user",
+                        help="login user for the beacon database")
+    parser.add_argument("-W", "--db-password", type=str, metavar="", default="beacon", dest="database_password",
+                        help="login password for the beacon database")
+    parser.add_argument("-N", "--db-name", type=str, metavar="", default="beacondb", dest="database_name",
+                        help="name of the beacon database")
+
+
+def cache_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds arguments controlling the download cache to the given parser
+
+        Parameters:
+            parser (ArgumentParser): sub-parser of a command downloading datasets
+
+        Returns:
+            Nothing.
+    """
+    parser.add_argument("--cache-dir", type=str, metavar="", default="/tmp/beacon-download-cache", dest="cache_dir",
+                        help="directory in which downloaded datasets are kept for later runs")
+    parser.add_argument("--cache-size", type=parse_size, metavar="", default="10G", dest="cache_size",
+                        help="size the download cache is trimmed to, least recently used datasets are removed first")
+    parser.add_argument("--no-cache", default=False, dest="no_cache", action="store_true",
+                        help="remove downloaded datasets right after their import")
+    parser.add_argument("--verify-cache", default=False, dest="verify_cache", action="store_true",
+                        help="hash cached datasets on every use to detect corruption (as slow as reading them)")
+
+
+def import_arguments(parser: argparse.ArgumentParser):
+    """
+    Adds arguments shared by the import commands (rebuild and sync) to the given parser
+
+        Parameters:
+            parser (ArgumentParser): sub-parser of an import command
+
+        Returns:
+            Nothing.
+    """
+    parser.add_argument("-s", "--store-origins", default=False, dest="store_origins",
+                        action="store_true",
+                        help="make a local file containing variantIDs with the dataset they stem from")
+    parser.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
+                        dest="origins_file",
+                        help="full file path of the sqlite store of the variant origins (if enabled)")
+    parser.add_argument("--compress-origins", default=False, dest="compress_origins", action="store_true",
+                        help="deflate the details kept with each variant origin")
+    parser.add_argument("--origins-lookup", choices=["bulk", "single"], default="bulk", dest="origins_lookup",
+                        help="resolve variant indices with one join per dataset (bulk) or one query per variant")
+    parser.add_argument("--incremental-counts", default=False, dest="incremental_counts", action="store_true",
+                        help="let each import add its own counts instead of counting all variants afterwards "
+                             "(concurrent imports to the same beacon dataset wait for each other)")
+    parser.add_argument("-S", "--state-file", type=str, metavar="", default="/tmp/beacon-sync-state.sqlite",
+                        dest="state_file",
+                        help="full file path of the local manifest of imported datasets (used by sync and --resume)")
+
+    database_arguments(parser)
+    cache_arguments(parser)
+
+    # download/import pipeline
+    parser.add_argument("--download-workers", type=int, metavar="", default=2, dest="download_workers",
+                        help="number of datasets downloaded concurrently")
+    parser.add_argument("--import-workers", type=int, metavar="", default=1, dest="import_workers",
+                        help="number of datasets imported concurrently, each worker uses its own database connection")
+    parser.add_argument("--queue-size", type=int, metavar="", default=2, dest="queue_size",
+                        help="number of downloaded datasets that may wait for an import worker")
+    parser.add_argument("--stream", default=False, dest="stream", action="store_true",
+                        help="parse datasets while they are downloaded instead of saving them first "
+                             "(no download cache and no region workers)")
+
+    # parallel import of a single dataset
+    parser.add_argument("--region-workers", type=int, metavar="", default=1, dest="region_workers",
+                        help="number of processes importing the contigs of a bgzipped vcf in parallel, "
+                             "each with its own database connection (1 imports each dataset serially)")
+    parser.add_argument("--region-size", type=int, metavar="", default=0, dest="region_size",
+                        help="split contigs into regions of this many bases for the region workers "
+                             "(0 imports whole contigs)")
+
+    # metrics of the run
+    parser.add_argument("--metrics-file", type=str, metavar="", default="", dest="metrics_file",
+                        help="write timings, throughput and call counts of each stage to this JSON file")
+    parser.add_argument("--prometheus-file", type=str, metavar="", default="", dest="prometheus_file",
+                        help="write the metrics to this file for the textfile collector of the prometheus node exporter")
+
+
 def parse_arguments() -> Namespace:
     """
     Defines and parses command line arguments for this script
@@ -117,27 +591,53 @@ def parse_arguments() -> Namespace:
                         help="galaxy hostname or IP")
     parser.add_argument("-k", "--galaxy-key", type=str, metavar="", default="6edbc8a89bbff89bb5232867edc1183c",
                         dest="galaxy_key", help="API key of a galaxy user WITH ADMIN PRIVILEGES")
+    parser.add_argument("--discovery-workers", type=int, metavar="", default=8, dest="discovery_workers",
+                        help="number of concurrent galaxy requests while looking for beacon histories and datasets")
+    parser.add_argument("--galaxy-connections", type=int, metavar="", default=16, dest="galaxy_connections",
+                        help="number of connections to galaxy shared by discovery and downloads")
+    parser.add_argument("--galaxy-timeout", type=float, metavar="", default=60, dest="galaxy_timeout",
+                        help="seconds to wait for galaxy to answer a request or send the next part of a download")
+    parser.add_argument("--galaxy-retries", type=int, metavar="", default=5, dest="galaxy_retries",
+                        help="how often requests failing with connection errors or 5xx statuses are repeated "
+                             "(with exponential backoff)")
+    parser.add_argument("--galaxy-rate", type=float, metavar="", default=0, dest="galaxy_rate",
+                        help="maximum number of requests per second sent to galaxy (0 for no limit)")
 
     # sub-parser for command "rebuild"
     parser_rebuild = subparsers.add_parser('rebuild')
-    parser_rebuild.add_argument("-s", "--store-origins", default=False, dest="store_origins",
-                                action="store_true",
-                                help="make a local file containing variantIDs with the dataset they stem from")
-    parser_rebuild.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.txt",
+    import_arguments(parser_rebuild)
+    parser_rebuild.add_argument("--shadow", default=False, dest="shadow", action="store_true",
+                                help="import into staging tables and replace the live tables only once the import "
+                                     "succeeded, the replaced tables are kept for the rollback command")
+    parser_rebuild.add_argument("--drop-previous", default=False, dest="drop_previous", action="store_true",
+                                help="with --shadow, drop the replaced tables instead of keeping them for rollback")
+    parser_rebuild.add_argument("--resume", default=False, dest="resume", action="store_true",
+                                help="continue an interrupted rebuild from the progress recorded in the state file "
+                                     "(add --shadow if the interrupted rebuild used it)")
+
+    # sub-parser for command "sync"
+    parser_sync = subparsers.add_parser('sync', help="only import new or changed datasets and remove deleted ones")
+    import_arguments(parser_sync)
+
+    # sub-parser for command "rollback"
+    parser_rollback = subparsers.add_parser('rollback', help="restore the tables replaced by the last shadow rebuild")
+    parser_rollback.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
+                                 dest="origins_file",
+                                 help="full file path of the variant origins, restored along with the tables")
+    parser_rollback.add_argument("-S", "--state-file", type=str, metavar="", default="/tmp/beacon-sync-state.sqlite",
+                                 dest="state_file",
+                                 help="full file path of the sync manifest, restored along with the tables")
+    database_arguments(parser_rollback)
+
+    # sub-parser for command "origins"
+    parser_origins = subparsers.add_parser('origins', help="look up the galaxy datasets variants stem from")
+    parser_origins.add_argument("indices", type=int, nargs="*", metavar="INDEX",
+                                help="database indices of the variants to look up")
+    parser_origins.add_argument("-d", "--dataset", type=str, metavar="", default="", dest="dataset",
+                                help="list the indices of the variants stemming from this galaxy dataset instead")
+    parser_origins.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
                                 dest="origins_file",
-                                help="full file path of where variant origins should be stored (if enabled)")
-    
-    # database connection
-    parser_rebuild.add_argument("-H", "--db-host", type=str, metavar="", default="localhost", dest="database_host",
-                                help="hostname/IP of the beacon database")
-    parser_rebuild.add_argument("-P", "--db-port", type=str, metavar="", default="5432", dest="database_port",
-                                help="port of the beacon database")
-    parser_rebuild.add_argument("-U", "--db-user", type=str, metavar="", default="beacon", dest="database_user",
-                                help="login user for the beacon database")
-    parser_rebuild.add_argument("-W", "--db-password", type=str, metavar="", default="beacon", dest="database_password",
-                                help="login password for the beacon database")
-    parser_rebuild.add_argument("-N", "--db-name", type=str, metavar="", default="beacondb", dest="database_name",
-                                help="name of the beacon database")
+                                help="full file path of the variant origins written by --store-origins")
 
     # sub-parser for command search
     parser_search = subparsers.add_parser('search')
@@ -147,6 +647,16 @@ def parse_arguments() -> Namespace:
                                help="sequence in the reference")
     parser_search.add_argument("-a", "--alt", type=str, metavar="", dest="alt", required=True,
                                help="alternate sequence found in the variant")
+    parser_search.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
+                               dest="origins_file",
+                               help="full file path of the variant origins used to map hits to galaxy datasets")
+    parser_search.add_argument("-S", "--state-file", type=str, metavar="", default="/tmp/beacon-sync-state.sqlite",
+                               dest="state_file",
+                               help="full file path of the sync manifest, used if there is no origins file")
+    parser_search.add_argument("--exhaustive", default=False, dest="exhaustive", action="store_true",
+                               help="download and scan every dataset instead of querying the beacon database")
+    database_arguments(parser_search)
+    cache_arguments(parser_search)
 
     return parser.parse_args()
 
@@ -171,77 +681,47 @@ def set_up_logging(verbosity: int):
         logging.basicConfig(level=logging.WARN)
 
 
-def get_datasets(gi: GalaxyInstance, history_id: str) -> List[GalaxyDataset]:
+def get_datasets(gi: GalaxyInstance, history_id: str, workers: int = 4) -> Iterator[GalaxyDataset]:
     """
     Fetches a given histories datasets from galaxy
 
         Parameters:
             gi (GalaxyInstance): galaxy instance to be used for the request
             history_id (str): (encoded) ID of the galaxy history
+            workers (int): maximum number of concurrent page requests
 
         Returns:
-            datasets (List[GalaxyDataset]): list of all datasets in the given history
+            datasets (Iterator[GalaxyDataset]): all datasets in the given history, yielded page by page
     """
 
-    # datasets = gi.histories.show_matching_datasets(history_id)
-
-    datasets: List[GalaxyDataset] = []
-
-    offset: int = 0
-    limit: int = 500
-
-    # galaxy api uses paging for datasets. This while loop continuously retrieves pages of *limit* datasets
-    # The loop breaks the first time an empty page comes up
-    while True:
-        # TODO extensions only allow one entry atm
-        # retrieve a list of datasets from the galaxy api
-        api_dataset_list = gi.datasets.get_datasets(
-            history_id=history_id,
-            deleted=False,
-            extension=["vcf", "vcf_bgzip"],
-            limit=limit,
-            offset=offset
-        )
-
-        # each api_dataset_list_entry is a dictionary with the fields:
-        #    "id", "name", "history_id", "hid", "history_content_type", "deleted", "visible",
-        #    "type_id", "type", "create_time", "update_time", "url", "tags", "dataset_id",
-        #    "state", "extension", "purged"
-        for api_dataset_list_entry in api_dataset_list:
-            dataset_info = gi.datasets.show_dataset(dataset_id=api_dataset_list_entry["id"])
-
-            # read dataset information from api
-            try:
-                dataset = GalaxyDataset(dataset_info)
-            except MissingFieldException as e:
-                # the exception is thrown by the constructor of GalaxyDataset which checks if all keys that are used
-                # actually exists
-                logging.warning(
-                    f"not reading dataset {api_dataset_list_entry['id']} because {e} from api response")
-
-            # filter for valid human references
-            match = re.match(r"(GRCh\d+|hg\d+).*", dataset.reference_name)
-            if match is None:
-                # skip datasets with unknown references
-                logging.warning(
-                    f"not reading dataset {dataset.name} with unknown reference \"{dataset.reference_name}\"")
-                continue
-
-            # set reference name to the first match group
-            #
-            # THIS WILL REMOVE PATCH LEVEL FROM THE REFERENCE
-            # therefore all patch levels will be grouped under the major version of the reference
-            dataset.reference_name = match.group(1)
-
-            datasets.append(dataset)
-        offset += limit
-
-        # no entries left
-        if len(api_dataset_list) == 0:
-            break
-
-    # return the finished dataset list
-    return datasets
+    # each dataset_info is a dictionary with the fields:
+    #    "id", "name", "uuid", "extension", "metadata_dbkey", "update_time", "file_size"
+    for dataset_info in iter_history_datasets(gi, history_id, ["vcf", "vcf_bgzip"], workers=workers):
+        # read dataset information from api
+        try:
+            dataset = GalaxyDataset(dataset_info)
+        except MissingFieldException as e:
+            # the exception is thrown by the constructor of GalaxyDataset which checks if all keys that are used
+            # actually exists
+            logging.warning(
+                f"not reading dataset {dataset_info.get('id')} because {e} from api response")
+            continue
+
+        # filter for valid human references
+        match = re.match(r"(GRCh\d+|hg\d+).*", dataset.reference_name)
+        if match is None:
+            # skip datasets with unknown references
+            logging.warning(
+                f"not reading dataset {dataset.name} with unknown reference \"{dataset.reference_name}\"")
+            continue
+
+        # set reference name to the first match group
+        #
+        # THIS WILL REMOVE PATCH LEVEL FROM THE REFERENCE
+        # therefore all patch levels will be grouped under the major version of the reference
+        dataset.reference_name = match.group(1)
+
+        yield dataset
 
 
 @dataclass
@@ -286,6 +766,20 @@ class BeaconMetadata:
         return json.dumps(data)
 
 
+def beacon_dataset_id(dataset: GalaxyDataset) -> str:
+    """
+    Returns the id of the beacon dataset the variants of a galaxy dataset are imported to
+    """
+    return f"galaxy-{dataset.reference_name.lower()}"
+
+
+def beacon_chromosome(chromosome: str) -> str:
+    """
+    Returns a chromosome name as beacon-python stores it (without "chr")
+    """
+    return chromosome.replace("chr", "")
+
+
 def prepare_metadata_file(dataset: GalaxyDataset, output_path: str) -> None:
     """
     Prepares a metadata file to be consumed by beacon database import scripts
@@ -301,7 +795,7 @@ def prepare_metadata_file(dataset: GalaxyDataset, output_path: str) -> None:
     # assemble metadata from collected information
     metadata = BeaconMetadata(
         name=f"Galaxy variants for {dataset.reference_name}",
-        dataset_id=f"galaxy-{dataset.reference_name.lower()}",
+        dataset_id=beacon_dataset_id(dataset),
         description="variants shared by galaxy users",
         assembly_id=dataset.reference_name,
         external_url="usegalaxy.eu",
@@ -317,7 +811,7 @@ def prepare_metadata_file(dataset: GalaxyDataset, output_path: str) -> None:
         f.write(metadata.__json__())
 
 
-def download_dataset(gi: GalaxyInstance, dataset: GalaxyDataset, filename: str) -> None:
+def download_dataset(gi: GalaxyInstance, dataset: GalaxyDataset, filename: str) -> bool:
     """
     Downloads a dataset from galaxy to a given path
 
@@ -327,17 +821,51 @@ def download_dataset(gi: GalaxyInstance, dataset: GalaxyDataset, filename: str)
             filename (str): output filename including complete path
 
         Returns:
-            Nothing
+            True if the dataset has been downloaded
 
     """
     try:
         gi.datasets.download_dataset(dataset.id, filename, use_default_filename=False)
+        metrics.add("download", datasets=1, bytes=os.path.getsize(filename))
+        return True
     except Exception as e:
         # TODO catch exceptions
         logging.critical(f"something went wrong while downloading file - {e}")
+        return False
+
+
+def download_index(gi: GalaxyInstance, dataset: GalaxyDataset, dataset_file: str) -> bool:
+    """
+    Downloads the tabix index galaxy keeps as metadata of a bgzipped vcf next to the downloaded dataset
 
+        Parameters:
+            gi (GalaxyInstance): galaxy instance to download from
+            dataset (GalaxyDataset): the dataset whose index to download
+            dataset_file (str): full path of the downloaded dataset
 
-def beacon_import(dataset_file: str, metadata_file: str) -> None:
+        Returns:
+            True if the index is available at "{dataset_file}.tbi"
+    """
+    index_file = f"{dataset_file}.tbi"
+    if os.path.exists(index_file):
+        return True
+
+    response: Response = gi.make_get_request(f"{gi.base_url}/api/datasets/{dataset.id}/metadata_file",
+                                             params={"metadata_file": "tabix_index"})
+    if response.status_code != 200:
+        logging.warning(f"no tabix index for {dataset.name} (status {response.status_code}), importing serially")
+        return False
+
+    with open(f"{index_file}.tmp", "wb") as index:
+        index.write(response.content)
+    os.replace(f"{index_file}.tmp", index_file)
+    metrics.add("download", bytes=len(response.content))
+    return True
+
+
+def beacon_import(dataset_file: str, metadata_file: str, database: BeaconExtendedDB = None,
+                  incremental_counts: bool = False, regions: ProcessPoolExecutor = None, region_size: int = 0,
+                  on_inserted: Callable[[List[Variant]], None] = None) -> int:
     """
     Import a dataset to beacon
 
@@ -345,9 +873,15 @@ def beacon_import(dataset_file: str, metadata_file: str) -> None:
             dataset_file (str): full path to the dataset file
             metadata_file (str): full path to a file containing matching metadata for the dataset
                 metadata should be in BeaconMetadata format
+            database (BeaconExtendedDB): connection to import with, defaults to the global connection
+            incremental_counts (bool): add the counts of the imported variants to beacon_dataset_counts_table
+            regions (ProcessPoolExecutor): region workers to import an indexed dataset in parallel (optional)
+            region_size (int): size of the regions handed to the region workers, 0 for whole contigs
+            on_inserted (Callable): called with every STREAM_CHUNK_SIZE variants once they are inserted, so that
+                their origins can be resolved without reading the dataset again (optional, serial imports only)
 
         Returns:
-            Nothing
+            number of imported variant records
 
         Note:
             This function uses BeaconDB from the beacon-python package found at https://github.com/CSCfi/beacon-python
@@ -362,61 +896,608 @@ def beacon_import(dataset_file: str, metadata_file: str) -> None:
 
     """
     loop = asyncio.get_event_loop()
-    global db
+    if database is None:
+        database = db
 
     dataset_vcf: VCF
     dataset_vcf = VCF(dataset_file)
 
     # insert dataset metadata into the database, prior to inserting actual variant data
-    dataset_id = loop.run_until_complete(db.load_metadata(dataset_vcf, metadata_file, dataset_file))
+    dataset_id = loop.run_until_complete(database.load_metadata(dataset_vcf, metadata_file, dataset_file))
+
+    if incremental_counts:
+        watermark = loop.run_until_complete(database.lock_dataset_counts(dataset_id))
+
+    imported = 0
+
+    def variants():
+        # the time spent reading records is recorded as parsing, the insert stage includes it
+        nonlocal imported
+        for variant in metrics.iterate("parse", dataset_vcf):
+            imported += 1
+            yield variant
+
+    def chunks():
+        chunk = []
+        for variant in variants():
+            chunk.append(variant)
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    try:
+        with metrics.stage("insert"):
+            if regions is not None and os.path.exists(f"{dataset_file}.tbi"):
+                imported = import_regions(regions, dataset_file, dataset_id, split_regions(dataset_vcf, region_size))
+            elif on_inserted is not None:
+                for chunk in chunks():
+                    loop.run_until_complete(database.load_datafile(chunk, dataset_file, dataset_id, min_ac=0))
+                    on_inserted(chunk)
+            else:
+                # insert data into the database
+                # setting "min_ac=0" instead of the default "min_ac=1" to prevent "pop from empty list" errors
+                loop.run_until_complete(database.load_datafile(variants(), dataset_file, dataset_id, min_ac=0))
+        metrics.add("insert", variants=imported)
+    finally:
+        if incremental_counts:
+            loop.run_until_complete(database.add_dataset_counts(dataset_id, watermark))
+    return imported
+
+
+def split_regions(dataset: VCF, region_size: int = 0) -> List[Tuple[str, int, Optional[int]]]:
+    """
+    Splits an indexed dataset into regions that can be imported independently
+
+        Parameters:
+            dataset (VCF): the dataset
+            region_size (int): maximal size of a region in bases, 0 for whole contigs
+
+        Returns:
+            list of (contig, start, end) tuples, end is None for whole contigs
+
+        Note:
+            Contigs are only split if their lengths are given in the vcf header
+    """
+    if region_size <= 0:
+        return [(contig, 0, None) for contig in dataset.seqnames]
+
+    try:
+        lengths = dataset.seqlens
+    except Exception:
+        logging.warning("no contig lengths in vcf header, importing whole contigs")
+        return [(contig, 0, None) for contig in dataset.seqnames]
+
+    return [(contig, start, min(start + region_size, length))
+            for contig, length in zip(dataset.seqnames, lengths)
+            for start in range(0, length, region_size)]
+
+
+def import_region(dataset_file: str, dataset_id: str, region: Tuple[str, int, Optional[int]]) -> int:
+    """
+    Imports the variants of one region of an indexed dataset, runs in a region worker
+
+        Parameters:
+            dataset_file (str): full path to the dataset file, the tabix index is expected next to it
+            dataset_id (str): beacon dataset the variants belong to
+            region (Tuple[str, int, Optional[int]]): (contig, start, end) as returned by split_regions
+
+        Returns:
+            number of imported variant records
+    """
+    contig, start, end = region
+    dataset_vcf = VCF(dataset_file)
+
+    imported = 0
 
-    # insert data into the database
-    # setting "min_ac=0" instead of the default "min_ac=1" to prevent "pop from empty list" errors
-    loop.run_until_complete(db.load_datafile(dataset_vcf, dataset_file, dataset_id, min_ac=0))
+    def variants():
+        nonlocal imported
+        for variant in dataset_vcf(contig if end is None else f"{contig}:{start + 1}-{end}"):
+            # variants overlapping the start of a region belong to the previous region
+            if end is not None and variant.start < start:
+                continue
+            imported += 1
+            yield variant
+
+    asyncio.get_event_loop().run_until_complete(
+        worker.db.load_datafile(variants(), dataset_file, dataset_id, min_ac=0))
+    return imported
+
+
+def import_regions(regions: ProcessPoolExecutor, dataset_file: str, dataset_id: str,
+                   dataset_regions: List[Tuple[str, int, Optional[int]]]) -> int:
+    """
+    Imports the regions of an indexed dataset in parallel
+
+        Parameters:
+            regions (ProcessPoolExecutor): region workers, see start_region_workers
+            dataset_file (str): full path to the dataset file
+            dataset_id (str): beacon dataset the variants belong to
+            dataset_regions (List): regions as returned by split_regions
+
+        Returns:
+            number of imported variant records
+
+        Raises:
+            RuntimeError if any region failed to import
+    """
+    futures = {regions.submit(import_region, dataset_file, dataset_id, region): region for region in dataset_regions}
+
+    imported = 0
+    failed = []
+    for done, future in enumerate(as_completed(futures), 1):
+        contig, start, end = futures[future]
+        name = contig if end is None else f"{contig}:{start + 1}-{end}"
+        try:
+            count = future.result()
+        except Exception as e:
+            logging.error(f"failed to import region {name} - {e}")
+            failed.append(name)
+            continue
+        imported += count
+        logging.info(f"imported {count} variants of region {name} ({done}/{len(futures)} regions)")
 
+    logging.info(f"imported {imported} variants from {len(futures)} regions")
+    if failed:
+        raise RuntimeError(f"failed to import {len(failed)} regions: {', '.join(failed)}")
+    return imported
 
-async def persist_variant_origins(dataset_id: str, dataset: VCF, record):
+
+def start_region_workers(count: int) -> Optional[ProcessPoolExecutor]:
+    """
+    Starts the processes importing regions of a dataset in parallel
+
+    Each process holds its own beacon connection, configured by the same environment variables as the main process.
+    Processes are spawned instead of forked, since the import workers run in threads.
+
+        Parameters:
+            count (int): number of processes
+
+        Returns:
+            the process pool or None if datasets are imported serially
     """
-    Maps dataset_id to variant index in a separate file (which is hard-coded)
+    if count <= 1:
+        return None
+    return ProcessPoolExecutor(count, mp_context=get_context("spawn"), initializer=connect_worker)
+
+
+async def resolve_variant_indices(dataset: Iterable[Variant], dataset_id: str, database: BeaconExtendedDB = None,
+                                  bulk: bool = True):
+    """
+    Yields database indices of all variants in the given dataset
+
+    Variants are matched by chromosome and beacon dataset too, so equal positions and bases on another chromosome
+    or assembly are not mistaken for variants of this dataset. Every matching row is returned, no matter which
+    import created it: beacon skips variants already stored for the beacon dataset, so galaxy datasets sharing a
+    variant share its row.
+
+        Parameters:
+            dataset (Iterable[Variant]): The actual dataset (or a part of it), which has already been imported
+            dataset_id (str): beacon dataset the variants have been imported to, see beacon_dataset_id
+            database (BeaconExtendedDB): connection to query, defaults to the global connection
+            bulk (bool): resolve all variants with a single join instead of one query per variant
+
+        Returns:
+            Async generator of variant indices
+    """
+    if database is None:
+        database = db
+
+    variant: Variant
+    if bulk:
+        variants = ((variant.start, variant.REF, alt, beacon_chromosome(variant.CHROM), dataset_id)
+                    for variant in dataset for alt in variant.ALT)
+        async for index in database.get_variant_indices_bulk(variants):
+            yield index
+        return
+
+    for variant in dataset:
+        for alt in variant.ALT:
+            for index in await database.get_variant_indices(variant.start, variant.REF, alt,
+                                                            beacon_chromosome(variant.CHROM), dataset_id):
+                yield index
+
+
+async def persist_variant_origins(dataset_id: str, dataset: Iterable[Variant], beacon_dataset: str,
+                                  record: OriginsStore = None, state: SyncState = None,
+                                  database: BeaconExtendedDB = None, bulk: bool = True):
+    """
+    Maps dataset_id to variant index in the origins store and/or the sync state
 
         Note:
             We do not want any information in the beacon database that may be used to reconstruct an actual file
             uploaded to galaxy. Additionally, we do not want to change the dataset import functions provided by
             beacon python.
-            Therefore, a separate file is maintained linking variant indices and dataset IDs. Since we do not interfer
-            with the actual variant import these indices have to be queried individually from beacons database.
+            Therefore, a separate store is maintained linking variant indices and dataset IDs. Since we do not interfer
+            with the actual variant import these indices have to be queried from beacons database, either all at
+            once (bulk) or individually.
 
         Parameters:
             dataset_id (str): Dataset id as returned by the galaxy api
-            dataset (VCF): The actual dataset
-            record (Any): Output file in which to persist the records
+            dataset (Iterable[Variant]): The actual dataset (or the part of it just imported)
+            beacon_dataset (str): beacon dataset the variants have been imported to, see beacon_dataset_id
+            record (OriginsStore): store in which to persist the origins (optional)
+            state (SyncState): Manifest in which the indices are tagged with their dataset (optional)
+            database (BeaconExtendedDB): connection to query, defaults to the global connection
+            bulk (bool): resolve all variants with a single join instead of one query per variant
 
         Returns:
             Nothing.
     """
 
-    variant: Variant
-    for variant in dataset:
-        for alt in variant.ALT:
-            for index in await db.get_variant_indices(variant.start, variant.REF, alt):
-                record.write(f"{index} {dataset_id}\n")
+    def persist(indices: List[int]):
+        if record is not None:
+            record.add(dataset_id, indices)
+        if state is not None:
+            state.add_rows(dataset_id, indices)
+
+    indices: List[int] = []
+    async for index in resolve_variant_indices(dataset, beacon_dataset, database, bulk):
+        indices.append(index)
+        if len(indices) >= 10000:
+            persist(indices)
+            indices = []
+    persist(indices)
+
+
+async def update_variant_counts(incremental: bool = False):
+    """
+    Sets the variant and call counts of all beacon datasets
+
+        Parameters:
+            incremental (bool): only sum up the counts added by each import instead of counting all variants
+
+        Returns:
+            Nothing.
+    """
+
+    if incremental:
+        await db.collapse_dataset_counts()
+    else:
+        await db.update_dataset_counts()
+
+
+
+async def connect_beacon(args: Namespace) -> None:
+    """
+    Connects the global database object to beacon
+
+        Parameters:
+            args (Namespace): parsed arguments containing the database connection
+
+        Returns:
+            Nothing.
+    """
+    os.environ['DATABASE_URL'] = args.database_host
+    os.environ['DATABASE_PORT'] = args.database_port
+    os.environ['DATABASE_USER'] = args.database_user
+    os.environ['DATABASE_PASSWORD'] = args.database_password
+    os.environ['DATABASE_NAME'] = args.database_name
+
+    await db.connection()
+
+
+def connect_galaxy(args: Namespace) -> GalaxyInstance:
+    """
+    Connects to galaxy with the URL, api key and connection settings given by command line args
+    """
+    return set_up_galaxy_instance(args.galaxy_url, args.galaxy_key, pool_size=args.galaxy_connections,
+                                  timeout=args.galaxy_timeout, retries=args.galaxy_retries, rate=args.galaxy_rate)
+
+
+def record_galaxy_request(start: float, end: float, status: Optional[int], retry: bool) -> None:
+    """
+    Records every attempt of a galaxy request in the metrics, see GalaxyClient.on_request
+    """
+    metrics.record("galaxy", start, end)
+    metrics.add("galaxy", requests=int(not retry), retries=int(retry), errors=int(status is None or status >= 500))
+
+
+def instrument_calls(gi: GalaxyInstance) -> None:
+    """
+    Counts the requests to galaxy and the calls to the beacon database of this run in the metrics
+    """
+    metrics.instrument(gi, "galaxy", GALAXY_CALLS)
+    metrics.instrument(db, "db", DATABASE_CALLS)
+    gi.on_request = record_galaxy_request
+
+
+def report_metrics(args: Namespace, success: bool) -> None:
+    """
+    Prints the run summary and writes the metrics files given by command line args
+    """
+    metrics.finish(success)
+    print(metrics.summary(), file=sys.stderr)
+    if args.metrics_file:
+        metrics.write_json(args.metrics_file)
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+
+def connect_worker():
+    """
+    Opens a beacon connection for the calling import worker
+
+    asyncpg connections are bound to the event loop they have been created in, so every worker thread
+    runs its own event loop.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    worker.db = BeaconExtendedDB()
+    loop.run_until_complete(worker.db.connection())
+    metrics.instrument(worker.db, "db", DATABASE_CALLS)
+
+
+def disconnect_worker():
+    """
+    Closes the beacon connection of the calling import worker
+    """
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(worker.db._conn.close())
+    loop.close()
+
+
+def set_up_cache(args: Namespace) -> Optional[DownloadCache]:
+    """
+    Opens the download cache given by command line args
+
+        Returns:
+            the cache or None if caching is disabled
+    """
+    if args.no_cache:
+        return None
+    return DownloadCache(args.cache_dir, args.cache_size, args.verify_cache)
+
+
+def download_step(gi: GalaxyInstance, dataset: GalaxyDataset, cache: DownloadCache = None,
+                  with_index: bool = False, state: SyncState = None) -> Optional[str]:
+    """
+    Download stage of the import pipeline
+
+        Parameters:
+            gi (GalaxyInstance): galaxy instance to download from
+            dataset (GalaxyDataset): the dataset to download
+            cache (DownloadCache): cache to take the dataset from (optional)
+            with_index (bool): also download the tabix index of bgzipped datasets (needed by the region workers)
+            state (SyncState): manifest in which failed downloads are recorded, see SyncState.failed_datasets
+
+        Returns:
+            full path of the downloaded dataset or None if the download failed
+    """
+    with metrics.stage("download"):
+        if cache is not None:
+            dataset_file = cache.get(dataset, partial(download_dataset, gi, dataset))
+        else:
+            logging.info(f"downloading {dataset.name}")
+
+            # the dataset id is used instead of the uuid, copies of a dataset share the same uuid
+            dataset_file = f"/tmp/dataset-{dataset.id}"
+            if not download_dataset(gi, dataset, dataset_file):
+                dataset_file = None
+
+        if dataset_file is None:
+            metrics.add("download", failed=1)
+            if state is not None:
+                state.fail_dataset(dataset)
+            return None
+
+        if state is not None:
+            state.set_stage(dataset.id, STAGE_DOWNLOADED)
+        if with_index and dataset.extension == "vcf_bgzip":
+            try:
+                download_index(gi, dataset, dataset_file)
+            except Exception as e:
+                # the dataset itself is there, any other error aborts the pipeline
+                logging.warning(f"failed to download the tabix index of {dataset.name}, importing serially - {e}")
+        return dataset_file
+
+
+def stream_step(gi: GalaxyInstance, dataset: GalaxyDataset) -> str:
+    """
+    Download stage of the import pipeline in streaming mode, the import stage downloads the dataset while parsing it
+
+        Returns:
+            URL the dataset is downloaded from
+    """
+    return f"{gi.base_url}/api/datasets/{dataset.id}/display?to_ext={dataset.extension}"
+
+
+def open_download(gi: GalaxyInstance, dataset: GalaxyDataset, url: str, state: SyncState = None) -> Optional[Response]:
+    """
+    Starts the download of a streamed dataset
+
+        Parameters:
+            gi (GalaxyInstance): galaxy instance to download from
+            dataset (GalaxyDataset): the dataset to download
+            url (str): URL of the dataset as returned by stream_step
+            state (SyncState): manifest in which failed downloads are recorded, see SyncState.failed_datasets
+
+        Returns:
+            the response with its body not read yet or None if the download failed
+    """
+    with metrics.stage("download"):
+        try:
+            response: Response = gi.make_get_request(url, stream=True)
+            response.raise_for_status()
+            return response
+        except Exception as e:
+            logging.critical(f"something went wrong while downloading file - {e}")
+            metrics.add("download", failed=1)
+            if state is not None:
+                state.fail_dataset(dataset)
+            return None
+
+
+def stream_import(response: Response, metadata_file: str, incremental_counts: bool = False,
+                  on_inserted: Callable[[List[Variant]], None] = None) -> int:
+    """
+    Imports a dataset while it is downloaded, without saving it to disk
+
+    The response is piped into cyvcf2 (htslib decompresses bgzipped datasets itself), see PipeStream.
+
+        Parameters:
+            response (Response): the download as returned by open_download
+            metadata_file (str): full path to a file containing matching metadata for the dataset
+            incremental_counts (bool): add the counts of the imported variants, see beacon_import
+            on_inserted (Callable): called with the inserted variants, see beacon_import (optional)
+
+        Returns:
+            number of imported variant records
+
+        Raises:
+            IOError if the download failed, the variants imported until then stay in the database
+    """
+    with PipeStream(response, on_bytes=lambda size: metrics.add("download", bytes=size)) as dataset_file:
+        imported = beacon_import(dataset_file, metadata_file, worker.db, incremental_counts, on_inserted=on_inserted)
+    metrics.add("download", datasets=1)
+    return imported
+
+
+def release_step(cache: Optional[DownloadCache], dataset: GalaxyDataset, dataset_file: str) -> None:
+    """
+    Release stage of the import pipeline, hands an imported dataset back to the cache or removes it
+    """
+    if cache is not None:
+        cache.release(dataset_file)
+    else:
+        remove_file(dataset, dataset_file)
+        remove_sidecars(dataset_file)
+
+
+def import_step(dataset: GalaxyDataset, dataset_file: str, origins_store: OriginsStore = None, state: SyncState = None,
+                origins_lookup: str = "bulk", incremental_counts: bool = False, regions: ProcessPoolExecutor = None,
+                region_size: int = 0, gi: GalaxyInstance = None) -> bool:
+    """
+    Import stage of the import pipeline, runs in an import worker
+
+        Parameters:
+            dataset (GalaxyDataset): the downloaded dataset
+            dataset_file (str): full path of the downloaded dataset
+            origins_store (OriginsStore): store in which to persist variant origins (optional)
+            state (SyncState): manifest in which the imported dataset is recorded (optional)
+            origins_lookup (str): "bulk" or "single", see resolve_variant_indices
+            incremental_counts (bool): add the counts of the imported variants, see beacon_import
+            regions (ProcessPoolExecutor): region workers, see beacon_import (optional)
+            region_size (int): size of the regions handed to the region workers
+            gi (GalaxyInstance): galaxy instance to stream the dataset from, dataset_file is the URL returned by
+                stream_step then (optional)
+
+        Returns:
+            True if the dataset has been imported or its download failed
+    """
+    logging.info(f"next file is {dataset.name}")
+
+    response = None
+    if gi is not None:
+        response = open_download(gi, dataset, dataset_file, state)
+        if response is None:
+            return True
+
+    metadata_file = f"/tmp/metadata-{dataset.id}"
+    if state is not None:
+        # variants above the watermark are cleaned up if the import is interrupted, see remove_datasets
+        watermark = asyncio.get_event_loop().run_until_complete(worker.db.get_variant_watermark())
+        state.start_dataset(dataset, watermark=watermark)
+
+    def resolve_origins(variants: Iterable[Variant]):
+        with metrics.stage("origins"):
+            asyncio.get_event_loop().run_until_complete(
+                persist_variant_origins(dataset.id, variants, beacon_dataset_id(dataset), origins_store, state,
+                                        worker.db, bulk=origins_lookup == "bulk"))
+
+    with metrics.stage("import"):
+        prepare_metadata_file(dataset, metadata_file)
+        if gi is not None:
+            # streamed datasets can not be read again, so their origins are resolved while they are imported
+            logging.info(f"streaming {dataset.name}")
+            stream_import(response, metadata_file, incremental_counts,
+                          resolve_origins if origins_store is not None or state is not None else None)
+        else:
+            beacon_import(dataset_file, metadata_file, worker.db, incremental_counts, regions, region_size)
+        os.remove(metadata_file)
+        if state is not None:
+            state.set_stage(dataset.id, STAGE_IMPORTED)
+
+        # save the origin of the variants in beacon database
+        if gi is None and (origins_store is not None or state is not None):
+            resolve_origins(VCF(dataset_file))
+    metrics.add("import", datasets=1)
+
+    if state is not None:
+        state.finish_dataset(dataset.id)
+    return True
+
+
+def discover_datasets(gi: GalaxyInstance, workers: int) -> Dict[str, GalaxyDataset]:
+    """
+    Returns all datasets currently shared in beacon histories by their id
+    """
+    current: Dict[str, GalaxyDataset] = {}
+    with metrics.stage("discovery"):
+        for history_id in iter_beacon_histories(gi, workers):
+            for dataset in get_datasets(gi, history_id, workers):
+                current[dataset.id] = dataset
+    return current
 
 
-async def update_variant_counts():
+def record_discovery(state: SyncState, datasets: Iterable[GalaxyDataset]) -> Iterator[GalaxyDataset]:
     """
-    asd
+    Records each dataset in the manifest as it is discovered
     """
+    for dataset in datasets:
+        state.discover_dataset(dataset)
+        yield dataset
 
-    await db.update_dataset_counts()
 
+def remove_datasets(state: SyncState, to_remove: List[str], update_counts: bool) -> bool:
+    """
+    Removes the variants of the given datasets and of interrupted imports, then forgets the datasets
+
+        Parameters:
+            state (SyncState): manifest of the imported datasets
+            to_remove (List[str]): IDs of the datasets to remove, see diff_datasets
+            update_counts (bool): subtract the removed variants from beacon_dataset_counts_table
+
+        Returns:
+            True if variants of interrupted imports have been removed, their counts are unknown and have to be
+            calculated from scratch
+    """
+    loop = asyncio.get_event_loop()
+    interrupted = False
 
+    with metrics.stage("removal"):
+        # interrupted imports may have left variants that are not tagged with their dataset yet
+        watermark = state.incomplete_watermark()
+        if watermark is not None:
+            tagged = state.complete_rows_above(watermark)
+            removed = loop.run_until_complete(db.delete_untagged_variants(watermark, tagged))
+            logging.info(f"removed {removed} variants of interrupted imports")
+            metrics.add("removal", variants=removed)
+            interrupted = True
 
-def cleanup(dataset_file: str, metadata_file: str):
+        for dataset_id in to_remove:
+            for indices in state.orphaned_rows(dataset_id):
+                loop.run_until_complete(db.delete_variants([int(index) for index in indices], update_counts))
+                metrics.add("removal", variants=len(indices))
+            state.forget_dataset(dataset_id)
+            metrics.add("removal", datasets=1)
+
+    return interrupted
+
+
+def report_failed_downloads(state: SyncState) -> bool:
     """
-    Removes given files
+    Logs the datasets whose download failed
+
+        Returns:
+            True if all downloads succeeded
     """
-    os.remove(dataset_file)
-    os.remove(metadata_file)
+    failed = state.failed_datasets()
+    if failed:
+        logging.critical(f"{len(failed)} datasets could not be downloaded and are missing: {', '.join(failed)}")
+    return not failed
 
 
 def command_rebuild(args: Namespace):
@@ -427,80 +1508,375 @@ def command_rebuild(args: Namespace):
              None.
 
         Returns:
-            Nothing.
+            False if datasets are missing because the import was aborted or downloads failed
 
         Note:
+            With args.shadow, variants are imported into the staging schema and replace the live tables only
+            after the import succeeded, see BeaconExtendedDB.prepare_shadow and publish_shadow.
+            The progress of each dataset is recorded in the sync manifest. With args.resume, an interrupted rebuild
+            continues from there: complete datasets are kept, variants of interrupted imports are removed and the
+            remaining datasets are imported.
             This function uses args from the rebuild subparser
     """
 
     global db
-    gi = set_up_galaxy_instance(args.galaxy_url, args.galaxy_key)
+    gi = connect_galaxy(args)
 
     loop = asyncio.get_event_loop()
 
     # connect to beacons database
-    os.environ['DATABASE_URL'] = args.database_host
-    os.environ['DATABASE_PORT'] = args.database_port
-    os.environ['DATABASE_USER'] = args.database_user
-    os.environ['DATABASE_PASSWORD'] = args.database_password
-    os.environ['DATABASE_NAME'] = args.database_name
-
-    loop.run_until_complete(db.connection())
+    loop.run_until_complete(connect_beacon(args))
+    instrument_calls(gi)
+
+    # searches look variants up by position and bases, see BeaconExtendedDB.ensure_variant_index
+    loop.run_until_complete(db.ensure_variant_index())
+
+    # a shadow rebuild keeps its manifest next to the live one until the tables are swapped
+    state_file = staging_path(args.state_file) if args.shadow else args.state_file
+    state = SyncState(state_file)
+
+    resume = args.resume and not state.is_empty()
+    if args.shadow and resume and not loop.run_until_complete(db.get_schema_tables(STAGING_SCHEMA)):
+        logging.warning(f"staging schema {STAGING_SCHEMA} is missing")
+        resume = False
+    if args.resume and not resume:
+        logging.warning("nothing to resume - starting a new rebuild")
+
+    origins_file = args.origins_file
+    if args.shadow:
+        # import into empty staging tables while the live tables keep answering queries
+        if not resume:
+            with metrics.stage("clear"):
+                loop.run_until_complete(db.prepare_shadow())
+        os.environ[IMPORT_SCHEMA_VARIABLE] = STAGING_SCHEMA
+        loop.run_until_complete(db.use_schema(STAGING_SCHEMA))
+        origins_file = staging_path(args.origins_file)
+    elif not resume:
+        # delete all data before the new import
+        with metrics.stage("clear"):
+            loop.run_until_complete(db.clear_database())
+
+    incremental_counts = args.incremental_counts
+    if resume:
+        logging.info(f"resuming rebuild, datasets by stage: {state.stages()}")
+
+        # complete datasets are kept unless they changed in the meantime, everything else starts over
+        to_import, to_remove = diff_datasets(discover_datasets(gi, args.discovery_workers), state.datasets())
+        logging.info(f"{len(to_import)} datasets to import, {len(to_remove)} datasets to remove")
+        remove_datasets(state, to_remove, update_counts=False)
+
+        # counts of the imports before the interruption are lost
+        incremental_counts = False
+    else:
+        to_remove = []
+        state.clear()
 
-    # delete all data before the new import
-    loop.run_until_complete(db.clear_database())
+        # discovery happens while the pipeline consumes the datasets, so its time is measured per dataset
+        to_import = record_discovery(state, metrics.iterate(
+            "discovery", (dataset
+                          for history_id in iter_beacon_histories(gi, args.discovery_workers)
+                          for dataset in get_datasets(gi, history_id, args.discovery_workers))))
 
+    origins_store = None
     if args.store_origins:
-        try:
-            os.remove(args.origins_file)
-        except:
-            # the file probably does not exist
-            pass
+        if not resume:
+            try:
+                os.remove(origins_file)
+            except:
+                # the file probably does not exist
+                pass
+
+        # open the store of the variant origins
+        origins_store = OriginsStore(origins_file, compress=args.compress_origins)
+        if resume:
+            origins_store.remove_datasets(to_remove)
+
+    cache = set_up_cache(args) if not args.stream else None
+
+    # load data from beacon histories, tagging the imported variants with their dataset
+    # downloads and imports overlap, see run_pipeline
+    regions = start_region_workers(args.region_workers) if not args.stream else None
+    download = (partial(stream_step, gi) if args.stream
+                else partial(download_step, gi, cache=cache, with_index=regions is not None, state=state))
+    completed = run_pipeline(to_import,
+                             download,
+                             partial(import_step, origins_store=origins_store, state=state,
+                                     origins_lookup=args.origins_lookup, incremental_counts=incremental_counts,
+                                     regions=regions, region_size=args.region_size,
+                                     gi=gi if args.stream else None),
+                             download_workers=args.download_workers,
+                             import_workers=args.import_workers,
+                             queue_size=args.queue_size,
+                             release=skip_release if args.stream else partial(release_step, cache),
+                             setup=connect_worker,
+                             teardown=disconnect_worker)
+
+    if regions is not None:
+        regions.shutdown()
+
+    if origins_store is not None:
+        origins_store.close()
+
+    completed = report_failed_downloads(state) and completed
+    if not completed:
+        logging.critical("rebuild is incomplete, run it again with --resume to import the missing datasets")
+    if args.shadow and not completed:
+        logging.critical(f"the live tables are unchanged (staging schema {STAGING_SCHEMA} kept)")
+        return False
 
-        # open a file to store variant origins
-        variant_origins_file = open(args.origins_file, "a")
+    # calculate variant counts
+    logging.info("Setting variant counts")
+    with metrics.stage("counts"):
+        loop.run_until_complete(update_variant_counts(incremental_counts))
 
-    # load data from beacon histories
-    for history_id in get_beacon_histories(gi):
-        for dataset in get_datasets(gi, history_id):
-            # dataset import happens here
-            logging.info(f"next file is {dataset.name}")
+    if args.shadow:
+        with metrics.stage("indexes"):
+            loop.run_until_complete(db.build_shadow_indexes())
+
+        # replace the live tables, origins and manifest in one step
+        logging.info("Publishing shadow rebuild")
+        with metrics.stage("swap"):
+            loop.run_until_complete(db.publish_shadow(keep_previous=not args.drop_previous))
+        del os.environ[IMPORT_SCHEMA_VARIABLE]
+        loop.run_until_complete(db.use_schema(LIVE_SCHEMA))
+        publish_file(args.origins_file, keep_previous=not args.drop_previous)
+        state.close()
+        publish_file(args.state_file, keep_previous=not args.drop_previous)
+
+    return completed
+
+
+def command_sync(args: Namespace):
+    """
+    Synchronizes beacon database with the datasets retrieved from galaxy
+
+        Parameters:
+             None.
+
+        Returns:
+            False if datasets are missing because the import was aborted or downloads failed
+
+        Note:
+            Only new or changed datasets are downloaded and imported. Variants of datasets that have been deleted,
+            unshared or changed since the last sync are removed. Which variant stems from which dataset is kept in
+            the local manifest given by args.state_file.
+            This function uses args from the sync subparser
+    """
+
+    global db
+    gi = connect_galaxy(args)
+
+    loop = asyncio.get_event_loop()
+
+    # connect to beacons database
+    loop.run_until_complete(connect_beacon(args))
+    instrument_calls(gi)
+
+    # searches look variants up by position and bases, see BeaconExtendedDB.ensure_variant_index
+    loop.run_until_complete(db.ensure_variant_index())
+
+    state = SyncState(args.state_file)
+
+    # without a manifest there is no way to tell which variants stem from which dataset
+    if state.is_empty():
+        logging.info("no sync state found - starting from an empty database")
+        loop.run_until_complete(db.clear_database())
+        if args.store_origins and os.path.exists(args.origins_file):
+            os.remove(args.origins_file)
 
-            # destination paths for downloaded dataset and metadata
-            dataset_file = f"/tmp/dataset-{dataset.uuid}"
-            metadata_file = f"/tmp/metadata-{dataset.uuid}"
+    # compare datasets in galaxy with the ones imported so far
+    current = discover_datasets(gi, args.discovery_workers)
 
-            # download dataset from galaxy
-            download_dataset(gi, dataset, dataset_file)
-            prepare_metadata_file(dataset, metadata_file)
+    to_import, to_remove = diff_datasets(current, state.datasets())
+    logging.info(f"{len(to_import)} datasets to import, {len(to_remove)} datasets to remove")
 
-            beacon_import(dataset_file, metadata_file)
+    # remove variants of deleted, unshared, changed and incompletely imported datasets
+    interrupted = remove_datasets(state, to_remove, args.incremental_counts)
+    incremental_counts = args.incremental_counts and not interrupted
 
-            # save the origin of the variants in beacon database
-            if args.store_origins:
-                loop.run_until_complete(persist_variant_origins(dataset.id, VCF(dataset_file), variant_origins_file))
+    origins_store = None
+    if args.store_origins:
+        origins_store = OriginsStore(args.origins_file, compress=args.compress_origins)
+        origins_store.remove_datasets(to_remove)
+
+    # import new and changed datasets, tagging the imported variants with their dataset
+    cache = set_up_cache(args) if not args.stream else None
+    regions = start_region_workers(args.region_workers) if not args.stream else None
+    download = (partial(stream_step, gi) if args.stream
+                else partial(download_step, gi, cache=cache, with_index=regions is not None, state=state))
+    completed = run_pipeline(to_import,
+                             download,
+                             partial(import_step, origins_store=origins_store, state=state,
+                                     origins_lookup=args.origins_lookup, incremental_counts=incremental_counts,
+                                     regions=regions, region_size=args.region_size,
+                                     gi=gi if args.stream else None),
+                             download_workers=args.download_workers,
+                             import_workers=args.import_workers,
+                             queue_size=args.queue_size,
+                             release=skip_release if args.stream else partial(release_step, cache),
+                             setup=connect_worker,
+                             teardown=disconnect_worker)
+
+    if regions is not None:
+        regions.shutdown()
+
+    if origins_store is not None:
+        origins_store.close()
 
     # calculate variant counts
     logging.info("Setting variant counts")
-    loop.run_until_complete(update_variant_counts())
+    with metrics.stage("counts"):
+        loop.run_until_complete(update_variant_counts(incremental_counts))
+
+    return report_failed_downloads(state) and completed
+
+
+def variant_origins(origins_file: str, state_file: str, indices: Iterable[int]) -> Dict[int, List[str]]:
+    """
+    Maps database indices to the galaxy datasets the variants stem from
+
+    The origins store is used if it exists, otherwise the sync manifest.
+
+        Parameters:
+            origins_file (str): full path of the origins store
+            state_file (str): full path of the sync manifest
+            indices (Iterable[int]): database indices to look up
+
+        Returns:
+            origins (Dict[int, List[str]]): maps each index to the IDs of its galaxy datasets
+    """
+    wanted = set(indices)
+    origins: Dict[int, List[str]] = {}
+
+    if os.path.exists(origins_file):
+        store = OriginsStore(origins_file)
+        for index, index_origins in store.lookup(wanted).items():
+            origins[index] = [dataset_id for dataset_id, _ in index_origins]
+        store.close()
+    elif os.path.exists(state_file):
+        state = SyncState(state_file)
+        for index, dataset_id in state.row_datasets(str(index) for index in wanted):
+            origins.setdefault(int(index), []).append(dataset_id)
+        state.close()
+
+    return origins
+
+
+def command_rollback(args: Namespace) -> bool:
+    """
+    Restores the tables replaced by the last shadow rebuild, the replacing ones are kept as previous copy
+
+        Parameters:
+            args (Namespace): parsed arguments of the rollback subparser
+
+        Returns:
+            False if there is nothing to roll back to
+    """
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(connect_beacon(args))
+
+    try:
+        loop.run_until_complete(db.rollback_schemas())
+    except RuntimeError as e:
+        logging.critical(f"Cannot roll back - {e}")
+        return False
+    logging.info("Restored the tables of the previous rebuild")
+    rollback_file(args.origins_file)
+
+    # the manifest is swapped along with the tables, without a previous one the next sync starts over
+    if os.path.exists(previous_path(args.state_file)):
+        rollback_file(args.state_file)
+    else:
+        SyncState(args.state_file).clear()
+    return True
+
+
+def command_origins(args: Namespace) -> bool:
+    """
+    Prints the origins of the variants given by command line args as "{index} {dataset_id}" lines
+
+    Without indices, the variants of args.dataset or the number of variants of each dataset are printed.
+
+        Returns:
+            False if there is no origins store
+    """
+    if not os.path.exists(args.origins_file):
+        logging.critical(f"no variant origins at {args.origins_file}, they are stored by rebuild and sync with -s")
+        return False
+
+    store = OriginsStore(args.origins_file)
+    if args.indices:
+        origins = store.lookup(args.indices)
+        for index in args.indices:
+            for dataset_id, _ in origins.get(index, []):
+                print(f"{index} {dataset_id}")
+    elif args.dataset:
+        for index, _ in store.dataset_variants(args.dataset):
+            print(f"{index} {args.dataset}")
+    else:
+        for dataset_id, count in sorted(store.dataset_counts().items()):
+            print(f"{dataset_id} {count} variants")
+    store.close()
+    return True
 
 
 def command_search(args: Namespace):
+    """
+    Searches a variant (as specified in command line args) in the beacon database
+
+    Hits are mapped back to galaxy datasets using the variant origins (see persist_variant_origins).
+
+    Note:
+        With --exhaustive each dataset is downloaded and scanned instead
+    """
+    if args.exhaustive:
+        search_datasets(args)
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(connect_beacon(args))
+
+    print(f"searching variant {args.ref} -> {args.alt} at position {args.start}\n")
+    hits = loop.run_until_complete(db.search_variant(args.start, args.ref, args.alt))
+    loop.run_until_complete(db._conn.close())
+
+    if not hits:
+        print("variant not found")
+        return
+
+    origins = variant_origins(args.origins_file, args.state_file, [index for index, _ in hits])
+    if not origins:
+        for index, beacon_dataset in hits:
+            print(f"found variant in beacon dataset {beacon_dataset} (no origins recorded)")
+        return
+
+    # only ask galaxy for the names of the datasets that contain the variant
+    gi = connect_galaxy(args)
+    for index, beacon_dataset in hits:
+        for dataset_id in origins.get(index, []):
+            dataset = gi.datasets.show_dataset(dataset_id)
+            print(f"found variant in dataset {dataset_id} ({dataset['name']}) of beacon dataset {beacon_dataset}")
+
+
+def search_datasets(args: Namespace):
     """
     Searches a variant (as specified in command line args) across all datasets
 
     Note:
         This will download each dataset
     """
-    gi = set_up_galaxy_instance(args.galaxy_url, args.galaxy_key)
+    gi = connect_galaxy(args)
+
+    cache = set_up_cache(args)
 
     print(f"searching variant {args.ref} -> {args.alt} at position {args.start} (each dot is one dataset)\n")
     # load data from beacon histories
-    for history_id in get_beacon_histories(gi):
-        for dataset in get_datasets(gi, history_id):
+    for history_id in iter_beacon_histories(gi, args.discovery_workers):
+        for dataset in get_datasets(gi, history_id, args.discovery_workers):
 
-            dataset_file = f"/tmp/searching-{dataset.uuid}"
-            download_dataset(gi, dataset, dataset_file)
+            dataset_file = download_step(gi, dataset, cache)
+            if dataset_file is None:
+                continue
 
             dataset_vcf: VCF
             dataset_vcf = VCF(dataset_file)
@@ -511,19 +1887,39 @@ def command_search(args: Namespace):
                 if variant.start == args.start and variant.REF == args.ref and args.alt in variant.ALT:
                     print(f"found variant in dataset {dataset.id} ({dataset.name})")
 
-            os.remove(dataset_file)
+            release_step(cache, dataset, dataset_file)
 
 
 def main():
     """
     Main function runs sub commands based on the given command line arguments
     """
+    global metrics
     args = parse_arguments()
 
     set_up_logging(args.verbosity)
 
-    if args.command == "rebuild":
-        command_rebuild(args)
+    if args.command in ("rebuild", "sync"):
+        # the run summary and metrics files are written even if the command fails
+        metrics = RunMetrics(args.command, "beacon")
+        success = False
+        try:
+            if args.command == "rebuild":
+                success = command_rebuild(args) is not False
+            else:
+                success = command_sync(args) is not False
+        finally:
+            report_metrics(args, success)
+        if not success:
+            sys.exit(1)
+
+    if args.command == "rollback":
+        if not command_rollback(args):
+            sys.exit(1)
+
+    if args.command == "origins":
+        if not command_origins(args):
+            sys.exit(1)
 
     if args.command == "search":
         command_search(args)
@@ -4,8 +4,25 @@ import re
 import os
 from argparse import Namespace
 from utils import *
-from pymongo import MongoClient
+from state import STAGE_DOWNLOADED, SyncState, diff_datasets
+from pipeline import remove_file, run_pipeline, skip_release
+from cache import DownloadCache, parse_size
+from indexes import create_indexes
+from query_cache import GENERATION_COLLECTION, bump_generation
+from metrics import RunMetrics
+from origins import OriginsStore
+from shadow import (STAGING_PREFIX, copy_indexes, drop_collections, prefixed_collections, previous_path, publish_file,
+                    rollback_collections, rollback_file, staging_path, swap_collections, swap_interrupted)
+from streaming import open_stream
+from functools import partial
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from bson import ObjectId, json_util
+import io
 import json
+import sys
+import threading
+import time
 
 class BeaconDB:
     def __init__(self):
@@ -17,6 +34,12 @@ class BeaconDB:
         self.database_port = ''
         self.database_name = ''
         self.database_auth_source = ''
+        # Prefix of the collections written to, set to STAGING_PREFIX during a shadow rebuild
+        self.collection_prefix = ''
+
+    def collection(self, name: str):
+        # Returns the collection documents of the given kind are written to and read from
+        return self.client[self.database_name][self.collection_prefix + name]
 
     def connection(self):
         # Establish connection to the MongoDB database
@@ -51,29 +74,168 @@ class BeaconDB:
 
     def get_variant_indices(self, start: int, ref: str, alt: str, var_id: str) -> list:
         # Get variant indices from the genomicVariations collection
-        rows = self.client[self.database_name]['genomicVariations'].find({'alternateBases': alt, 'referenceBases': ref, 'variantInternalId': var_id})
-        rows_l = [row for row in rows]
-        rows_res_list = []
-        for row_dict in rows_l:
-            if row_dict['position']['start'][0] == start:
-                rows_res_list.append(row_dict)
-        return [str(row["_id"]) for row in rows_res_list]
+        rows = self.collection('genomicVariations').find(
+            {'alternateBases': alt, 'referenceBases': ref, 'variantInternalId': var_id, 'position.start.0': start},
+            {'_id': 1})
+        return [str(row["_id"]) for row in rows]
+
+    def get_variant_indices_bulk(self, variants: list) -> dict:
+        # Get variant indices of many variants from the genomicVariations collection with a single query
+        # variants is a list of (start, ref, alt, var_id) tuples, the result maps each of them to a list of document ids
+        if not variants:
+            return {}
+        query = {'$or': [
+            {'alternateBases': alt, 'referenceBases': ref, 'variantInternalId': var_id, 'position.start.0': start}
+            for start, ref, alt, var_id in variants
+        ]}
+        projection = {'_id': 1, 'alternateBases': 1, 'referenceBases': 1, 'variantInternalId': 1, 'position.start': 1}
+
+        indices = {variant: [] for variant in variants}
+        for row in self.collection('genomicVariations').find(query, projection):
+            key = (row['position']['start'][0], row['referenceBases'], row['alternateBases'], row['variantInternalId'])
+            if key in indices:
+                indices[key].append(row['_id'])
+        return indices
+
+    def delete_documents(self, collection_name: str, ids: list):
+        # Remove the documents with the given ids from a collection
+        self.collection(collection_name).delete_many({'_id': {'$in': ids}})
 
     def update_dataset_counts(self):
         # Update dataset counts in the datasets collection
+        # Variants and calls are counted per dataset by MongoDB, only one document per dataset is transferred
         try:
-            rows = self.client[self.database_name]['genomicVariations'].find({})
-            count = 0
-            for row in rows:
-                count += 1
-            self.client[self.database_name]['datasets'].update_many({}, {'$set': {'data_count': str(count)}})
-            return f'There are {str(count)} data'
+            pipeline = [{'$group': {
+                '_id': '$datasetId',
+                'variants': {'$sum': 1},
+                'calls': {'$sum': {'$cond': [{'$isArray': '$caseLevelData'}, {'$size': '$caseLevelData'}, 0]}}
+            }}]
+            counts = {}
+            for row in self.collection('genomicVariations').aggregate(pipeline, allowDiskUse=True):
+                counts[row['_id']] = (row['variants'], row['calls'])
+            return self.persist_dataset_counts(counts)
         except:
             return 'There are some errors in update dataset counts'
 
+    def persist_dataset_counts(self, counts: dict):
+        # Write variant and call counts (mapping datasetId to (variants, calls)) to the datasets collection
+        datasets = self.collection('datasets')
+        total = sum(variants for variants, _ in counts.values())
+
+        # Variants without datasetId can not be assigned to a dataset, every dataset gets the overall count then
+        if set(counts) <= {None}:
+            calls = sum(calls for _, calls in counts.values())
+            datasets.update_many({}, {'$set': {'data_count': str(total), 'call_count': str(calls)}})
+            return f'There are {str(total)} data'
+
+        updates = [UpdateOne({'id': dataset_id}, {'$set': {'data_count': str(variants), 'call_count': str(calls)}})
+                   for dataset_id, (variants, calls) in counts.items() if dataset_id is not None]
+        datasets.bulk_write(updates, ordered=False)
+
+        # Datasets without any variant
+        datasets.update_many({'id': {'$nin': list(counts)}}, {'$set': {'data_count': '0', 'call_count': '0'}})
+        return f'There are {str(total)} data in {len(updates)} datasets'
+
+
+class DatasetCounts:
+    # Keeps per-dataset variant and call counts up to date while genomicVariations documents are imported,
+    # so they can be persisted without counting the whole collection afterwards
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, documents: list):
+        # Add the counts of a batch of inserted documents
+        with self._lock:
+            for document in documents:
+                calls = document.get('caseLevelData')
+                variants_before, calls_before = self.counts.get(document.get('datasetId'), (0, 0))
+                self.counts[document.get('datasetId')] = (variants_before + 1,
+                                                          calls_before + (len(calls) if isinstance(calls, list) else 0))
+
 
 db: BeaconDB = BeaconDB()
 
+# Metrics of the current run, replaced by main for each command
+metrics: RunMetrics = RunMetrics()
+
+# Maps keywords in dataset names to the collection the dataset is imported to
+path_dict = {
+    "analyses": "analyses",
+    "biosamples": "biosamples",
+    "cohorts": "cohorts",
+    "genomicVariations": "genomicVariations",
+    "individuals": "individuals",
+    "runs": "runs"
+}
+
+def database_arguments(parser):
+    # Adds the arguments of the connection to the beacon database to the given parser
+    parser.add_argument("-A", "--db-auth-source", type=str, metavar="admin", default="admin",
+                        dest="database_auth_source",
+                        help="auth source for the beacon database")
+    parser.add_argument("-H", "--db-host", type=str, metavar="", default="127.0.0.1", dest="database_host",
+                        help="hostname/IP of the beacon database")
+    parser.add_argument("-P", "--db-port", type=str, metavar="", default="27017", dest="database_port",
+                        help="port of the beacon database")
+    parser.add_argument("-U", "--db-user", type=str, metavar="", default="root", dest="database_user",
+                        help="login user for the beacon database")
+    parser.add_argument("-W", "--db-password", type=str, metavar="", default="example",
+                        dest="database_password",
+                        help="login password for the beacon database")
+    parser.add_argument("-N", "--db-name", type=str, metavar="", default="beacon", dest="database_name",
+                        help="name of the beacon database")
+
+def local_file_arguments(parser):
+    # Adds the arguments of the local files linking documents to datasets to the given parser
+    parser.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
+                        dest="origins_file",
+                        help="full file path of the sqlite store of the variant origins (if enabled)")
+    parser.add_argument("-S", "--state-file", type=str, metavar="", default="/tmp/beacon2-sync-state.sqlite",
+                        dest="state_file",
+                        help="full file path of the local manifest of imported datasets (used by sync and --resume)")
+
+def import_arguments(parser):
+    # Adds arguments shared by the import commands (rebuild and sync) to the given parser
+    parser.add_argument("-s", "--store-origins", default=False, dest="store_origins",
+                        action="store_true",
+                        help="make a local file containing variantIDs with the dataset they stem from")
+    parser.add_argument("--compress-origins", default=False, dest="compress_origins", action="store_true",
+                        help="deflate the details kept with each variant origin")
+    local_file_arguments(parser)
+
+    # Database connection arguments
+    database_arguments(parser)
+
+    # Download cache arguments
+    parser.add_argument("--cache-dir", type=str, metavar="", default="/tmp/beacon2-download-cache", dest="cache_dir",
+                        help="directory in which downloaded datasets are kept for later runs")
+    parser.add_argument("--cache-size", type=parse_size, metavar="", default="10G", dest="cache_size",
+                        help="size the download cache is trimmed to, least recently used datasets are removed first")
+    parser.add_argument("--no-cache", default=False, dest="no_cache", action="store_true",
+                        help="remove downloaded datasets right after their import")
+    parser.add_argument("--verify-cache", default=False, dest="verify_cache", action="store_true",
+                        help="hash cached datasets on every use to detect corruption (as slow as reading them)")
+
+    # Download/import pipeline arguments
+    parser.add_argument("--download-workers", type=int, metavar="", default=2, dest="download_workers",
+                        help="number of datasets downloaded concurrently")
+    parser.add_argument("--import-workers", type=int, metavar="", default=1, dest="import_workers",
+                        help="number of datasets imported concurrently")
+    parser.add_argument("--queue-size", type=int, metavar="", default=2, dest="queue_size",
+                        help="number of downloaded datasets that may wait for an import worker")
+    parser.add_argument("--stream", default=False, dest="stream", action="store_true",
+                        help="parse datasets while they are downloaded instead of saving them first "
+                             "(no download cache)")
+    parser.add_argument("-b", "--batch-size", type=int, metavar="", default=1000, dest="batch_size",
+                        help="number of documents inserted into MongoDB at once")
+
+    # Metrics arguments
+    parser.add_argument("--metrics-file", type=str, metavar="", default="", dest="metrics_file",
+                        help="write timings, throughput and call counts of each stage to this JSON file")
+    parser.add_argument("--prometheus-file", type=str, metavar="", default="", dest="prometheus_file",
+                        help="write the metrics to this file for the textfile collector of the prometheus node exporter")
+
 def parse_arguments() -> Namespace:
     # Defines and parses command line arguments for this script
     parser = argparse.ArgumentParser(description="Push genomic variants from galaxy to beacon.")
@@ -89,189 +251,704 @@ def parse_arguments() -> Namespace:
                         help="galaxy hostname or IP")
     parser.add_argument("-k", "--galaxy-key", type=str, metavar="", default="",
                         dest="galaxy_key", help="API key of a galaxy user WITH ADMIN PRIVILEGES")
+    parser.add_argument("--discovery-workers", type=int, metavar="", default=8, dest="discovery_workers",
+                        help="number of concurrent galaxy requests while looking for beacon histories and datasets")
+    parser.add_argument("--galaxy-connections", type=int, metavar="", default=16, dest="galaxy_connections",
+                        help="number of connections to galaxy shared by discovery and downloads")
+    parser.add_argument("--galaxy-timeout", type=float, metavar="", default=60, dest="galaxy_timeout",
+                        help="seconds to wait for galaxy to answer a request or send the next part of a download")
+    parser.add_argument("--galaxy-retries", type=int, metavar="", default=5, dest="galaxy_retries",
+                        help="how often requests failing with connection errors or 5xx statuses are repeated "
+                             "(with exponential backoff)")
+    parser.add_argument("--galaxy-rate", type=float, metavar="", default=0, dest="galaxy_rate",
+                        help="maximum number of requests per second sent to galaxy (0 for no limit)")
 
     # Sub-parser for command "rebuild"
     parser_rebuild = subparsers.add_parser('rebuild')
-    parser_rebuild.add_argument("-s", "--store-origins", default=False, dest="store_origins",
-                                action="store_true",
-                                help="make a local file containing variantIDs with the dataset they stem from")
-    parser_rebuild.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.txt",
+    import_arguments(parser_rebuild)
+    parser_rebuild.add_argument("--incremental-counts", default=False, dest="incremental_counts", action="store_true",
+                                help="count variants and calls per dataset during the import instead of aggregating them afterwards")
+    parser_rebuild.add_argument("--create-indexes", default=False, dest="create_indexes", action="store_true",
+                                help="create the indexes used by beacon2-search.py once all datasets are imported")
+    parser_rebuild.add_argument("--shadow", default=False, dest="shadow", action="store_true",
+                                help="import to staging collections while the live ones keep answering queries, "
+                                     "then swap them with renameCollection")
+    parser_rebuild.add_argument("--drop-previous", default=False, dest="drop_previous", action="store_true",
+                                help="with --shadow, drop the replaced collections instead of keeping them for rollback")
+    parser_rebuild.add_argument("--resume", default=False, dest="resume", action="store_true",
+                                help="continue an interrupted rebuild from the progress recorded in the state file "
+                                     "(add --shadow if the interrupted rebuild used it)")
+
+    # Sub-parser for command "sync"
+    parser_sync = subparsers.add_parser('sync', help="only import new or changed datasets and remove deleted ones")
+    import_arguments(parser_sync)
+
+    # Sub-parser for command "rollback"
+    parser_rollback = subparsers.add_parser('rollback', help="restore the collections replaced by the last rebuild --shadow")
+    local_file_arguments(parser_rollback)
+    database_arguments(parser_rollback)
+
+    # Sub-parser for command "origins"
+    parser_origins = subparsers.add_parser('origins', help="look up the galaxy datasets variants stem from")
+    parser_origins.add_argument("ids", type=str, nargs="*", metavar="ID",
+                                help="ids of the genomicVariations documents to look up")
+    parser_origins.add_argument("-D", "--dataset", type=str, metavar="", default="", dest="dataset",
+                                help="list the variants stemming from this galaxy dataset instead")
+    parser_origins.add_argument("-o", "--origins-file", type=str, metavar="", default="/tmp/variant-origins.sqlite",
                                 dest="origins_file",
-                                help="full file path of where variant origins should be stored (if enabled)")
-
-    # Database connection arguments
-    parser_rebuild.add_argument("-A", "--db-auth-source", type=str, metavar="admin", default="admin",
-                                dest="database_auth_source",
-                                help="auth source for the beacon database")
-    parser_rebuild.add_argument("-H", "--db-host", type=str, metavar="", default="127.0.0.1", dest="database_host",
-                                help="hostname/IP of the beacon database")
-    parser_rebuild.add_argument("-P", "--db-port", type=str, metavar="", default="27017", dest="database_port",
-                                help="port of the beacon database")
-    parser_rebuild.add_argument("-U", "--db-user", type=str, metavar="", default="root", dest="database_user",
-                                help="login user for the beacon database")
-    parser_rebuild.add_argument("-W", "--db-password", type=str, metavar="", default="example",
-                                dest="database_password",
-                                help="login password for the beacon database")
-    parser_rebuild.add_argument("-N", "--db-name", type=str, metavar="", default="beacon", dest="database_name",
-                                help="name of the beacon database")
+                                help="full file path of the variant origins written by --store-origins")
 
     return parser.parse_args()
 
-def get_datasets(gi: GalaxyInstance, history_id: str) -> list:
-    # Fetches a given history's datasets from Galaxy
-    datasets = []
-    offset = 0
-    limit = 500
-
-    # Galaxy API uses paging for datasets. This while loop continuously retrieves pages of *limit* datasets
-    while True:
-        # Retrieve a list of datasets from the Galaxy API
-        api_dataset_list = gi.datasets.get_datasets(
-            history_id=history_id,
-            deleted=False,
-            extension=["json", "json_bgzip"],
-            limit=limit,
-            offset=offset
-        )
-
-        # Each api_dataset_list_entry is a dictionary with dataset details
-        for api_dataset_list_entry in api_dataset_list:
-            dataset_info = gi.datasets.show_dataset(dataset_id=api_dataset_list_entry["id"])
-            try:
-                dataset = GalaxyDataset(dataset_info)
-            except MissingFieldException as e:
-                logging.warning(f"Not reading dataset {api_dataset_list_entry['id']} because {e} from API response")
-                continue
-
-            # Filter for valid human references
-            match = re.match(r"(GRCh\d+|hg\d+).*", dataset.reference_name)
-            if match is None:
-                logging.warning(f"Not reading dataset {dataset.name} with unknown reference \"{dataset.reference_name}\"")
-                continue
-
-            # Set reference name to the first match group (removes patch level from reference)
-            dataset.reference_name = match.group(1)
-            datasets.append(dataset)
-        offset += limit
-
-        # No entries left
-        if len(api_dataset_list) == 0:
-            break
-
-    return datasets
-
-def download_dataset(gi: GalaxyInstance, dataset: GalaxyDataset, filename: str) -> None:
-    # Downloads a dataset from Galaxy to a given path
+def get_datasets(gi: GalaxyInstance, history_id: str, workers: int = 4):
+    # Yields a given history's datasets from Galaxy
+    # All needed fields are part of the history contents, pages are fetched concurrently (see iter_history_datasets)
+    for dataset_info in iter_history_datasets(gi, history_id, ["json", "json_bgzip"], workers=workers):
+        try:
+            dataset = GalaxyDataset(dataset_info)
+        except MissingFieldException as e:
+            logging.warning(f"Not reading dataset {dataset_info.get('id')} because {e} from API response")
+            continue
+
+        # Filter for valid human references
+        match = re.match(r"(GRCh\d+|hg\d+).*", dataset.reference_name)
+        if match is None:
+            logging.warning(f"Not reading dataset {dataset.name} with unknown reference \"{dataset.reference_name}\"")
+            continue
+
+        # Set reference name to the first match group (removes patch level from reference)
+        dataset.reference_name = match.group(1)
+        yield dataset
+
+def download_dataset(gi: GalaxyInstance, dataset: GalaxyDataset, filename: str) -> bool:
+    # Downloads a dataset from Galaxy to a given path, returns True on success
     try:
         gi.datasets.download_dataset(dataset.id, filename, use_default_filename=False)
+        metrics.add('download', datasets=1, bytes=os.path.getsize(filename))
+        return True
     except Exception as e:
         logging.critical(f"Something went wrong while downloading file - {e} filename:{filename}")
+        return False
 
-def import_to_mongodb(collection_name, datafile_path):
-    # Import data from a given file path into the specified MongoDB collection
+def insert_batch(collection, batch):
+    # Insert a batch of documents without stopping at the first failing document
+    # Returns the documents that have been inserted, each of them now carries its _id
+    start = time.perf_counter()
+    metrics.count_call('db', 'insert_many')
+    try:
+        collection.insert_many(batch, ordered=False)
+        inserted = batch
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        failed = {error['index'] for error in errors}
+        logging.warning(f"Failed to insert {len(failed)} documents into {collection.name}: {errors[0]['errmsg'] if errors else e}")
+        inserted = [document for index, document in enumerate(batch) if index not in failed]
+
+    end = time.perf_counter()
+    elapsed = end - start
+    metrics.record('insert', start, end)
+    metrics.add('insert', documents=len(inserted))
+    if collection.name == db.collection_prefix + 'genomicVariations':
+        metrics.add('insert', variants=len(inserted))
+    logging.info(f"Inserted {len(inserted)} documents into {collection.name} in {elapsed:.2f}s ({len(inserted) / max(elapsed, 1e-9):.0f} documents/s)")
+    return inserted
+
+def insert_documents(collection_name, f, batch_size=1000, on_inserted=None, before_insert=None):
+    # Insert the documents read from an open text file into the specified MongoDB collection
+    # The file (a JSON array or JSON Lines) is parsed incrementally and inserted in batches of batch_size documents,
+    # so memory usage depends on the batch size instead of the file size.
+    # before_insert is called with each batch before it is inserted, its documents already carry their _id
+    # on_inserted is called with the inserted documents of each batch
+    # Returns the number of inserted documents
+    collection = db.collection(collection_name)
+    count = 0
+
+    def insert(batch):
+        for document in batch:
+            # Ids given as extended JSON ({"$oid": ...}) are stored as ObjectId, like mongoimport does
+            if isinstance(document.get('_id'), dict):
+                document['_id'] = json_util.object_hook(document['_id'])
+        if before_insert is not None:
+            # Ids are assigned here instead of by insert_many, so the documents can be tagged before they exist
+            for document in batch:
+                document.setdefault('_id', ObjectId())
+            before_insert(batch)
+        inserted = insert_batch(collection, batch)
+        if on_inserted is not None:
+            on_inserted(inserted)
+        return len(inserted)
+
+    batch = []
+    # Time spent reading documents from the file is recorded as parsing
+    for document in metrics.iterate('parse', iter_json_documents(f)):
+        batch.append(document)
+        if len(batch) < batch_size:
+            continue
+        count += insert(batch)
+        batch = []
+    if batch:
+        count += insert(batch)
+    return count
+
+def import_to_mongodb(collection_name, datafile_path, batch_size=1000, on_inserted=None, before_insert=None):
+    # Import data from a given file path into the specified MongoDB collection, see insert_documents
+    # Returns the number of inserted documents or None if the import failed
     try:
         with open(datafile_path) as f:
-            data = json.load(f)
-            db.client[db.database_name][collection_name].insert_many(data)
-        return True
+            return insert_documents(collection_name, f, batch_size, on_inserted, before_insert)
     except:
         print(f"The downloaded file probably does not exist. file name:{datafile_path}")
         logging.info(f"The downloaded file probably does not exist. file name:{datafile_path}")
-        return False
+        return None
+
+def stream_to_mongodb(collection_name, response, batch_size=1000, on_inserted=None, before_insert=None):
+    # Import data into the specified MongoDB collection while it is downloaded, without saving it to disk
+    # gzip and bgzip compressed datasets are decompressed on the fly, see open_stream
+    # Returns the number of inserted documents or None if the download or the import failed
+    try:
+        with response, open_stream(response, on_bytes=lambda size: metrics.add('download', bytes=size)) as stream:
+            count = insert_documents(collection_name, io.TextIOWrapper(stream, encoding='utf-8'), batch_size,
+                                     on_inserted, before_insert)
+        metrics.add('download', datasets=1)
+        return count
+    except Exception as e:
+        logging.critical(f"Failed to stream {response.url.split('?')[0]} into {collection_name} - {e}")
+        return None
+
+def origin_key(variant):
+    # Returns (start, ref, alt, var_id) identifying a variant document or None if a field is missing
+    try:
+        return (variant['position']['start'][0], variant['referenceBases'], variant['alternateBases'],
+                variant['variantInternalId'])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+def origin_details(key):
+    # Returns the details kept with the origin of a variant, key as returned by origin_key
+    start, REF, ALT, var_id = key
+    return {'alternateBases': ALT, 'start': start, 'referenceBases': REF, 'variantInternalId': var_id}
+
+def format_origin(data_id, dataset_id, details):
+    # Formats an origin like the lines of the plain text origins file of earlier versions
+    return (f"data_id:{data_id} dataset_id:{dataset_id} alternateBases:{details['alternateBases']} "
+            f"start:{details['start']} referenceBases:{details['referenceBases']} "
+            f"variantInternalId:{details['variantInternalId']}")
+
+def origin_id(_id):
+    # Returns how the origins store keys a document id: ObjectIds by their 12 bytes, ids of other types as string
+    return _id.binary if isinstance(_id, ObjectId) else str(_id)
+
+def document_id(key):
+    # Returns the document id of a key in the origins store, see origin_id
+    return ObjectId(key) if isinstance(key, bytes) else key
+
+def record_variant_origins(dataset_id: str, documents: list, record: OriginsStore):
+    # Maps dataset_id to the ids of freshly inserted variant documents in the origins store
+    # insert_many sets the _id of each document, so no lookup in the database is needed
+    ids, details = [], []
+    for document in documents:
+        key = origin_key(document)
+        if key is None:
+            continue
+        ids.append(origin_id(document['_id']))
+        details.append(origin_details(key))
+    record.add(dataset_id, ids, details)
+
+def persist_variant_origins(dataset_id: str, dataset: str, record: OriginsStore, batch_size: int = 1000):
+    # Maps dataset_id to variant index in the origins store for variants that are already in the database
+    # Variants are resolved in batches with a single query each, see BeaconDB.get_variant_indices_bulk
+    def resolve(batch):
+        ids, details = [], []
+        for key, res_list in db.get_variant_indices_bulk(batch).items():
+            for res_id in res_list:
+                ids.append(origin_id(res_id))
+                details.append(origin_details(key))
+        record.add(dataset_id, ids, details)
 
-def persist_variant_origins(dataset_id: str, dataset: str, record):
-    # Maps dataset_id to variant index in a separate file
     try:
         with open(dataset) as j_f:
-            data = json.load(j_f)
-            for variant in data:
-                try:
-                    ALT = variant['alternateBases']
-                    start = variant['position']['start'][0]
-                    REF = variant['referenceBases']
-                    var_id = variant['variantInternalId']
-                except:
+            batch = []
+            for variant in iter_json_documents(j_f):
+                key = origin_key(variant)
+                if key is None:
                     print(f'Some fields may not be found')
                     continue
-                try:
-                    res_list = db.get_variant_indices(start, REF, ALT, var_id)
-                    for res_id in res_list:
-                        record.write(f'data_id:{res_id} dataset_id:{dataset_id} alternateBases:{ALT} start:{start} referenceBases:{REF} variantInternalId:{var_id}\n')
-                except:
-                    print(f'Something went wrong when searching this field and recording')
-                    continue
+                batch.append(key)
+                if len(batch) >= batch_size:
+                    resolve(list(set(batch)))
+                    batch = []
+            resolve(list(set(batch)))
     except:
         print(f'The dataset file probably does not exist dataset:{dataset_id}')
         logging.info(f'The dataset file probably does not exist dataset:{dataset_id}')
         return False
 
+def dataset_collections(datasets):
+    # Pairs each dataset with the collections it is imported to, based on its name
+    for dataset in datasets:
+        for key in path_dict:
+            if key in dataset.name:
+                yield dataset, path_dict[key]
+
+def set_up_cache(args: Namespace):
+    # Opens the download cache given by the command line args, None if caching is disabled
+    if args.no_cache:
+        return None
+    return DownloadCache(args.cache_dir, args.cache_size, args.verify_cache)
+
+def download_step(gi: GalaxyInstance, item, cache=None, state=None):
+    # Download stage of the import pipeline, returns the downloaded file or None
+    # With a cache, the file is shared by all collections and copies of the dataset
+    # Only actual downloads count as downloaded bytes, files taken from the cache do not
+    # Failed downloads are recorded in the manifest, see SyncState.failed_datasets
+    dataset, collection_name = item
+    with metrics.stage('download'):
+        if cache is not None:
+            path = cache.get(dataset, partial(download_dataset, gi, dataset))
+        else:
+            logging.info(f"Downloading {dataset.name}")
+
+            # The dataset id is used instead of the uuid, copies of a dataset share the same uuid
+            path = f"/tmp/{collection_name}-{dataset.id}"
+            if not download_dataset(gi, dataset, path):
+                path = None
+
+    if path is None:
+        metrics.add('download', failed=1)
+        if state is not None:
+            state.fail_dataset(dataset, collection_name)
+    elif state is not None:
+        state.set_stage(dataset.id, STAGE_DOWNLOADED)
+    return path
+
+def stream_step(gi: GalaxyInstance, item):
+    # Download stage of the import pipeline in streaming mode, returns the URL the import stage streams the dataset from
+    dataset, collection_name = item
+    return f"{gi.base_url}/api/datasets/{dataset.id}/display?to_ext={dataset.extension}"
+
+def open_download(gi: GalaxyInstance, item, url, state=None):
+    # Starts the download of a streamed dataset, returns the response with its body not read yet or None
+    # Failed downloads are recorded in the manifest like in download_step
+    dataset, collection_name = item
+    with metrics.stage('download'):
+        try:
+            response = gi.make_get_request(url, stream=True)
+            response.raise_for_status()
+            return response
+        except Exception as e:
+            logging.critical(f"Something went wrong while downloading file - {e} dataset:{dataset.id}")
+    metrics.add('download', failed=1)
+    if state is not None:
+        state.fail_dataset(dataset, collection_name)
+    return None
+
+def release_step(cache, item, path):
+    # Release stage of the import pipeline, hands an imported file back to the cache or removes it
+    if cache is not None:
+        cache.release(path)
+    else:
+        remove_file(item, path)
+
+def import_step(item, path, origins_store=None, state=None, batch_size=1000, counts=None, gi=None):
+    # Import stage of the import pipeline, runs in an import worker
+    # With gi, the dataset is streamed from galaxy and path is the URL returned by stream_step
+    # Returns False to abort the pipeline, failed downloads are skipped
+    dataset, collection_name = item
+    logging.info(f"Next file is {dataset.name}")
+
+    response = None
+    if gi is not None:
+        response = open_download(gi, item, path, state)
+        if response is None:
+            return True
+
+    store_origins = collection_name == 'genomicVariations' and origins_store is not None
+    if state is not None:
+        state.start_dataset(dataset, collection_name)
+
+    def before_insert(documents):
+        # Tag the documents with their dataset before they are inserted, so an interrupted import can be cleaned up
+        with metrics.stage('origins'):
+            state.add_rows(dataset.id, (json_util.dumps(document['_id']) for document in documents))
+
+    def on_inserted(documents):
+        with metrics.stage('origins'):
+            if store_origins:
+                record_variant_origins(dataset.id, documents, origins_store)
+        if counts is not None and collection_name == 'genomicVariations':
+            counts.add(documents)
+
+    with metrics.stage('import'):
+        if response is not None:
+            count = stream_to_mongodb(collection_name, response, batch_size, on_inserted,
+                                      before_insert if state is not None else None)
+        else:
+            count = import_to_mongodb(collection_name, path, batch_size, on_inserted,
+                                      before_insert if state is not None else None)
+        if count is None:
+            return False
+
+    metrics.add('import', datasets=1)
+    if state is not None:
+        # Origins and counts are written while inserting, so the dataset is complete once it is imported
+        state.finish_dataset(dataset.id)
+    return True
+
 def update_variant_counts():
     # Update variant counts in the dataset
     info = db.update_dataset_counts()
     return info
 
-def command_rebuild(args: Namespace):
-    # Rebuild the beacon database based on datasets retrieved from Galaxy
-    global db
-    gi = set_up_galaxy_instance(args.galaxy_url, args.galaxy_key)
-
+def connect_database(args: Namespace):
+    # Connects the global database object to the beacon database given by the command line args
     db.database_user = args.database_user
     db.database_password = args.database_password
     db.database_host = args.database_host
     db.database_port = args.database_port
     db.database_name = args.database_name
     db.database_auth_source = args.database_auth_source
+    return db.connection()
+
+def connect_galaxy(args: Namespace):
+    # Connects to Galaxy with the URL, API key and connection settings given by the command line args
+    return set_up_galaxy_instance(args.galaxy_url, args.galaxy_key, pool_size=args.galaxy_connections,
+                                  timeout=args.galaxy_timeout, retries=args.galaxy_retries, rate=args.galaxy_rate)
+
+def record_galaxy_request(start, end, status, retry):
+    # Records every attempt of a Galaxy request in the metrics, see GalaxyClient.on_request
+    metrics.record('galaxy', start, end)
+    metrics.add('galaxy', requests=int(not retry), retries=int(retry), errors=int(status is None or status >= 500))
+
+def instrument_calls(gi: GalaxyInstance):
+    # Counts the requests to Galaxy and the calls to the beacon database of this run
+    metrics.instrument(gi, 'galaxy', ['make_get_request', 'make_post_request', 'make_put_request', 'make_delete_request'])
+    metrics.instrument(db, 'db', ['clear_database', 'get_variant_indices', 'get_variant_indices_bulk', 'delete_documents',
+                                  'update_dataset_counts', 'persist_dataset_counts'])
+    gi.on_request = record_galaxy_request
+
+def report_metrics(args: Namespace, success: bool):
+    # Prints the run summary and writes the metrics files given by the command line args
+    metrics.finish(success)
+    print(metrics.summary(), file=sys.stderr)
+    if args.metrics_file:
+        metrics.write_json(args.metrics_file)
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+def discover_datasets(gi: GalaxyInstance, workers: int):
+    # Returns all datasets currently shared in beacon histories by their id
+    current = {}
+    with metrics.stage('discovery'):
+        for history_id in iter_beacon_histories(gi, workers):
+            for dataset in get_datasets(gi, history_id, workers):
+                current[dataset.id] = dataset
+    return current
+
+def record_discovery(state: SyncState, items):
+    # Records each (dataset, collection) pair in the manifest as it is discovered
+    for dataset, collection_name in items:
+        state.discover_dataset(dataset, collection_name)
+        yield dataset, collection_name
+
+def remove_datasets(state: SyncState, to_remove: list):
+    # Removes the documents of the given datasets and forgets the datasets
+    # Documents are tagged before they are inserted, so this also cleans up after interrupted imports
+    with metrics.stage('removal'):
+        for dataset_id in to_remove:
+            collection_name = state.collection(dataset_id)
+            for ids in state.orphaned_rows(dataset_id):
+                db.delete_documents(collection_name, [json_util.loads(row) for row in ids])
+                metrics.add('removal', documents=len(ids))
+            state.forget_dataset(dataset_id)
+            metrics.add('removal', datasets=1)
+
+def report_failed_downloads(state: SyncState):
+    # Logs the datasets whose download failed, returns True if all downloads succeeded
+    failed = state.failed_datasets()
+    if failed:
+        logging.critical(f"{len(failed)} datasets could not be downloaded and are missing: {', '.join(failed)}")
+    return not failed
 
-    if not db.connection():
-        return False
-    
-    db.clear_database()
+def command_rebuild(args: Namespace):
+    # Rebuild the beacon database based on datasets retrieved from Galaxy
+    # The progress of each dataset is recorded in the manifest given by args.state_file. With args.resume, an
+    # interrupted rebuild continues from there: complete datasets are kept, documents of interrupted imports are
+    # removed and the remaining datasets are imported
+    global db
+    gi = connect_galaxy(args)
 
+    if not connect_database(args):
+        return False
+    instrument_calls(gi)
+    database = db.client[db.database_name]
+
+    # During a shadow rebuild, the manifest is kept next to the live one until the collections are swapped
+    state_file = staging_path(args.state_file) if args.shadow else args.state_file
+    state = SyncState(state_file)
+
+    resume = args.resume and not state.is_empty()
+    if args.shadow and resume and not prefixed_collections(database, STAGING_PREFIX):
+        logging.warning(f"No {STAGING_PREFIX} collections found")
+        resume = False
+    if args.resume and not resume:
+        logging.warning("Nothing to resume - starting a new rebuild")
+
+    if args.shadow:
+        # Import next to the live collections, which keep answering queries until they are swapped
+        # Staging collections of an interrupted shadow rebuild are dropped first, unless it is resumed
+        if not resume:
+            drop_collections(database, STAGING_PREFIX)
+        db.collection_prefix = STAGING_PREFIX
+    elif not resume:
+        with metrics.stage('clear'):
+            db.clear_database()
+
+    if resume:
+        logging.info(f"Resuming rebuild, datasets by stage: {state.stages()}")
+
+        # Complete datasets are kept unless they changed in the meantime, everything else starts over
+        to_import, to_remove = diff_datasets(discover_datasets(gi, args.discovery_workers), state.datasets())
+        logging.info(f"{len(to_import)} datasets to import, {len(to_remove)} datasets to remove")
+        remove_datasets(state, to_remove)
+        items = dataset_collections(to_import)
+    else:
+        to_remove = []
+        state.clear()
+
+        # Discovery happens while the pipeline consumes the datasets, so its time is measured per dataset
+        datasets = metrics.iterate('discovery', (dataset
+                                                 for history_id in iter_beacon_histories(gi, args.discovery_workers)
+                                                 for dataset in get_datasets(gi, history_id, args.discovery_workers)))
+        items = record_discovery(state, dataset_collections(datasets))
+
+    # During a shadow rebuild, origins are written next to the live file until the collections are swapped
+    origins_file = staging_path(args.origins_file) if args.shadow else args.origins_file
+    origins_store = None
     if args.store_origins:
-        if os.path.exists(args.origins_file):
-            os.remove(args.origins_file)
+        if not resume and os.path.exists(origins_file):
+            os.remove(origins_file)
         try:
-            variant_origins_file = open(args.origins_file, "a")
-        except:
-            print(f"Cannot open origins_file {args.origins_file}")
-            logging.info(f"Cannot open origins_file {args.origins_file}")
+            origins_store = OriginsStore(origins_file, compress=args.compress_origins)
+        except Exception as e:
+            print(f"Cannot open origins_file {origins_file} - {e}")
+            logging.info(f"Cannot open origins_file {origins_file} - {e}")
+            return False
+        if resume:
+            origins_store.remove_datasets(to_remove)
+
+    # Counts of the imports before an interruption are lost, a resumed rebuild counts all documents afterwards
+    counts = DatasetCounts() if args.incremental_counts and not resume else None
+
+    cache = set_up_cache(args) if not args.stream else None
+
+    # Downloads and imports overlap, see run_pipeline
+    # In streaming mode, each import worker downloads its dataset while parsing it
+    completed = run_pipeline(items,
+                             partial(stream_step, gi) if args.stream else partial(download_step, gi, cache=cache,
+                                                                                   state=state),
+                             partial(import_step, origins_store=origins_store, state=state,
+                                     batch_size=args.batch_size, counts=counts, gi=gi if args.stream else None),
+                             download_workers=args.download_workers,
+                             import_workers=args.import_workers,
+                             queue_size=args.queue_size,
+                             release=skip_release if args.stream else partial(release_step, cache))
+
+    if origins_store is not None:
+        origins_store.close()
+
+    completed = report_failed_downloads(state) and completed
+    if not completed:
+        logging.critical("Rebuild is incomplete, run it again with --resume to import the missing datasets")
+        if args.shadow:
             return False
 
-    path_dict = {
-        "analyses": "analyses",
-        "biosamples": "biosamples",
-        "cohorts": "cohorts",
-        "genomicVariations": "genomicVariations",
-        "individuals": "individuals",
-        "runs": "runs"
-    }
-    
-    for history_id in get_beacon_histories(gi):
-        for dataset in get_datasets(gi, history_id):
-            logging.info(f"Next file is {dataset.name}")
-            for key in path_dict:
-                if key in dataset.name:
-                    # Match dataset name to appropriate collection and construct file path
-                    collection_name = path_dict[key]
-                    path = f"/tmp/{collection_name}-{dataset.uuid}"
-                    download_dataset(gi, dataset, path)
-                    if not import_to_mongodb(collection_name, path):
-                        return False
-                    if key == 'genomicVariations' and args.store_origins:
-                        persist_variant_origins(dataset.id, path, variant_origins_file)
+    logging.info("Setting variant counts")
+    with metrics.stage('counts'):
+        if counts is not None:
+            info = db.persist_dataset_counts(counts.counts)
+        else:
+            info = update_variant_counts()
+    logging.info(f"{info}")
+
+    # Indexes are built once after the bulk load instead of being maintained during every insert
+    # Staging collections get the indexes of their live counterparts, so queries are as fast after the swap
+    if args.shadow:
+        logging.info("Copying indexes of the live collections")
+        with metrics.stage('indexes'):
+            for name in prefixed_collections(database, STAGING_PREFIX):
+                created = copy_indexes(database, name, STAGING_PREFIX + name)
+                metrics.add('indexes', indexes=len(created))
+    if args.create_indexes:
+        logging.info("Creating search indexes")
+        with metrics.stage('indexes'):
+            created = create_indexes(database, prefix=db.collection_prefix)
+        metrics.add('indexes', indexes=len(created))
+        logging.info(f"Created {len(created)} indexes")
+
+    if args.shadow:
+        logging.info("Swapping staging and live collections")
+        with metrics.stage('swap'):
+            swapped = swap_collections(database, keep_previous=not args.drop_previous, skip=[GENERATION_COLLECTION])
+        db.collection_prefix = ''
+        metrics.add('swap', collections=len(swapped))
+        publish_file(args.origins_file, keep_previous=not args.drop_previous)
+        state.close()
+        publish_file(args.state_file, keep_previous=not args.drop_previous)
+
+    # Invalidate results cached by beacon2-search.py
+    bump_generation(database)
+    return completed
+
+def command_sync(args: Namespace):
+    # Synchronize the beacon database with the datasets retrieved from Galaxy
+    # Only new or changed datasets are imported, documents of deleted, unshared or changed datasets are removed.
+    # Which document stems from which dataset is kept in the local manifest given by args.state_file
+    global db
+    gi = connect_galaxy(args)
+
+    if not connect_database(args):
+        return False
+    instrument_calls(gi)
+
+    state = SyncState(args.state_file)
+
+    # Without a manifest there is no way to tell which documents stem from which dataset
+    if state.is_empty():
+        logging.info("No sync state found - starting from an empty database")
+        db.clear_database()
+        if args.store_origins and os.path.exists(args.origins_file):
+            os.remove(args.origins_file)
+
+    # Compare datasets in Galaxy with the ones imported so far
+    current = discover_datasets(gi, args.discovery_workers)
+
+    to_import, to_remove = diff_datasets(current, state.datasets())
+    logging.info(f"{len(to_import)} datasets to import, {len(to_remove)} datasets to remove")
+
+    # Remove documents of deleted, unshared, changed and incompletely imported datasets
+    remove_datasets(state, to_remove)
+
+    origins_store = None
+    if args.store_origins:
+        try:
+            origins_store = OriginsStore(args.origins_file, compress=args.compress_origins)
+        except Exception as e:
+            print(f"Cannot open origins_file {args.origins_file} - {e}")
+            logging.info(f"Cannot open origins_file {args.origins_file} - {e}")
+            return False
+        origins_store.remove_datasets(to_remove)
+
+    # Import new and changed datasets, tagging the imported documents with their dataset
+    cache = set_up_cache(args) if not args.stream else None
+    completed = run_pipeline(dataset_collections(to_import),
+                             partial(stream_step, gi) if args.stream else partial(download_step, gi, cache=cache,
+                                                                                   state=state),
+                             partial(import_step, origins_store=origins_store, state=state,
+                                     batch_size=args.batch_size, gi=gi if args.stream else None),
+                             download_workers=args.download_workers,
+                             import_workers=args.import_workers,
+                             queue_size=args.queue_size,
+                             release=skip_release if args.stream else partial(release_step, cache))
+
+    if origins_store is not None:
+        origins_store.close()
 
     logging.info("Setting variant counts")
-    info = update_variant_counts()
+    with metrics.stage('counts'):
+        info = update_variant_counts()
     logging.info(f"{info}")
 
+    # Invalidate results cached by beacon2-search.py
+    bump_generation(db.client[db.database_name])
+    return report_failed_downloads(state) and completed
+
+def command_rollback(args: Namespace):
+    # Restore the collections replaced by the last shadow rebuild, the replacing ones are kept as previous copy
+    if not connect_database(args):
+        return False
+    database = db.client[db.database_name]
+
+    # The origins and the manifest are published after the swap, so a swap that stopped halfway did not replace them
+    interrupted = swap_interrupted(database)
+    try:
+        restored = rollback_collections(database, skip=[GENERATION_COLLECTION])
+    except RuntimeError as e:
+        print(f"Cannot roll back - {e}")
+        logging.critical(f"Cannot roll back - {e}")
+        return False
+    logging.info(f"Restored {len(restored)} collections")
+    if interrupted:
+        logging.warning("The last swap did not finish, the origins and the manifest are kept")
+    else:
+        rollback_file(args.origins_file)
+
+        # The manifest is swapped along with the collections, without a previous one the next sync starts over
+        if os.path.exists(previous_path(args.state_file)):
+            rollback_file(args.state_file)
+        else:
+            SyncState(args.state_file).clear()
+
+    # Invalidate results cached by beacon2-search.py
+    bump_generation(database)
+
+def command_origins(args: Namespace):
+    # Print the origins of the documents given by command line args, in the format of the old plain text origins file
+    # Without ids, the variants of args.dataset or the number of variants of each dataset are printed
+    if not os.path.exists(args.origins_file):
+        print(f"No variant origins at {args.origins_file}, they are stored by rebuild and sync with -s")
+        return False
+
+    store = OriginsStore(args.origins_file)
+    if args.ids:
+        # Ids that look like an ObjectId may still belong to documents imported with a string _id
+        keys = []
+        for data_id in args.ids:
+            if ObjectId.is_valid(data_id):
+                keys.append(origin_id(ObjectId(data_id)))
+            keys.append(data_id)
+        origins = store.lookup(keys)
+        for key in keys:
+            for dataset_id, details in origins.get(key, []):
+                print(format_origin(document_id(key), dataset_id, details))
+    elif args.dataset:
+        for key, details in store.dataset_variants(args.dataset):
+            print(format_origin(document_id(key), args.dataset, details))
+    else:
+        for dataset_id, count in sorted(store.dataset_counts().items()):
+            print(f"{dataset_id} {count} variants")
+    store.close()
+
 def main():
     # Main function to run sub commands based on the given command line arguments
+    global metrics
     args = parse_arguments()
 
     logging.basicConfig(level=args.loglevel)
 
-    if args.command == "rebuild":
-        command_rebuild(args)
+    if args.command == "rollback":
+        if command_rollback(args) is False:
+            sys.exit(1)
+        return
+
+    if args.command == "origins":
+        if command_origins(args) is False:
+            sys.exit(1)
+        return
+
+    # The run summary and metrics files are written even if the command fails
+    metrics = RunMetrics(args.command, "beacon2")
+    success = False
+    try:
+        if args.command == "rebuild":
+            success = command_rebuild(args) is not False
+
+        if args.command == "sync":
+            success = command_sync(args) is not False
+    finally:
+        report_metrics(args, success)
+    if not success:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,26 @@
-from pymongo import MongoClient
 import argparse
+import csv
+import io
+import json
 import pprint
+import shutil
 import sys
 import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from indexes import SEARCH_INDEXES, create_indexes, drop_indexes, list_indexes
+from query_cache import QueryCache, read_generation
+# pymongo and bson are imported where they are used, a client forwarding its query to a server (--server) never needs them
+
+# Arguments of the connection to MongoDB, they can not be set by queries of a batch file or a server request
+CONNECTION_KEYS = ["database_host", "database_port", "advance", "database_auth_source", "database_user", "database_password"]
+
+# Arguments of the query result cache, a server uses its own cache
+CACHE_KEYS = ["cache", "cache_ttl", "cache_entries", "cache_dir", "cache_disk_size", "cache_max_results"]
 
 def common_arguments(parser):
     connection_group = parser.add_argument_group("Connection to MongoDB")
@@ -19,66 +37,551 @@ def common_arguments(parser):
     database_group.add_argument("-d", "--database", type=str, default="", dest="database", help="The targeted beacon database")
     database_group.add_argument("-c", "--collection", type=str, default="", dest="collection", help="The targeted beacon collection from the desired database")
 
-def connect_to_mongodb(args):
+def output_arguments(parser):
+    output_group = parser.add_argument_group("Output")
+    output_group.add_argument("--format", choices=["pprint", "jsonl", "csv"], default="pprint", dest="format", help="pprint for reading, JSON Lines or CSV for other tools (written as results arrive)")
+    output_group.add_argument("--fields", type=str, default="", dest="fields", help="comma separated fields to return, e.g. id,variation.alternateBases (default: whole documents)")
+    output_group.add_argument("--limit", type=int, default=0, dest="limit", help="maximum number of results (default: no limit)")
+    output_group.add_argument("--skip", type=int, default=0, dest="skip", help="number of results to skip")
+    output_group.add_argument("--after", type=str, default="", dest="after", help="only return results after this _id, as printed at the end of the previous page")
+    output_group.add_argument("--batch-size", type=int, default=0, dest="batch_size", help="number of documents fetched from MongoDB per round trip (default: MongoDB's choice)")
+    granularity_arguments(output_group)
+
+def cache_arguments(parser):
+    cache_group = parser.add_argument_group("Query result cache")
+    cache_group.add_argument("--cache", action="store_true", default=False, dest="cache", help="cache query results until they expire or beacon2-import.py changes the database")
+    cache_group.add_argument("--cache-ttl", type=float, default=300, dest="cache_ttl", help="seconds until a cached result expires")
+    cache_group.add_argument("--cache-entries", type=int, default=1000, dest="cache_entries", help="number of results cached in memory")
+    cache_group.add_argument("--cache-dir", type=str, default="", dest="cache_dir", help="also cache results in this directory, e.g. to share them between runs")
+    cache_group.add_argument("--cache-disk-size", type=int, default=1 << 30, dest="cache_disk_size", help="bytes the cache directory is trimmed to")
+    cache_group.add_argument("--cache-max-results", type=int, default=10000, dest="cache_max_results", help="results with more documents are not cached")
+
+def set_up_cache(args):
+    # Returns the query result cache given by the arguments or None if caching is disabled
+    if not args.cache:
+        return None
+    return QueryCache(args.cache_entries, args.cache_ttl, args.cache_dir, args.cache_disk_size, args.cache_max_results)
+
+def cached_results(cache, database, collection_name, query, args):
+    # Like query_results, but answers repeated queries from the cache
+    # Results are streamed while they are collected for the cache, larger results than the cache takes are not kept
+    if cache is None:
+        yield from query_results(database[collection_name], query, args)
+        return
+
+    generation = cache.generation(database.name, lambda: read_generation(database))
+    key = cache.key(database.name, collection_name, generation, query,
+                    [getattr(args, name) for name in ["fields", "limit", "skip", "after", "granularity", "facet"]])
+    result = cache.get(key)
+    if result is not None:
+        yield from result
+        return
+
+    collected = []
+    for document in query_results(database[collection_name], query, args):
+        if collected is not None:
+            collected.append(document)
+            if len(collected) > cache.max_results:
+                collected = None
+        yield document
+    if collected is not None:
+        cache.put(key, collected)
+
+def granularity_arguments(group):
+    group.add_argument("--granularity", choices=["boolean", "count", "record"], default="record", dest="granularity", help="whether any document matches (boolean), how many match (count) or the matching documents (record)")
+    group.add_argument("--facet", type=str, action="append", default=[], dest="facet", help="count matching documents per value of this field instead of returning them, can be repeated")
+
+def parse_id(value):
+    # Document ids are ObjectIds unless the importer set them explicitly
+    from bson import ObjectId
+    return ObjectId(value) if ObjectId.is_valid(value) else value
+
+def find_documents(collection, query, args):
+    # Returns a cursor over the matching documents, limited, paginated and projected as given by the output arguments
+    # Paging (--skip/--after) sorts by _id, so consecutive pages neither repeat nor miss documents
+    fields = [field for field in args.fields.split(",") if field]
+    if args.after:
+        query = {"$and": [query, {"_id": {"$gt": parse_id(args.after)}}]} if query else {"_id": {"$gt": parse_id(args.after)}}
+    cursor = collection.find(query, {field: 1 for field in fields} if fields else None)
+    if args.after or args.skip:
+        cursor = cursor.sort("_id", 1)
+    if args.skip:
+        cursor = cursor.skip(args.skip)
+    if args.limit:
+        cursor = cursor.limit(args.limit)
+    if args.batch_size:
+        cursor = cursor.batch_size(args.batch_size)
+    return cursor
+
+def facet_pipeline(query, field, args):
+    # Aggregation counting the documents matching a query per value of a field, most frequent values first
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1, "_id": 1}},
+    ]
+    if args.limit:
+        pipeline.append({"$limit": args.limit})
+    return pipeline
+
+def query_results(collection, query, args):
+    # Runs a query in MongoDB at the granularity given by the arguments and returns an iterable of result documents
+    # Only records return documents of the collection, the other granularities return a single summary
+    # and facets return one document per field value, so their cost does not depend on the number of matches
+    if args.facet:
+        return ({"facet": field, "value": row["_id"], "count": row["count"]}
+                for field in args.facet
+                for row in collection.aggregate(facet_pipeline(query, field, args)))
+    if args.granularity == "boolean":
+        return [{"exists": collection.find_one(query, {"_id": 1}) is not None}]
+    if args.granularity == "count":
+        options = {key: getattr(args, key) for key in ["skip", "limit"] if getattr(args, key)}
+        return [{"count": collection.count_documents(query, **options)}]
+    return find_documents(collection, query, args)
+
+def field_value(document, field):
+    # Resolves a dotted field in a document, None if it is missing
+    value = document
+    for key in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def write_documents(documents, args, out=sys.stdout, query_id=None):
+    # Writes documents one by one in the format given by args.format, returns the number of documents and the last _id
+    # JSON lines of a batch query are tagged with its query_id
+    from bson import json_util
+    fields = [field for field in args.fields.split(",") if field]
+    count = 0
+    last_id = None
+    writer = None
+    for document in documents:
+        if args.format == "jsonl" and query_id is not None:
+            out.write(json_util.dumps({"query_id": query_id, "document": document}) + "\n")
+        elif args.format == "jsonl":
+            out.write(json_util.dumps(document) + "\n")
+        elif args.format == "csv":
+            if writer is None:
+                writer = csv.writer(out)
+                fields = fields or list(document.keys())
+                writer.writerow(fields)
+            row = []
+            for field in fields:
+                value = field_value(document, field)
+                # Nested values are written as JSON
+                row.append(json_util.dumps(value) if isinstance(value, (dict, list)) else "" if value is None else str(value))
+            writer.writerow(row)
+        else:
+            pprint.pprint(document, stream=out)
+        count += 1
+        last_id = document.get("_id")
+    out.flush()
+    return count, last_id
+
+def connect_to_mongodb(args, max_pool_size=100):
+    # Raises a ValueError if the advanced connection lacks a credential, see check_required
+    from pymongo import MongoClient
     if args.advance:
-        advanced_required_args = ['database_auth_source', 'database_user', 'database_password']
-        if any(getattr(args, arg) == "" for arg in advanced_required_args):
-            for arg in advanced_required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    logging.info(f"Missing value -> {arg}")
-            parser.print_help()
-            sys.exit(1)
-        client = MongoClient(f"mongodb://{args.database_user}:{args.database_password}@{args.database_host}:{args.database_port}/{args.database}?authSource={args.database_auth_source}")
+        check_required(args, ['database_auth_source', 'database_user', 'database_password'])
+        client = MongoClient(f"mongodb://{args.database_user}:{args.database_password}@{args.database_host}:{args.database_port}/{args.database}?authSource={args.database_auth_source}", maxPoolSize=max_pool_size)
     else:
-        client = MongoClient(args.database_host, args.database_port)
+        client = MongoClient(args.database_host, args.database_port, maxPoolSize=max_pool_size)
     return client
 
-def beacon_query():
-    
-    """
-    Beacon Query Tool
-    
-    This script provides a command-line interface for querying different collections in a Beacon Database using various sub-commands for sequence, range, gene ID, or bracket criteria.
-    
-    Example Usage:
-    
-    1. Query genomicVariations collection by sequence:
-        beacon_search sequence -d database_name -c collection_name -rn reference_name -s start -ab alternate_bases
-    
-    2. Query genomicVariations collection by range:
-        beacon_search range -d database_name -c collection_name -rn reference_name -s start -e end -v variant_type
-    
-    3. Query genomicVariations collection by gene ID:
-        beacon_search gene -d database_name -c collection_name -g gene_id -vmin variant_min_length -vmax variant_max_length
-    
-    4. Query genomicVariations collection by bracket:
-        beacon_search bracket -d database_name -c collection_name -rn reference_name -smin start_minimum -smax start_maximum -emin end_minimum -emax end_maximum -v variant_type
-    
-    5. Query analyses collection:
-        beacon_search analyses -d database_name -c collection_name -al aligner -ad analysis_date -bi biosample_id -id identification -ii individual_id -pn pipeline_name -pr pipeline_ref -ri run_id -vc variant_caller
-    
-    6. Query biosamples collection:
-        beacon_search biosamples -d database_name -c collection_name -bs biosample_status -cd collection_date -cm collection_moment -id identification -op obtention_procedure -so sample_origin_type
-    
-    7. Query cohorts collection:
-        beacon_search cohorts -d database_name -c collection_name -ct cohort_data_types -cd cohort_design -cz cohort_size -t cohort_type -id identification -g genders -n name
-    
-    8. Query datasets collection:
-        beacon_search datasets -d database_name -c collection_name -o ontology -om ontology_modifiers -id identification -n name
+def manage_indexes(args):
+    # Creates, lists or drops the indexes used by the query sub-commands
+    client = connect_to_mongodb(args)
+    db = client[args.database]
+    if args.action == "create":
+        for name in create_indexes(db, args.query_types, args.collection):
+            print(f"created {name}")
+    elif args.action == "drop":
+        for name in drop_indexes(db, args.query_types, args.collection):
+            print(f"dropped {name}")
+    else:
+        for collection_name, name, keys in list_indexes(db):
+            print(f"{collection_name}.{name}: {', '.join(keys)}")
+
+def check_required(args, required_args):
+    # Raises a ValueError naming the first required argument without a value
+    for arg in required_args:
+        if not getattr(args, arg):
+            raise ValueError(f"Missing value -> {arg}. Use -h or --help for usage details.")
+
+def build_query(args):
+    # Builds the MongoDB query of a query sub-command from its arguments
+    # Raises a ValueError if a required argument is missing
+    if args.command == "sequence":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port','alternateBases','referenceBases'])
+        
+        query = {
+            "variation.location.sequence_id": args.referenceName,
+            "variation.location.interval.start.value": args.start,
+            "variation.alternateBases": args.alternateBases,
+            "variation.referenceBases": args.referenceBases,
+            "caseLevelData.biosampleId": {"$in": args.collectionIds} if args.collectionIds else None
+        }
+
+        # Debugging statement to verify the constructed query
+        # Logged instead of printed to keep machine-readable output clean
+        logging.debug(f"Constructed query: {query}")
+
+    elif args.command == "range":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port','start','end'])
+        
+        
+        query = {
+            "variation.location.sequence_id": args.referenceName,
+            "variation.location.interval.start.value": args.start,
+            "variation.location.interval.end.value": args.end,
+            "variation.variantType": args.variantType,
+            "variation.alternateBases": args.alternateBases,
+            "molecularAttributes.aminoacidChanges": args.aminoacidChange,
+            "variation.location.interval.start.value": {"$gte": args.variantMinLength} if args.variantMinLength is not None else None,
+            "variation.location.interval.end.value": {"$lte": args.variantMaxLength} if args.variantMaxLength is not None else None
+        }
+
+
+    # query gene_id_queries
+    elif args.command == "gene":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port','geneId'])
+        query = {
+            "molecularAttributes.geneIds": args.geneId,
+            "variation.variantType": args.variantType,
+            "variation.alternateBases": args.alternateBases,
+            "molecularAttributes.aminoacidChanges": args.aminoacidChange,
+            "variation.location.interval.start.value": {"$gte": args.variantMinLength} if args.variantMinLength is not None else None,
+            "variation.location.interval.end.value": {"$lte": args.variantMaxLength} if args.variantMaxLength is not None else None
+        }
+
+
+    # query bracket_queries
+    elif args.command == "bracket":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port','start_minimum','start_maximum','end_minimum','end_maximum'])
+        
+        query = {
+            "variation.location.sequence_id": args.referenceName,
+            "variation.location.interval.start.value": {"$gte": args.start_minimum, "$lte": args.start_maximum} if args.start_minimum is not None and args.start_maximum is not None else None,
+            "variation.location.interval.end.value": {"$gte": args.end_minimum, "$lte": args.end_maximum} if args.end_minimum is not None and args.end_maximum is not None else None,
+            "variation.variantType": args.variantType
+        }
+    # query analyses collection
+    elif args.command == "analyses":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+        
+        query = {
+            "aligner": args.aligner,
+            "analysisDate": args.analysisDate,
+            "biosampleId": args.biosampleId,
+            "id": args.identification,
+            "individualId": args.individualId,
+            "pipelineName": args.pipelineName,
+            "pipelineRef": args.pipelineRef,
+            "runId": args.runId,
+            "variantCaller": args.variantCaller
+        }
+        
+        
+    # query biosample collection
+    elif args.command == "biosamples":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+        
+        query = {
+            "biosampleStatus.label": args.biosampleStatus,
+            "collectionDate": args.collectionDate,
+            "collectionMoment": args.collectionMoment,
+            "id": args.identification,
+            "obtentionProcedure.procedureCode.label": args.obtentionProcedure,
+            "sampleOriginType.label": args.sampleOriginType,
+            "histologicalDiagnosis.label": args.histologicalDiagnosis,
+            "pathologicalStage.label": args.pathologicalStage,
+            "pathologicalTnmFinding.label": args.pathologicalTnmFinding,
+            "phenotypicFeatures.featureType.label": args.featureType,
+            "phenotypicFeatures.severity.label": args.severity,
+            "sampleOriginDetail.label": args.sampleOriginDetail,
+            "sampleProcessing.label": args.sampleProcessing,
+            "sampleStorage.label": args.sampleStorage,
+            "tumorGrade.label": args.tumorGrade,
+            "tumorProgression.label": args.tumorProgression
+        }
+
+    # query cohorts collection
+    elif args.command == "cohorts":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+
+        query = {
+            "cohortDataTypes.label": args.cohortDataTypes,
+            "cohortDesign.label": args.cohortDesign,
+            "cohortSize": args.cohortSize,
+            "cohortType": args.cohortType,
+            "id": args.identification,
+            "inclusionCriteria.genders.label": args.genders,
+            "name": args.name
+        }
+
+    # query datasets collection
+    elif args.command == "datasets":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+
+        query = {
+            "dataUseConditions.duoDataUse.label": args.dataUseConditions,
+            "dataUseConditions.duoDataUse.modifiers.label": args.ontologyModifiers,
+            "id": args.identification,
+            "name": args.name
+        }
+
+    # query individuals collection
+    elif args.command == "individuals":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+
+        query = {
+            "diseases.ageOfOnset.ageGroup.label": args.ageGroup,
+            "diseases.diseaseCode.label": args.diseaseCode,
+            "diseases.familyHistory": args.familyHistory,
+            "diseases.severity": args.severity,
+            "diseases.stage": args.stage,
+            "ethnicity.label": args.ethnicity,
+            "geographicOrigin.label": args.geographicOrigin,
+            "id": args.identification,
+            "measures.assayCode.label": args.assayCode,
+            "sex.label": args.sex
+        }
     
-    9. Query individuals collection:
-        beacon_search individuals -d database_name -c collection_name -g age_group -do disease_ontology -f family_history -se severity -st stage -e ethnicity -go geographic_origin -id identification -as assay_code -s sex
     
-    10. Query runs collection:
-        beacon_search runs -d database_name -c collection_name -id identification -ii individual_id -ll library_layout -ls library_selection -s library_source -st library_strategy -p platform -pm platform_model -r run_date
+    # query individuals collection
+    elif args.command == "runs":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+        
+        query = {
+            "id": args.identification,
+            "individualId": args.individualId,
+            "libraryLayout": args.libraryLayout,
+            "librarySelection": args.librarySelection,
+            "librarySource.label": args.librarySource,
+            "libraryStrategy": args.libraryStrategy,
+            "platform": args.platform,
+            "platformModel.label": args.platformModel,
+            "runDate": args.runDate
+        }
     
-    11. Query for cnv:
+    # query individuals collection
+    elif args.command == "cnv":
+        check_required(args, ['database', 'collection', 'database_host', 'database_port'])
+        
+        query = {
+            "variantInternalId": args.variantInternalId,
+            "analysisId": args.analysisId,
+            "individualId": args.individualId,
+            "definitions.Location.start": args.start,
+            "definitions.Location.end": args.end,
+            "definitions.Location.chromosome": args.chromosome,
+            "variantState.id": args.variantStateId,
+            "variantState.label": args.variantState,
+            "definitions.Location.sequenceId": args.sequenceId
+        }
 
-        beacon_search cnv  -d database_name -c collection_name -id identification -ii individual_id
-    """
-    
+    return query
+
+def filter_query(query):
+    # Create a new dictionary with non-empty and non-default values
+    return {key: value for key, value in query.items() if value}
+
+class LockedOutput:
+    # Serializes writes of concurrent queries, each JSON line is written at once
+    def __init__(self, out):
+        self.out = out
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.out.write(text)
+
+    def flush(self):
+        with self.lock:
+            self.out.flush()
+
+def read_batch(batch_file, input_format):
+    # Yields the queries of a batch file as dictionaries, one query per JSON line or TSV row
+    # Each query has a "type" (sequence, range, gene, ...) and optionally an "id", the other keys are argument names
+    # of the query type (e.g. referenceBases, start, collection)
+    with open(batch_file) as lines:
+        if input_format == "tsv":
+            header = None
+            for line in lines:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                values = line.rstrip("\n").split("\t")
+                if header is None:
+                    header = values
+                    continue
+                yield {key: value for key, value in zip(header, values) if value != ""}
+        else:
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+
+def query_namespace(parsers, defaults, fields, shared):
+    # Turns a query of a batch file or server request into the arguments of its query sub-command
+    # shared holds values for all queries (connection, database, ...), the query's own fields take precedence
+    query_type = fields.pop("type", "")
+    if query_type not in defaults:
+        raise ValueError(f"Unknown query type \"{query_type}\"")
+    args = argparse.Namespace(**defaults[query_type])
+    args.command = query_type
+    for key, value in shared.items():
+        setattr(args, key, value)
+
+    # Values read from TSV are strings, convert them like argparse would
+    types = {action.dest: action.type for action in parsers[query_type]._actions}
+    for key, value in fields.items():
+        if key not in types or key in CONNECTION_KEYS + CACHE_KEYS:
+            raise ValueError(f"Unknown argument \"{key}\" for query type {query_type}")
+        if isinstance(value, str) and types[key] is not None:
+            value = types[key](value)
+        if key == "facet" and isinstance(value, str):
+            value = value.split(",")
+        setattr(args, key, value)
+    return args
+
+def query_defaults(parsers):
+    # Default arguments of each query sub-command
+    return {name: vars(parsers[name].parse_args([])) for name in parsers if name not in ("indexes", "batch", "serve")}
+
+def run_batch(args, parsers):
+    # Runs all queries of a batch file over one connection pool, writing JSON lines tagged with the query id
+    defaults = query_defaults(parsers)
+    # Connection, database and output arguments are shared by all queries of the batch
+    shared = {key: getattr(args, key) for key in CONNECTION_KEYS + ["database", "collection", "fields", "limit", "skip",
+                                                                    "batch_size", "granularity", "facet"]}
+    shared.update({"format": "jsonl", "after": ""})
+    input_format = args.input_format or ("tsv" if args.batch_file.endswith((".tsv", ".txt")) else "jsonl")
+
+    client = connect_to_mongodb(args, max_pool_size=args.concurrency)
+    db = client[args.database]
+    cache = set_up_cache(args)
+    out = LockedOutput(sys.stdout)
+    stats = {"queries": 0, "documents": 0, "errors": 0}
+    stats_lock = threading.Lock()
+
+    # Queries are read lazily, at most concurrency * 2 of them are waiting at the same time
+    slots = threading.BoundedSemaphore(args.concurrency * 2)
+
+    def run(query_id, fields):
+        try:
+            query_args = query_namespace(parsers, defaults, fields, shared)
+            query = filter_query(build_query(query_args))
+            results = cached_results(cache, client[query_args.database], query_args.collection, query, query_args)
+            count, _ = write_documents(results, query_args, out, query_id=query_id)
+            with stats_lock:
+                stats["queries"] += 1
+                stats["documents"] += count
+        except Exception as e:
+            out.write(json.dumps({"query_id": query_id, "error": str(e)}) + "\n")
+            with stats_lock:
+                stats["errors"] += 1
+        finally:
+            slots.release()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for number, fields in enumerate(read_batch(args.batch_file, input_format), 1):
+            slots.acquire()
+            executor.submit(run, str(fields.pop("id", number)), fields)
+    elapsed = time.monotonic() - started
+    out.flush()
+
+    print(f"{stats['queries']} queries ({stats['errors']} failed) returned {stats['documents']} documents "
+          f"in {elapsed:.2f}s - {stats['queries'] / elapsed if elapsed else 0:.1f} queries/s", file=sys.stderr)
+    if cache is not None:
+        print(f"query cache: {cache.hits} hits, {cache.misses} misses", file=sys.stderr)
+
+def serve(args, parsers):
+    # Answers queries sent as JSON (like the lines of a batch file) to POST /query over one pooled connection
+    # The results are streamed back in the requested format, exactly as the query sub-command would print them
+    defaults = query_defaults(parsers)
+    shared = {key: getattr(args, key) for key in CONNECTION_KEYS + ["database", "collection"]}
+    client = connect_to_mongodb(args, max_pool_size=args.concurrency)
+    cache = set_up_cache(args)
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {"status": "ok"})
+            else:
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/query":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                fields = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                query_args = query_namespace(parsers, defaults, fields, shared)
+                query = filter_query(build_query(query_args))
+            except (ValueError, TypeError, AttributeError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson" if query_args.format == "jsonl" else "text/plain")
+            self.end_headers()
+            # Without a Content-Length the response ends when the connection is closed, so results are streamed
+            out = io.TextIOWrapper(self.wfile, encoding="utf-8")
+            try:
+                write_documents(cached_results(cache, client[query_args.database], query_args.collection, query, query_args), query_args, out)
+            except Exception as e:
+                logging.error(f"Query failed: {e}")
+            finally:
+                out.flush()
+                out.detach()
+
+        def log_message(self, format, *log_args):
+            logging.info(f"{self.address_string()} {format % log_args}")
+
+    host, _, port = args.listen.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), QueryHandler)
+    server.daemon_threads = True
+    print(f"Serving queries on http://{host or '127.0.0.1'}:{port}/query", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        client.close()
+
+def forward_query(args, parsers):
+    # Sends a query to a server started with "serve" and copies its results to stdout
+    # Only arguments differing from the defaults are sent, database and collection default to the server's
+    defaults = query_defaults(parsers)[args.command]
+    fields = {key: value for key, value in vars(args).items()
+              if key not in CONNECTION_KEYS + CACHE_KEYS + ["command", "server"] and value != defaults.get(key)}
+    fields["type"] = args.command
+    request = urllib.request.Request(args.server.rstrip("/") + "/query", data=json.dumps(fields).encode(),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            shutil.copyfileobj(response, sys.stdout.buffer)
+    except urllib.error.HTTPError as e:
+        print(json.loads(e.read()).get("error", e.reason))
+        sys.exit(1)
+    except urllib.error.URLError as e:
+        print(f"Cannot reach query server {args.server} - {e.reason}")
+        sys.exit(1)
+
+def build_parser():
+    # Builds the argument parser of all sub-commands, returns the parser and the sub-parsers by command
     parser = argparse.ArgumentParser(description="Query Beacon Database")
+    parser.add_argument("--server", type=str, default="", dest="server", help="send the query to a server started with the serve sub-command, e.g. http://127.0.0.1:8765")
     subparsers = parser.add_subparsers(dest="command")
     parsers = {}
     # subparsers.required = True
@@ -291,264 +794,165 @@ def beacon_query():
     optional_query_group.add_argument("-vs", "--variantState", type=str, default="", dest="variantState", help="Variant State")
     optional_query_group.add_argument("-sd", "--sequenceId", type=str, default="", dest="sequenceId", help="Sequence Id")
     
-    args = parser.parse_args()
-    # Check if a sub-command has been provided
-    if args.command is None:
-        print("Please provide a valid sub-command. Use -h or --help for usage details.")
-        parser.print_help()
-        sys.exit(1)  # exit with an error code
-    
-    # query sequence_queries
-    if args.command == "sequence":
-        required_args = ['database', 'collection', 'database_host', 'database_port','alternateBases','referenceBases']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "variation.location.sequence_id": args.referenceName,
-            "variation.location.interval.start.value": args.start,
-            "variation.alternateBases": args.alternateBases,
-            "variation.referenceBases": args.referenceBases,
-            "caseLevelData.biosampleId": {"$in": args.collectionIds} if args.collectionIds else None
-        }
+    # Output and cache arguments of all query sub-commands
+    for query_parser in parsers.values():
+        output_arguments(query_parser)
+        cache_arguments(query_parser)
 
-        # Debugging print statement to verify the constructed query
-        print("Constructed query:", query)
+    # Sub-parser for command "indexes"
+    parser_indexes = subparsers.add_parser("indexes", help="Create, list or drop the indexes used by the query sub-commands")
+    common_arguments(parser_indexes)
+    parsers["indexes"] = parser_indexes
+    parser_indexes.add_argument("action", choices=["create", "list", "drop"], help="What to do with the indexes")
+    parser_indexes.add_argument("-q", "--query-types", nargs="+", choices=list(SEARCH_INDEXES), default=None, dest="query_types", help="Only create or drop the indexes of these query types (default: all)")
 
-    elif args.command == "range":
-        required_args = ['database', 'collection', 'database_host', 'database_port','start','end']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        
-        query = {
-            "variation.location.sequence_id": args.referenceName,
-            "variation.location.interval.start.value": args.start,
-            "variation.location.interval.end.value": args.end,
-            "variation.variantType": args.variantType,
-            "variation.alternateBases": args.alternateBases,
-            "molecularAttributes.aminoacidChanges": args.aminoacidChange,
-            "variation.location.interval.start.value": {"$gte": args.variantMinLength} if args.variantMinLength is not None else None,
-            "variation.location.interval.end.value": {"$lte": args.variantMaxLength} if args.variantMaxLength is not None else None
-        }
+    # Sub-parser for command "batch"
+    parser_batch = subparsers.add_parser("batch", help="Run many queries of any type from a JSONL or TSV file over one connection")
+    common_arguments(parser_batch)
+    parsers["batch"] = parser_batch
+    parser_batch.add_argument("batch_file", help="JSONL or TSV file with one query per line, each with a \"type\" (sequence, range, ...), an optional \"id\" and the arguments of that type")
+    parser_batch.add_argument("--input-format", choices=["jsonl", "tsv"], default="", dest="input_format", help="format of the batch file (default: by file extension)")
+    parser_batch.add_argument("--concurrency", type=int, default=8, dest="concurrency", help="number of queries running at the same time")
+    batch_output_group = parser_batch.add_argument_group("Output (JSON lines tagged with the query id)")
+    batch_output_group.add_argument("--fields", type=str, default="", dest="fields", help="comma separated fields to return (default: whole documents)")
+    batch_output_group.add_argument("--limit", type=int, default=0, dest="limit", help="maximum number of results per query (default: no limit)")
+    batch_output_group.add_argument("--skip", type=int, default=0, dest="skip", help="number of results to skip per query")
+    batch_output_group.add_argument("--batch-size", type=int, default=0, dest="batch_size", help="number of documents fetched from MongoDB per round trip")
+    granularity_arguments(batch_output_group)
+    cache_arguments(parser_batch)
 
+    # Sub-parser for command "serve"
+    parser_serve = subparsers.add_parser("serve", help="Answer queries over HTTP/JSON with one pooled connection, see --server")
+    common_arguments(parser_serve)
+    parsers["serve"] = parser_serve
+    parser_serve.add_argument("--listen", type=str, default="127.0.0.1:8765", dest="listen", help="address and port to listen on")
+    parser_serve.add_argument("--concurrency", type=int, default=16, dest="concurrency", help="maximal number of MongoDB connections")
+    cache_arguments(parser_serve)
 
-    # query gene_id_queries
-    elif args.command == "gene":
-        required_args = ['database', 'collection', 'database_host', 'database_port','geneId']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        query = {
-            "molecularAttributes.geneIds": args.geneId,
-            "variation.variantType": args.variantType,
-            "variation.alternateBases": args.alternateBases,
-            "molecularAttributes.aminoacidChanges": args.aminoacidChange,
-            "variation.location.interval.start.value": {"$gte": args.variantMinLength} if args.variantMinLength is not None else None,
-            "variation.location.interval.end.value": {"$lte": args.variantMaxLength} if args.variantMaxLength is not None else None
-        }
+    return parser, parsers
 
+def beacon_query():
+    
+    """
+    Beacon Query Tool
+    
+    This script provides a command-line interface for querying different collections in a Beacon Database using various sub-commands for sequence, range, gene ID, or bracket criteria.
+    
+    Example Usage:
+    
+    1. Query genomicVariations collection by sequence:
+        beacon_search sequence -d database_name -c collection_name -rn reference_name -s start -ab alternate_bases
+    
+    2. Query genomicVariations collection by range:
+        beacon_search range -d database_name -c collection_name -rn reference_name -s start -e end -v variant_type
+    
+    3. Query genomicVariations collection by gene ID:
+        beacon_search gene -d database_name -c collection_name -g gene_id -vmin variant_min_length -vmax variant_max_length
+    
+    4. Query genomicVariations collection by bracket:
+        beacon_search bracket -d database_name -c collection_name -rn reference_name -smin start_minimum -smax start_maximum -emin end_minimum -emax end_maximum -v variant_type
+    
+    5. Query analyses collection:
+        beacon_search analyses -d database_name -c collection_name -al aligner -ad analysis_date -bi biosample_id -id identification -ii individual_id -pn pipeline_name -pr pipeline_ref -ri run_id -vc variant_caller
+    
+    6. Query biosamples collection:
+        beacon_search biosamples -d database_name -c collection_name -bs biosample_status -cd collection_date -cm collection_moment -id identification -op obtention_procedure -so sample_origin_type
+    
+    7. Query cohorts collection:
+        beacon_search cohorts -d database_name -c collection_name -ct cohort_data_types -cd cohort_design -cz cohort_size -t cohort_type -id identification -g genders -n name
+    
+    8. Query datasets collection:
+        beacon_search datasets -d database_name -c collection_name -o ontology -om ontology_modifiers -id identification -n name
+    
+    9. Query individuals collection:
+        beacon_search individuals -d database_name -c collection_name -g age_group -do disease_ontology -f family_history -se severity -st stage -e ethnicity -go geographic_origin -id identification -as assay_code -s sex
+    
+    10. Query runs collection:
+        beacon_search runs -d database_name -c collection_name -id identification -ii individual_id -ll library_layout -ls library_selection -s library_source -st library_strategy -p platform -pm platform_model -r run_date
+    
+    11. Query for cnv:
 
-    # query bracket_queries
-    elif args.command == "bracket":
-        required_args = ['database', 'collection', 'database_host', 'database_port','start_minimum','start_maximum','end_minimum','end_maximum']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "variation.location.sequence_id": args.referenceName,
-            "variation.location.interval.start.value": {"$gte": args.start_minimum, "$lte": args.start_maximum} if args.start_minimum is not None and args.start_maximum is not None else None,
-            "variation.location.interval.end.value": {"$gte": args.end_minimum, "$lte": args.end_maximum} if args.end_minimum is not None and args.end_maximum is not None else None,
-            "variation.variantType": args.variantType
-        }
-    # query analyses collection
-    elif args.command == "analyses":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "aligner": args.aligner,
-            "analysisDate": args.analysisDate,
-            "biosampleId": args.biosampleId,
-            "id": args.identification,
-            "individualId": args.individualId,
-            "pipelineName": args.pipelineName,
-            "pipelineRef": args.pipelineRef,
-            "runId": args.runId,
-            "variantCaller": args.variantCaller
-        }
-        
-        
-    # query biosample collection
-    elif args.command == "biosamples":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "biosampleStatus.label": args.biosampleStatus,
-            "collectionDate": args.collectionDate,
-            "collectionMoment": args.collectionMoment,
-            "id": args.identification,
-            "obtentionProcedure.procedureCode.label": args.obtentionProcedure,
-            "sampleOriginType.label": args.sampleOriginType,
-            "histologicalDiagnosis.label": args.histologicalDiagnosis,
-            "pathologicalStage.label": args.pathologicalStage,
-            "pathologicalTnmFinding.label": args.pathologicalTnmFinding,
-            "phenotypicFeatures.featureType.label": args.featureType,
-            "phenotypicFeatures.severity.label": args.severity,
-            "sampleOriginDetail.label": args.sampleOriginDetail,
-            "sampleProcessing.label": args.sampleProcessing,
-            "sampleStorage.label": args.sampleStorage,
-            "tumorGrade.label": args.tumorGrade,
-            "tumorProgression.label": args.tumorProgression
-        }
+        beacon_search cnv  -d database_name -c collection_name -id identification -ii individual_id
 
-    # query cohorts collection
-    elif args.command == "cohorts":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
+    12. Manage the indexes used by the queries above:
 
-        query = {
-            "cohortDataTypes.label": args.cohortDataTypes,
-            "cohortDesign.label": args.cohortDesign,
-            "cohortSize": args.cohortSize,
-            "cohortType": args.cohortType,
-            "id": args.identification,
-            "inclusionCriteria.genders.label": args.genders,
-            "name": args.name
-        }
+        beacon_search indexes create -d database_name [-q sequence range ...]
+        beacon_search indexes list -d database_name
+        beacon_search indexes drop -d database_name [-q sequence range ...]
+    """
+    
+    parser, parsers = build_parser()
 
-    # query datasets collection
-    elif args.command == "datasets":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
+    args = parser.parse_args()
+    # Check if a sub-command has been provided
+    if args.command is None:
+        print("Please provide a valid sub-command. Use -h or --help for usage details.")
+        parser.print_help()
+        sys.exit(1)  # exit with an error code
 
-        query = {
-            "dataUseConditions.duoDataUse.label": args.dataUseConditions,
-            "dataUseConditions.duoDataUse.modifiers.label": args.ontologyModifiers,
-            "id": args.identification,
-            "name": args.name
-        }
+    if args.server:
+        if args.command in ("indexes", "batch", "serve"):
+            print(f"The {args.command} sub-command can not be sent to a server.")
+            sys.exit(1)
+        forward_query(args, parsers)
+        return
 
-    # query individuals collection
-    elif args.command == "individuals":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
+    if args.command == "serve":
+        try:
+            check_required(args, ['database_auth_source', 'database_user', 'database_password'])
+        except ValueError as e:
+            print(e)
+            parsers[args.command].print_help()
+            sys.exit(1)
+        serve(args, parsers)
+        return
 
-        query = {
-            "diseases.ageOfOnset.ageGroup.label": args.ageGroup,
-            "diseases.diseaseCode.label": args.diseaseCode,
-            "diseases.familyHistory": args.familyHistory,
-            "diseases.severity": args.severity,
-            "diseases.stage": args.stage,
-            "ethnicity.label": args.ethnicity,
-            "geographicOrigin.label": args.geographicOrigin,
-            "id": args.identification,
-            "measures.assayCode.label": args.assayCode,
-            "sex.label": args.sex
-        }
-    
-    
-    # query individuals collection
-    elif args.command == "runs":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "id": args.identification,
-            "individualId": args.individualId,
-            "libraryLayout": args.libraryLayout,
-            "librarySelection": args.librarySelection,
-            "librarySource.label": args.librarySource,
-            "libraryStrategy": args.libraryStrategy,
-            "platform": args.platform,
-            "platformModel.label": args.platformModel,
-            "runDate": args.runDate
-        }
-    
-    # query individuals collection
-    elif args.command == "cnv":
-        required_args = ['database', 'collection', 'database_host', 'database_port']
-        if any(getattr(args, arg)  != "" for arg in required_args):
-            for arg in required_args:
-                if not getattr(args, arg):
-                    print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                    parsers[args.command].print_help()
-                    sys.exit(1)
-        
-        query = {
-            "variantInternalId": args.variantInternalId,
-            "analysisId": args.analysisId,
-            "individualId": args.individualId,
-            "definitions.Location.start": args.start,
-            "definitions.Location.end": args.end,
-            "definitions.Location.chromosome": args.chromosome,
-            "variantState.id": args.variantStateId,
-            "variantState.label": args.variantState,
-            "definitions.Location.sequenceId": args.sequenceId
-        }
+    if args.command == "indexes":
+        if not args.database:
+            print("Missing value -> database. Use -h or --help for usage details.")
+            parsers[args.command].print_help()
+            sys.exit(1)
+        try:
+            manage_indexes(args)
+        except ValueError as e:
+            print(e)
+            parsers[args.command].print_help()
+            sys.exit(1)
+        return
+
+    if args.command == "batch":
+        try:
+            check_required(args, ['database', 'database_auth_source', 'database_user', 'database_password'])
+        except ValueError as e:
+            print(e)
+            parsers[args.command].print_help()
+            sys.exit(1)
+        run_batch(args, parsers)
+        return
+    
+    try:
+        query = build_query(args)
+    except ValueError as e:
+        print(e)
+        parsers[args.command].print_help()
+        sys.exit(1)
 
     # Connect to MongoDB collection
-    advanced_required_args = ['database_auth_source', 'database_user', 'database_password']
-    if any(getattr(args, arg)  != "" for arg in advanced_required_args):
-        for arg in advanced_required_args:
-            if not getattr(args, arg):
-                print(f"Missing value -> {arg}. Use -h or --help for usage details.")
-                parsers[args.command].print_help()
-                sys.exit(1)
+    try:
+        check_required(args, ['database_auth_source', 'database_user', 'database_password'])
+    except ValueError as e:
+        print(e)
+        parsers[args.command].print_help()
+        sys.exit(1)
 
     client = connect_to_mongodb(args)
     db = client[args.database]
-    collection = db[args.collection]
-    # Create a new dictionary with non-empty and non-default values
-    filtered_query = {key: value for key, value in query.items() if value}
-    for v in collection.find(filtered_query):
-        pprint.pprint(v)
+    filtered_query = filter_query(query)
+    count, last_id = write_documents(cached_results(set_up_cache(args), db, args.collection, filtered_query, args), args)
+
+    # Tell how to fetch the next page
+    if args.granularity == "record" and not args.facet and args.limit and count == args.limit and last_id is not None:
+        print(f"next page: --after {last_id}", file=sys.stderr)
 
 if __name__ == "__main__":
     beacon_query()
@@ -0,0 +1,248 @@
+"""Local stand-in for the parts of the Galaxy API used by the import scripts.
+
+The server answers the requests of utils.py and bioblend (whoami, histories, history contents, users, dataset
+details and downloads) from files on disk, so imports can be timed without a Galaxy instance. Every request is
+counted per endpoint, which shows how many round trips an import needs.
+"""
+
+import json
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+BEACON_HISTORY_NAME = "Beacon Export \U0001F4E1"
+
+
+class FakeDataset:
+    """
+    A dataset served by the fake galaxy, backed by a local file
+    """
+
+    def __init__(self, dataset_id: str, path: str, extension: str, name: str = "", dbkey: str = "hg38"):
+        self.id = dataset_id
+        self.path = path
+        self.extension = extension
+        self.name = name or os.path.basename(path)
+        self.dbkey = dbkey
+
+    def info(self) -> Dict:
+        """
+        Returns the dataset as listed by the history contents api
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "uuid": f"00000000-0000-4000-8000-{int(self.id, 16):012x}",
+            "extension": self.extension,
+            "file_ext": self.extension,
+            "metadata_dbkey": self.dbkey,
+            "update_time": "2024-01-01T00:00:00",
+            "file_size": os.path.getsize(self.path),
+            "state": "ok",
+            "deleted": False,
+            "purged": False,
+            "history_content_type": "dataset",
+            "download_url": f"/api/datasets/{self.id}/display",
+        }
+
+
+class FakeGalaxy:
+    """
+    Fake galaxy server running in a background thread
+
+        Usage:
+            with FakeGalaxy() as galaxy:
+                history = galaxy.add_history()
+                galaxy.add_dataset(history, "/tmp/variants.vcf", "vcf")
+                gi = GalaxyInstance(galaxy.url, key="benchmark")
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        """
+            Parameters:
+                host (str): address to listen on
+                port (int): port to listen on, 0 for any free port
+        """
+        self.histories: Dict[str, Dict] = {}
+        self.datasets: Dict[str, FakeDataset] = {}
+        self.users: Dict[str, Dict] = {}
+        self.requests: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_user(self, beacon_enabled: bool = True) -> str:
+        """
+        Adds a user, returns its id
+        """
+        with self._lock:
+            user_id = f"{len(self.users) + 1:016x}"
+            self.users[user_id] = {
+                "id": user_id,
+                "username": f"user{len(self.users)}",
+                "preferences": {"beacon_enabled": "true" if beacon_enabled else "false"},
+            }
+        return user_id
+
+    def add_history(self, user_id: str = "", name: str = BEACON_HISTORY_NAME) -> str:
+        """
+        Adds a history (owned by a new beacon enabled user by default), returns its id
+        """
+        user_id = user_id or self.add_user()
+        with self._lock:
+            history_id = f"{len(self.histories) + 1:016x}"
+            self.histories[history_id] = {"id": history_id, "name": name, "user_id": user_id, "datasets": []}
+        return history_id
+
+    def add_dataset(self, history_id: str, path: str, extension: str, name: str = "", dbkey: str = "hg38") -> str:
+        """
+        Adds the file at path as a dataset of a history, returns its id
+        """
+        with self._lock:
+            dataset_id = f"{len(self.datasets) + 1:016x}"
+            self.datasets[dataset_id] = FakeDataset(dataset_id, path, extension, name, dbkey)
+            self.histories[history_id]["datasets"].append(dataset_id)
+        return dataset_id
+
+    def start(self) -> "FakeGalaxy":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeGalaxy":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.requests[endpoint] += 1
+
+    def _history_contents(self, history_id: str, params: Dict[str, List[str]]) -> Optional[List[Dict]]:
+        history = self.histories.get(history_id)
+        if history is None:
+            return None
+        contents = [self.datasets[dataset_id].info() for dataset_id in history["datasets"]]
+
+        # filters are given as pairs of q and qv parameters, only the extension filter matters here
+        for key, value in zip(params.get("q", []), params.get("qv", [])):
+            if key == "extension-in":
+                contents = [entry for entry in contents if entry["extension"] in value.split(",")]
+
+        keys = params.get("keys", [""])[0].split(",")
+        if keys != [""]:
+            contents = [{key: entry[key] for key in keys if key in entry} for entry in contents]
+
+        offset = int(params.get("offset", ["0"])[0])
+        limit = int(params.get("limit", [str(len(contents))])[0])
+        return contents[offset:offset + limit]
+
+    def _handler(self):
+        galaxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                path = url.path.rstrip("/")
+
+                if path == "/api/whoami":
+                    galaxy._count("whoami")
+                    return self.send_json({"id": "0", "username": "admin", "email": "admin@example.org"})
+                if path == "/api/version":
+                    galaxy._count("version")
+                    return self.send_json({"version_major": "23.1", "version_minor": "1"})
+                if path == "/api/histories":
+                    galaxy._count("histories")
+                    names = [value for key, value in zip(params.get("q", []), params.get("qv", [])) if key == "name"]
+                    return self.send_json([{"id": history["id"], "name": history["name"], "user_id": history["user_id"]}
+                                           for history in galaxy.histories.values()
+                                           if not names or history["name"] in names])
+
+                match = re.fullmatch(r"/api/histories/(\w+)", path)
+                if match:
+                    galaxy._count("history")
+                    history = galaxy.histories.get(match.group(1))
+                    if history is None:
+                        return self.send_json({"err_msg": "history not found"}, 404)
+                    return self.send_json({key: history[key] for key in ("id", "name", "user_id")})
+
+                match = re.fullmatch(r"/api/histories/(\w+)/contents", path)
+                if match:
+                    galaxy._count("history_contents")
+                    contents = galaxy._history_contents(match.group(1), params)
+                    if contents is None:
+                        return self.send_json({"err_msg": "history not found"}, 404)
+                    return self.send_json(contents)
+
+                match = re.fullmatch(r"/api/users/(\w+)", path)
+                if match:
+                    galaxy._count("user")
+                    user = galaxy.users.get(match.group(1))
+                    if user is None:
+                        return self.send_json({"err_msg": "user not found"}, 404)
+                    return self.send_json(user)
+
+                match = re.fullmatch(r"/api/(?:histories/\w+/contents|datasets)/(\w+)/display", path)
+                if match:
+                    galaxy._count("download")
+                    dataset = galaxy.datasets.get(match.group(1))
+                    if dataset is None:
+                        return self.send_json({"err_msg": "dataset not found"}, 404)
+                    return self.send_file(dataset.path)
+
+                match = re.fullmatch(r"/api/datasets/(\w+)/metadata_file", path)
+                if match:
+                    # bgzipped test datasets come without a tabix index
+                    galaxy._count("metadata_file")
+                    return self.send_json({"err_msg": "no such metadata file"}, 404)
+
+                match = re.fullmatch(r"/api/(?:histories/\w+/contents|datasets)/(\w+)", path)
+                if match:
+                    galaxy._count("dataset")
+                    dataset = galaxy.datasets.get(match.group(1))
+                    if dataset is None:
+                        return self.send_json({"err_msg": "dataset not found"}, 404)
+                    return self.send_json(dataset.info())
+
+                galaxy._count("unknown")
+                self.send_json({"err_msg": f"unknown endpoint {path}"}, 404)
+
+            def send_json(self, content, status: int = 200):
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_file(self, path: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, "rb") as file:
+                    shutil.copyfileobj(file, self.wfile)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,184 @@
+"""Generates synthetic datasets for the benchmarks.
+
+VCFs are written for beacon-import.py, Beacon v2 JSON collections for beacon2-import.py and beacon2-search.py.
+All generators are deterministic for a given seed, so results of different runs are comparable.
+"""
+
+import gzip
+import json
+import random
+from typing import Dict, Iterator, List
+
+BASES = "ACGT"
+CONTIGS = ["1", "2", "3", "X"]
+CONTIG_LENGTH = 50_000_000
+GENES = [f"GENE{i}" for i in range(200)]
+SEXES = ["female", "male"]
+ETHNICITIES = ["European", "African", "Asian", "American"]
+VARIANT_TYPES = ["SNP", "INDEL"]
+
+
+def random_variants(count: int, seed: int = 0) -> Iterator[Dict]:
+    """
+    Yields (contig, position, ref, alt) dictionaries sorted by contig and position
+
+        Parameters:
+            count (int): number of variants
+            seed (int): seed of the random generator
+
+        Returns:
+            Iterator over variants with 1-based positions
+    """
+    rng = random.Random(seed)
+    per_contig = max(count // len(CONTIGS), 1)
+    produced = 0
+    for contig in CONTIGS:
+        positions = sorted(rng.sample(range(1, CONTIG_LENGTH), min(per_contig, count - produced)))
+        for position in positions:
+            ref = rng.choice(BASES)
+            if rng.random() < 0.9:
+                alt = rng.choice(BASES.replace(ref, ""))
+            else:
+                # deletion or insertion
+                alt = ref + "".join(rng.choice(BASES) for _ in range(rng.randint(1, 5)))
+                if rng.random() < 0.5:
+                    ref, alt = alt, ref
+            yield {"contig": contig, "position": position, "ref": ref, "alt": alt}
+        produced += len(positions)
+        if produced >= count:
+            return
+
+
+def write_vcf(path: str, count: int, samples: int = 4, seed: int = 0) -> int:
+    """
+    Writes a VCF with random variants and genotypes, gzip compressed if the path ends with ".gz"
+
+        Returns:
+            number of written variants
+    """
+    rng = random.Random(seed + 1)
+    opener = gzip.open if path.endswith(".gz") else open
+    written = 0
+    with opener(path, "wt") as vcf:
+        vcf.write("##fileformat=VCFv4.2\n")
+        for contig in CONTIGS:
+            vcf.write(f"##contig=<ID={contig},length={CONTIG_LENGTH}>\n")
+        vcf.write('##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count">\n')
+        vcf.write('##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles">\n')
+        vcf.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Allele frequency">\n')
+        vcf.write('##INFO=<ID=VT,Number=1,Type=String,Description="Variant type">\n')
+        vcf.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        sample_names = "\t".join(f"SAMPLE{i}" for i in range(samples))
+        vcf.write(f"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{sample_names}\n")
+
+        for variant in random_variants(count, seed):
+            genotypes = [rng.choice(["0/0", "0/1", "1/1"]) for _ in range(samples)]
+            ac = sum(genotype.count("1") for genotype in genotypes)
+            if ac == 0:
+                genotypes[0] = "0/1"
+                ac = 1
+            an = 2 * samples
+            variant_type = "SNP" if len(variant["ref"]) == len(variant["alt"]) else "INDEL"
+            vcf.write(f"{variant['contig']}\t{variant['position']}\t.\t{variant['ref']}\t{variant['alt']}\t50\tPASS\t"
+                      f"AC={ac};AN={an};AF={ac / an:.4f};VT={variant_type}\tGT\t" + "\t".join(genotypes) + "\n")
+            written += 1
+    return written
+
+
+def variant_documents(count: int, dataset_id: str = "dataset0", samples: int = 4, seed: int = 0) -> Iterator[Dict]:
+    """
+    Yields genomicVariations documents with the fields used by beacon2-import.py and beacon2-search.py
+    """
+    rng = random.Random(seed + 2)
+    for number, variant in enumerate(random_variants(count, seed)):
+        start = variant["position"] - 1
+        end = start + len(variant["ref"])
+        variant_type = "SNP" if len(variant["ref"]) == len(variant["alt"]) else "INDEL"
+        internal_id = f"{variant['contig']}:{variant['position']}{variant['ref']}>{variant['alt']}"
+        yield {
+            "variantInternalId": internal_id,
+            "datasetId": dataset_id,
+            "referenceBases": variant["ref"],
+            "alternateBases": variant["alt"],
+            "position": {"assemblyId": "GRCh38", "refseqId": variant["contig"], "start": [start], "end": [end]},
+            "variation": {
+                "referenceBases": variant["ref"],
+                "alternateBases": variant["alt"],
+                "variantType": variant_type,
+                "location": {
+                    "sequence_id": variant["contig"],
+                    "interval": {"start": {"value": start}, "end": {"value": end}},
+                },
+            },
+            "molecularAttributes": {"geneIds": [rng.choice(GENES)], "aminoacidChanges": []},
+            "caseLevelData": [{"biosampleId": f"biosample{rng.randrange(samples * 10)}"}
+                              for _ in range(rng.randint(1, samples))],
+            "definitions": {"Location": {"chromosome": variant["contig"], "start": start, "end": end}},
+        }
+
+
+def metadata_documents(collection: str, count: int, seed: int = 0) -> Iterator[Dict]:
+    """
+    Yields documents of the metadata collections (individuals, biosamples, analyses, runs, cohorts, datasets)
+    """
+    rng = random.Random(seed + 3)
+    for number in range(count):
+        document = {"id": f"{collection}{number}"}
+        if collection == "individuals":
+            document.update({"sex": {"label": rng.choice(SEXES)}, "ethnicity": {"label": rng.choice(ETHNICITIES)},
+                             "diseases": [{"diseaseCode": {"label": f"disease{rng.randrange(20)}"}}]})
+        elif collection == "biosamples":
+            document.update({"individualId": f"individuals{rng.randrange(count)}",
+                             "biosampleStatus": {"label": rng.choice(["case", "control"])},
+                             "sampleOriginType": {"label": "blood"}})
+        elif collection in ("analyses", "runs"):
+            document.update({"individualId": f"individuals{rng.randrange(count)}",
+                             "biosampleId": f"biosamples{rng.randrange(count)}", "runId": f"runs{number}",
+                             "platform": "Illumina"})
+        elif collection in ("cohorts", "datasets"):
+            document.update({"name": f"{collection} {number}"})
+        yield document
+
+
+def write_json(path: str, documents: Iterator[Dict], lines: bool = False) -> int:
+    """
+    Writes documents as a JSON array (or JSON Lines), returns the number of documents
+    """
+    written = 0
+    with open(path, "w") as out:
+        if not lines:
+            out.write("[")
+        for document in documents:
+            if lines:
+                out.write(json.dumps(document) + "\n")
+            else:
+                out.write(("," if written else "") + json.dumps(document))
+            written += 1
+        if not lines:
+            out.write("]")
+    return written
+
+
+def sample_queries(documents: List[Dict]) -> Dict[str, List[str]]:
+    """
+    Returns beacon2-search.py arguments of one query per query type matching the given variant documents
+    """
+    variant = documents[len(documents) // 2]
+    location = variant["variation"]["location"]
+    start = location["interval"]["start"]["value"]
+    end = location["interval"]["end"]["value"]
+    return {
+        "sequence": ["-rn", location["sequence_id"], "-s", str(start), "-rb", variant["referenceBases"],
+                     "-ab", variant["alternateBases"]],
+        "range": ["-rn", location["sequence_id"], "-s", str(start), "-e", str(end)],
+        "gene": ["-g", variant["molecularAttributes"]["geneIds"][0]],
+        "bracket": ["-rn", location["sequence_id"], "-smin", str(max(start - 100000, 1)), "-smax", str(start + 100000),
+                    "-emin", str(max(end - 100000, 1)), "-emax", str(end + 100000)],
+        "cnv": ["-ch", location["sequence_id"]],
+        "individuals": ["-s", "female"],
+        "biosamples": ["-bs", "case"],
+        "analyses": ["-ii", "individuals1"],
+        "runs": ["-p", "Illumina"],
+        "cohorts": ["-id", "cohorts1"],
+        "datasets": ["-id", "datasets1"],
+    }
@@ -0,0 +1,516 @@
+"""Times the hot paths of the import and search scripts on synthetic data.
+
+    python benchmarks/run.py --variants 20000 --datasets 4 --output results.json
+    python benchmarks/run.py --output new.json --baseline results.json
+
+Galaxy is replaced by benchmarks/fake_galaxy.py. Beacon v2 is imported to the MongoDB given by --mongo-uri or to
+mongomock, Beacon v1 only to the PostgreSQL given by the DATABASE_* environment variables when --postgres is set.
+Benchmarks whose dependencies are missing are reported as skipped. Results are written as JSON, so runs of different
+versions can be compared with --baseline.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import generate  # noqa: E402
+from fake_galaxy import FakeGalaxy  # noqa: E402
+from origins import OriginsStore  # noqa: E402
+
+# metadata collections imported next to genomicVariations
+METADATA_COLLECTIONS = ["individuals", "biosamples", "analyses", "runs", "cohorts", "datasets"]
+DATABASE_NAME = "beacon_benchmark"
+
+
+class Skipped(Exception):
+    """
+    Raised by a benchmark whose dependencies or targets are not available
+    """
+
+
+def load_script(name: str):
+    """
+    Imports one of the (hyphenated) scripts of the repository as a module
+
+        Raises:
+            Skipped if a dependency of the script is not installed
+    """
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(REPO_DIR, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        raise Skipped(f"{name}.py cannot be imported - {e}")
+    return module
+
+
+class Suite:
+    """
+    Runs benchmarks and collects their results
+    """
+
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: Dict[str, Dict[str, Any]] = {}
+
+    def run(self, name: str, benchmark: Callable[[], Optional[int]], setup: Callable[[], None] = None,
+            unit: str = "items") -> None:
+        """
+        Times benchmark repeat times and records the best and mean duration
+
+            Parameters:
+                name (str): name of the result
+                benchmark (Callable): the timed function, returns the number of processed items (optional)
+                setup (Callable): untimed preparation before each repetition (optional)
+                unit (str): what the items are (variants, documents, bytes, ...)
+        """
+        durations = []
+        items = None
+        try:
+            for _ in range(self.repeat):
+                if setup is not None:
+                    setup()
+                start = time.perf_counter()
+                items = benchmark()
+                durations.append(time.perf_counter() - start)
+        except Skipped as e:
+            self.skip(name, str(e))
+            return
+        except Exception as e:
+            print(f"{name}: failed - {e!r}", file=sys.stderr)
+            self.results[name] = {"status": "failed", "error": repr(e)}
+            return
+
+        best = min(durations)
+        result = {"status": "ok", "best": best, "mean": statistics.mean(durations), "repeat": len(durations)}
+        if items is not None:
+            result.update({"items": items, "unit": unit, "per_second": items / best if best else None})
+        self.results[name] = result
+        rate = f" ({items / best:,.0f} {unit}/s)" if items is not None and best else ""
+        print(f"{name}: {best:.4f}s{rate}", file=sys.stderr)
+
+    def skip(self, name: str, reason: str) -> None:
+        print(f"{name}: skipped - {reason}", file=sys.stderr)
+        self.results[name] = {"status": "skipped", "reason": reason}
+
+
+def generate_data(directory: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Writes the synthetic datasets, returns their paths and the search queries matching them
+    """
+    data: Dict[str, Any] = {"vcf": [], "variants": [], "metadata": {}}
+    for number in range(args.datasets):
+        vcf = os.path.join(directory, f"variants-{number}.vcf")
+        generate.write_vcf(vcf, args.variants, seed=args.seed + number)
+        data["vcf"].append(vcf)
+
+        # the collection name is part of the dataset name, as in the beacon histories
+        variants = os.path.join(directory, f"genomicVariations-{number}.json")
+        generate.write_json(variants, generate.variant_documents(args.variants, f"dataset{number}",
+                                                                  seed=args.seed + number))
+        data["variants"].append(variants)
+
+    for collection in METADATA_COLLECTIONS:
+        path = os.path.join(directory, f"{collection}.json")
+        generate.write_json(path, generate.metadata_documents(collection, args.documents, seed=args.seed))
+        data["metadata"][collection] = path
+
+    data["queries"] = generate.sample_queries(list(generate.variant_documents(args.variants, "dataset0",
+                                                                              seed=args.seed)))
+    return data
+
+
+def set_up_galaxy(galaxy: FakeGalaxy, data: Dict[str, Any], histories: int) -> None:
+    """
+    Spreads the generated datasets over beacon histories of the fake galaxy
+    """
+    history_ids = [galaxy.add_history() for _ in range(histories)]
+    paths = [(path, "vcf") for path in data["vcf"]] + [(path, "json") for path in data["variants"]]
+    paths += [(path, "json") for path in data["metadata"].values()]
+    for number, (path, extension) in enumerate(paths):
+        galaxy.add_dataset(history_ids[number % len(history_ids)], path, extension)
+    # a history of a user without beacon sharing, which has to be filtered out
+    galaxy.add_history(galaxy.add_user(beacon_enabled=False))
+
+
+def galaxy_benchmarks(suite: Suite, galaxy: FakeGalaxy, directory: str) -> None:
+    try:
+        import utils
+        gi = utils.set_up_galaxy_instance(galaxy.url, "benchmark")
+    except ImportError as e:
+        for name in ["get_beacon_histories", "v1.get_datasets", "v2.get_datasets", "download_dataset"]:
+            suite.skip(name, f"bioblend is not installed - {e}")
+        return
+
+    histories: List[str] = []
+
+    def get_histories():
+        histories[:] = utils.get_beacon_histories(gi)
+        return len(histories)
+    suite.run("get_beacon_histories", get_histories, unit="histories")
+
+    datasets = []
+    download_dataset = None
+    for version, script in [("v1", "beacon-import"), ("v2", "beacon2-import")]:
+        try:
+            module = load_script(script)
+        except Skipped as e:
+            suite.skip(f"{version}.get_datasets", str(e))
+            continue
+
+        def get_datasets(module=module):
+            datasets[:] = [dataset for history_id in histories for dataset in module.get_datasets(gi, history_id)]
+            return len(datasets)
+        suite.run(f"{version}.get_datasets", get_datasets, unit="datasets")
+        download_dataset = module.download_dataset
+
+    def download():
+        if download_dataset is None:
+            raise Skipped("neither import script can be imported")
+        downloaded = 0
+        for dataset in datasets:
+            path = os.path.join(directory, f"download-{dataset.id}")
+            if not download_dataset(gi, dataset, path):
+                raise RuntimeError(f"download of {dataset.name} failed")
+            downloaded += os.path.getsize(path)
+            os.remove(path)
+        return downloaded
+    suite.run("download_dataset", download, unit="bytes")
+
+
+def mongo_client(args: argparse.Namespace):
+    """
+    Returns a client for the benchmark database, MongoDB if --mongo-uri is given else mongomock
+
+    mongomock keeps its data per client, so the import and search benchmarks have to share one.
+
+        Raises:
+            Skipped if neither is available
+    """
+    if args.mongo_uri:
+        try:
+            from pymongo import MongoClient
+        except ImportError as e:
+            raise Skipped(f"pymongo is not installed - {e}")
+        return MongoClient(args.mongo_uri)
+    try:
+        import mongomock
+    except ImportError:
+        raise Skipped("mongomock is not installed and no --mongo-uri is given")
+    return mongomock.MongoClient()
+
+
+def v2_benchmarks(suite: Suite, data: Dict[str, Any], client_factory: Callable, args: argparse.Namespace) -> None:
+    names = ["v2.import_to_mongodb", "v2.import_metadata", "v2.persist_variant_origins", "v2.update_dataset_counts"]
+    try:
+        module = load_script("beacon2-import")
+        client = client_factory()
+    except Skipped as e:
+        for name in names:
+            suite.skip(name, str(e))
+        return
+    module.db.client = client
+    module.db.database_name = DATABASE_NAME
+    total = args.variants * args.datasets
+
+    def clear():
+        client.drop_database(DATABASE_NAME)
+
+    def import_variants():
+        for path in data["variants"]:
+            if module.import_to_mongodb("genomicVariations", path) is None:
+                raise RuntimeError(f"import of {path} failed")
+        return total
+    suite.run("v2.import_to_mongodb", import_variants, setup=clear, unit="variants")
+
+    def import_metadata():
+        for collection, path in data["metadata"].items():
+            if module.import_to_mongodb(collection, path) is None:
+                raise RuntimeError(f"import of {path} failed")
+        return len(data["metadata"]) * args.documents
+    suite.run("v2.import_metadata", import_metadata, setup=lambda: [client[DATABASE_NAME][collection].drop()
+                                                                     for collection in data["metadata"]],
+              unit="documents")
+
+    def persist_origins():
+        with tempfile.TemporaryDirectory(prefix="beacon-benchmark-origins-") as directory:
+            record = OriginsStore(os.path.join(directory, "origins.sqlite"))
+            for number, path in enumerate(data["variants"]):
+                module.persist_variant_origins(f"dataset{number}", path, record)
+            record.close()
+        return total
+    suite.run("v2.persist_variant_origins", persist_origins, unit="variants")
+
+    def update_counts():
+        info = module.db.update_dataset_counts()
+        if info.startswith("There are some errors"):
+            raise RuntimeError(info)
+        return total
+    suite.run("v2.update_dataset_counts", update_counts, unit="variants")
+
+
+def search_benchmarks(suite: Suite, data: Dict[str, Any], client_factory: Callable, args: argparse.Namespace) -> None:
+    """
+    Times every query type of beacon2-search.py on the database filled by v2_benchmarks
+    """
+    queries = data["queries"]
+    try:
+        module = load_script("beacon2-search")
+        from indexes import SEARCH_INDEXES
+        database = client_factory()[DATABASE_NAME]
+        if "genomicVariations" not in database.list_collection_names():
+            raise Skipped("the beacon v2 import benchmarks did not fill the database")
+    except Skipped as e:
+        for query_type in queries:
+            suite.skip(f"search.{query_type}", str(e))
+        return
+
+    parser, _ = module.build_parser()
+    null = open(os.devnull, "w")
+
+    if args.create_indexes:
+        from indexes import create_indexes
+        create_indexes(database)
+
+    for query_type, query_args in queries.items():
+        collection = SEARCH_INDEXES[query_type][0]
+        granularities = ["record", "count", "boolean"] if collection == "genomicVariations" else ["record"]
+        for granularity in granularities:
+            search_args = parser.parse_args([query_type, "-d", DATABASE_NAME, "-c", collection, "--format", "jsonl",
+                                             "--granularity", granularity] + query_args)
+
+            def search(search_args=search_args, collection=collection):
+                query = module.filter_query(module.build_query(search_args))
+                count, _ = module.write_documents(module.query_results(database[collection], query, search_args),
+                                                  search_args, null)
+                return count
+            name = f"search.{query_type}" + ("" if granularity == "record" else f".{granularity}")
+            suite.run(name, search, unit="results")
+    null.close()
+
+
+def origins_benchmarks(suite: Suite, directory: str, args: argparse.Namespace) -> None:
+    """
+    Times writes to and lookups in the origins store, with the beacon indices of all synthetic variants
+    """
+    path = os.path.join(directory, "origins.sqlite")
+    batch_size = 10000
+
+    def clear():
+        if os.path.exists(path):
+            os.remove(path)
+
+    def add():
+        store = OriginsStore(path)
+        for number in range(args.datasets):
+            first = number * args.variants
+            for start in range(first, first + args.variants, batch_size):
+                store.add(f"dataset{number}", range(start, min(start + batch_size, first + args.variants)))
+        store.close()
+        return args.datasets * args.variants
+    suite.run("origins.add", add, setup=clear, unit="variants")
+
+    store = OriginsStore(path)
+    indices = list(range(0, args.datasets * args.variants, 7))
+
+    def lookup():
+        for index in indices:
+            store.lookup([index])
+        return len(indices)
+    suite.run("origins.lookup", lookup, unit="variants")
+    store.close()
+
+    def refill():
+        clear()
+        add()
+
+    def remove():
+        store = OriginsStore(path)
+        store.remove_datasets([f"dataset{number}" for number in range(args.datasets)])
+        store.close()
+        return args.datasets * args.variants
+    suite.run("origins.remove_datasets", remove, setup=refill, unit="variants")
+
+
+def v1_benchmarks(suite: Suite, data: Dict[str, Any], directory: str, args: argparse.Namespace) -> None:
+    names = ["v1.beacon_import", "v1.persist_variant_origins", "v1.update_dataset_counts"]
+    if not args.postgres:
+        for name in names:
+            suite.skip(name, "needs a PostgreSQL beacon database, see --postgres")
+        return
+    try:
+        module = load_script("beacon-import")
+    except Skipped as e:
+        for name in names:
+            suite.skip(name, str(e))
+        return
+
+    # the connection is configured like the import script, DATABASE_* environment variables override the defaults
+    parser = argparse.ArgumentParser()
+    module.database_arguments(parser)
+    db_args = parser.parse_args([])
+    for variable, dest in [("DATABASE_URL", "database_host"), ("DATABASE_PORT", "database_port"),
+                           ("DATABASE_USER", "database_user"), ("DATABASE_PASSWORD", "database_password"),
+                           ("DATABASE_NAME", "database_name")]:
+        if variable in os.environ:
+            setattr(db_args, dest, os.environ[variable])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(module.connect_beacon(db_args))
+    loop.run_until_complete(module.db.ensure_variant_index())
+    total = args.variants * args.datasets
+
+    datasets = []
+    for number, path in enumerate(data["vcf"]):
+        dataset = module.GalaxyDataset({"name": os.path.basename(path), "id": f"{number:016x}",
+                                        "uuid": f"uuid-{number}", "extension": "vcf", "metadata_dbkey": "GRCh38"})
+        metadata_file = os.path.join(directory, f"metadata-{number}.json")
+        module.prepare_metadata_file(dataset, metadata_file)
+        datasets.append((dataset, path, metadata_file))
+
+    def clear():
+        loop.run_until_complete(module.db.clear_database())
+
+    def import_variants():
+        for _, path, metadata_file in datasets:
+            module.beacon_import(path, metadata_file)
+        return total
+    suite.run("v1.beacon_import", import_variants, setup=clear, unit="variants")
+
+    def persist_origins():
+        with tempfile.TemporaryDirectory(prefix="beacon-benchmark-origins-", dir=directory) as origins_directory:
+            record = OriginsStore(os.path.join(origins_directory, "origins.sqlite"))
+            for dataset, path, _ in datasets:
+                loop.run_until_complete(module.persist_variant_origins(
+                    dataset.id, module.VCF(path), module.beacon_dataset_id(dataset), record))
+            record.close()
+        return total
+    suite.run("v1.persist_variant_origins", persist_origins, unit="variants")
+
+    def update_counts():
+        loop.run_until_complete(module.db.update_dataset_counts())
+        return total
+    suite.run("v1.update_dataset_counts", update_counts, unit="variants")
+
+
+def version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: Dict[str, Dict], baseline_file: str, threshold: float) -> List[str]:
+    """
+    Prints the ratio of each best duration to the one of a baseline run, returns the regressed benchmarks
+    """
+    with open(baseline_file) as baseline:
+        baseline_results = json.load(baseline)["results"]
+
+    regressions = []
+    for name, result in results.items():
+        previous = baseline_results.get(name, {})
+        if result.get("status") != "ok" or previous.get("status") != "ok" or not previous["best"]:
+            continue
+        ratio = result["best"] / previous["best"]
+        marker = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            marker = "  <- regression"
+        print(f"{name}: {ratio:.2f}x of baseline{marker}", file=sys.stderr)
+    return regressions
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the beacon import and search scripts")
+    data_group = parser.add_argument_group("Synthetic data")
+    data_group.add_argument("--variants", type=int, default=10000, help="variants per dataset")
+    data_group.add_argument("--datasets", type=int, default=2, help="number of VCF and genomicVariations datasets")
+    data_group.add_argument("--histories", type=int, default=2, help="number of beacon histories in the fake galaxy")
+    data_group.add_argument("--documents", type=int, default=1000, help="documents per metadata collection")
+    data_group.add_argument("--seed", type=int, default=0, help="seed of the data generators")
+
+    target_group = parser.add_argument_group("Targets")
+    target_group.add_argument("--mongo-uri", type=str, default="",
+                              help="MongoDB for the beacon v2 benchmarks (default: mongomock), "
+                                   f"the database {DATABASE_NAME} is dropped")
+    target_group.add_argument("--postgres", action="store_true", default=False,
+                              help="run the beacon v1 benchmarks against the PostgreSQL beacon database given by the "
+                                   "DATABASE_* environment variables - ALL ITS DATA IS REMOVED")
+    target_group.add_argument("--create-indexes", action="store_true", default=False,
+                              help="create the search indexes before timing the queries")
+
+    run_group = parser.add_argument_group("Run")
+    run_group.add_argument("--repeat", type=int, default=3, help="repetitions of each benchmark, the best one counts")
+    run_group.add_argument("--output", type=str, default="", help="JSON file for the results (default: stdout)")
+    run_group.add_argument("--baseline", type=str, default="", help="results of an earlier run to compare with")
+    run_group.add_argument("--threshold", type=float, default=0.1,
+                           help="slowdown relative to the baseline that counts as a regression")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_arguments()
+    suite = Suite(args.repeat)
+
+    with tempfile.TemporaryDirectory(prefix="beacon-benchmark-") as directory:
+        data = generate_data(directory, args)
+        with FakeGalaxy() as galaxy:
+            set_up_galaxy(galaxy, data, args.histories)
+            galaxy_benchmarks(suite, galaxy, directory)
+            galaxy_requests = dict(galaxy.requests)
+        clients = []
+
+        def client_factory():
+            if not clients:
+                clients.append(mongo_client(args))
+            return clients[0]
+        v2_benchmarks(suite, data, client_factory, args)
+        search_benchmarks(suite, data, client_factory, args)
+        origins_benchmarks(suite, directory, args)
+        v1_benchmarks(suite, data, directory, args)
+
+    report = {
+        "suite": "galaxy-beacon-import",
+        "version": version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: getattr(args, key) for key in
+                       ["variants", "datasets", "histories", "documents", "seed", "repeat", "create_indexes"]},
+        "targets": {"mongodb": "mongodb" if args.mongo_uri else "mongomock",
+                    "postgres": args.postgres},
+        "galaxy_requests": galaxy_requests,
+        "results": suite.results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        return 1 if compare(suite.results, args.baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+from typing import Callable, Dict, Optional
+
+from utils import GalaxyDataset
+
+# files kept next to a cached dataset, removed together with it
+SIDECAR_SUFFIXES = (".sha256", ".tbi")
+
+
+class DownloadCache:
+    """
+    Persistent on-disk cache of downloaded galaxy datasets
+
+    Files are keyed by dataset uuid and update_time, so copies of a dataset share one file and a dataset is
+    downloaded again once it changes. Downloads are written to a temporary file and renamed into place when
+    complete, their size is checked against galaxy and a sha256 checksum is kept next to each file. Hashing a
+    file takes about as long as reading it, so cache hits only compare its size and modification time with the
+    checksum file (written or touched after the file). Files modified since then, and with verify every file, are
+    hashed again. Once the cache grows beyond max_size, the least recently used files are evicted.
+
+    Files handed out by get are pinned until they are released, pinned files are never evicted.
+    """
+
+    def __init__(self, directory: str, max_size: int, verify: bool = False):
+        """
+        Opens (or creates) the cache in the given directory
+
+            Parameters:
+                directory (str): directory holding the cached files
+                max_size (int): size in bytes the cache is trimmed to after each release
+                verify (bool): compare the checksum of a cached file on every hit
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.verify = verify
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._pins: Dict[str, int] = {}
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+        # temporary files of interrupted downloads
+        for name in os.listdir(directory):
+            if ".tmp-" in name:
+                os.remove(os.path.join(directory, name))
+
+    def path(self, dataset: GalaxyDataset) -> str:
+        """
+        Returns the path a dataset is cached at
+        """
+        key = re.sub(r"[^0-9A-Za-z-]", "", f"{dataset.uuid}-{dataset.update_time}")
+        return os.path.join(self.directory, key)
+
+    def get(self, dataset: GalaxyDataset, download: Callable[[str], bool]) -> Optional[str]:
+        """
+        Returns the path of a cached dataset, downloading it first if it is missing or corrupt
+
+        The returned file is pinned and has to be handed to release once it is no longer needed.
+
+            Parameters:
+                dataset (GalaxyDataset): the dataset to look up
+                download (Callable): downloads the dataset to the given path, returns True on success
+
+            Returns:
+                full path of the cached dataset or None if the download failed
+        """
+        path = self.path(dataset)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+        # concurrent requests for the same file wait for a single download
+        with key_lock:
+            if os.path.exists(path):
+                if self._verify(dataset, path):
+                    logging.info(f"using cached copy of {dataset.name}")
+                    # the checksum file is touched last, so it stays at least as recent as the verified file
+                    os.utime(path)
+                    os.utime(f"{path}.sha256")
+                    return path
+                logging.warning(f"cached copy of {dataset.name} is corrupt, downloading it again")
+                self._remove(path)
+
+            temp_path = f"{path}.tmp-{threading.get_ident()}"
+            if download(temp_path) and self._check_size(dataset, temp_path, log=True):
+                with open(f"{temp_path}.sha256", "w") as checksum_file:
+                    checksum_file.write(_sha256(temp_path))
+                os.replace(f"{temp_path}.sha256", f"{path}.sha256")
+                os.replace(temp_path, path)
+                return path
+
+            for leftover in (temp_path, f"{temp_path}.sha256"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+        self.release(path)
+        return None
+
+    def release(self, path: str) -> None:
+        """
+        Unpins a file returned by get and evicts files beyond the size limit
+        """
+        with self._lock:
+            pins = self._pins.get(path, 0) - 1
+            if pins > 0:
+                self._pins[path] = pins
+            else:
+                self._pins.pop(path, None)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used files until the cache fits into max_size
+        """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if ".tmp-" in name or name.endswith(SIDECAR_SUFFIXES):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if path in self._pins:
+                    continue
+                logging.debug(f"evicting {path} from the download cache")
+                self._remove(path)
+                total -= size
+
+    def _verify(self, dataset: GalaxyDataset, path: str) -> bool:
+        if not self._check_size(dataset, path):
+            return False
+        try:
+            if not self.verify and os.path.getmtime(path) <= os.path.getmtime(f"{path}.sha256"):
+                return True
+            with open(f"{path}.sha256") as checksum_file:
+                return checksum_file.read().strip() == _sha256(path)
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _check_size(dataset: GalaxyDataset, path: str, log: bool = False) -> bool:
+        # galaxy does not always know the size of a dataset
+        size = os.path.getsize(path)
+        if dataset.size and size != dataset.size:
+            if log:
+                logging.error(f"download of {dataset.name} is incomplete ({size} of {dataset.size} bytes)")
+            return False
+        return True
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        remove_sidecars(path)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a size like "512M" or "20G" into bytes
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+    if match is None:
+        raise ValueError(f"invalid size \"{size}\"")
+    return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(2) or " "))
+
+
+def remove_sidecars(path: str) -> None:
+    """
+    Removes the files kept next to a dataset that is not cached
+    """
+    for suffix in SIDECAR_SUFFIXES:
+        try:
+            os.remove(f"{path}{suffix}")
+        except FileNotFoundError:
+            pass
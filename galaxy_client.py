@@ -0,0 +1,245 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+import requests
+from bioblend.galaxy import GalaxyInstance
+from requests.adapters import HTTPAdapter
+
+# statuses of an overloaded or restarting galaxy (or of the proxy in front of it), worth retrying
+RETRY_STATUSES = {500, 502, 503, 504}
+
+# upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+
+class RateLimiter:
+    """
+    Token bucket limiting how many requests per second are started, shared by all threads of a run
+    """
+
+    def __init__(self, rate: float, burst: int = 0):
+        """
+            Parameters:
+                rate (float): requests per second, 0 for no limit
+                burst (int): requests that may start at once after a quiet period (defaults to one second's worth)
+        """
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Waits until the next request may start
+
+            Returns:
+                seconds waited
+        """
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # tokens may become negative, every waiting thread sleeps until its own token is due
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RequestStats:
+    """
+    Counters and latencies of the requests sent to galaxy, can be updated from concurrent threads
+
+    Every attempt is counted, so a request retried twice counts as three attempts and two retries.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.attempts = 0
+        self.retries = 0
+        self.failures = 0
+        self.statuses: Counter = Counter()
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_buckets: Counter = Counter()
+        self.throttled = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, status: Optional[int], retry: bool) -> None:
+        """
+        Records an attempt, status is None if it failed without a response (e.g. connection refused or timeout)
+        """
+        with self._lock:
+            self.attempts += 1
+            if retry:
+                self.retries += 1
+            else:
+                self.requests += 1
+            self.statuses[status or "error"] += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.latency_buckets[next(bound for bound in LATENCY_BUCKETS if latency <= bound)] += 1
+
+    def fail(self) -> None:
+        """
+        Records a request that failed after its last retry
+        """
+        with self._lock:
+            self.failures += 1
+
+    def throttle(self, seconds: float) -> None:
+        """
+        Records time spent waiting for the rate limiter
+        """
+        if seconds:
+            with self._lock:
+                self.throttled += seconds
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Returns the upper bound of the histogram bucket holding the given fraction (e.g. 0.95) of all latencies
+        """
+        with self._lock:
+            total = sum(self.latency_buckets.values())
+            seen = 0
+            for bound in LATENCY_BUCKETS:
+                seen += self.latency_buckets[bound]
+                if total and seen >= fraction * total:
+                    return min(bound, self.latency_max)
+        return 0.0
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns the counters as a JSON serializable dictionary
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "statuses": {str(status): count for status, count in self.statuses.items()},
+                "latency_sum": self.latency_sum,
+                "latency_max": self.latency_max,
+                "latency_buckets": {str(bound): self.latency_buckets[bound] for bound in LATENCY_BUCKETS},
+                "throttled": self.throttled,
+            }
+
+    def summary(self) -> str:
+        """
+        Returns a human readable summary of the requests
+        """
+        report = self.report()
+        average = report["latency_sum"] / report["attempts"] if report["attempts"] else 0.0
+        return (f"{report['requests']} galaxy requests ({report['retries']} retries, {report['failures']} failed), "
+                f"latency avg {average:.2f}s p95 <= {self.percentile(0.95):.2f}s max {report['latency_max']:.2f}s, "
+                f"{report['throttled']:.1f}s waited for the rate limit")
+
+
+class GalaxyClient(GalaxyInstance):
+    """
+    GalaxyInstance sending its requests through a pooled, retrying and rate limited session
+
+    bioblend reads everything (including dataset downloads) with make_get_request, which opens a new connection for
+    each request and gives up on the first error. Here, all threads share a session with a pool of pool_size
+    keep-alive connections (threads wait for a free connection instead of opening more), every request has a
+    timeout, and connection errors, timeouts and 5xx responses are retried with exponential backoff and full
+    jitter. Requests changing data in galaxy (POST, PUT, DELETE) are left to bioblend and never retried.
+
+        Usage:
+            gi = GalaxyClient("https://usegalaxy.eu", key, pool_size=16, timeout=60, retries=5, rate=20)
+            ...
+            logging.info(gi.stats.summary())
+    """
+
+    def __init__(self, url: str, key: str, pool_size: int = 16, timeout: float = 60.0, connect_timeout: float = 10.0,
+                 retries: int = 5, backoff: float = 0.5, max_backoff: float = 30.0, rate: float = 0.0):
+        """
+            Parameters:
+                url (str): base URL of the galaxy instance
+                key (str): galaxy api key
+                pool_size (int): number of connections kept open to galaxy
+                timeout (float): seconds to wait for a response or the next chunk of a download
+                connect_timeout (float): seconds to wait for a connection
+                retries (int): how often a failing request is repeated
+                backoff (float): delay before the first retry, doubled for every further retry (before jitter)
+                max_backoff (float): upper bound of the delay between retries
+                rate (float): maximum number of requests started per second, 0 for no limit
+        """
+        super().__init__(url, key=key)
+
+        # bioblend passes gi.timeout explicitly to some requests (e.g. downloads)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(rate)
+        self.stats = RequestStats()
+
+        # called with start, end (as returned by time.perf_counter), status and retry flag of every attempt
+        self.on_request: Optional[Callable[[float, float, Optional[int], bool], None]] = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        # full jitter keeps concurrent workers from retrying in lockstep
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+    def make_get_request(self, url: str, **kwargs: Any) -> requests.Response:
+        """
+        Sends a GET request to galaxy, retrying connection errors, timeouts and 5xx responses
+
+        Takes the same arguments as requests.get. Once the retries are used up, the last response is returned or
+        the last exception raised, like bioblend does for the first one.
+        """
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (self.connect_timeout, self.timeout)
+        kwargs.setdefault("verify", self.verify)
+
+        attempt = 0
+        while True:
+            self.stats.throttle(self.limiter.acquire())
+            start = time.perf_counter()
+            response, error = None, None
+            try:
+                response = self.session.get(url, headers=self.json_headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            end = time.perf_counter()
+
+            status = response.status_code if response is not None else None
+            self.stats.record(end - start, status, retry=attempt > 0)
+            if self.on_request is not None:
+                self.on_request(start, end, status, attempt > 0)
+
+            if error is None and status not in RETRY_STATUSES:
+                return response
+            if attempt >= self.retries:
+                self.stats.fail()
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self._delay(attempt, response)
+            logging.warning(f"GET {url.split('?')[0]} failed ({error or f'status {status}'}), "
+                            f"retry {attempt + 1}/{self.retries} in {delay:.1f}s")
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
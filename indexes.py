@@ -0,0 +1,141 @@
+import logging
+from typing import Dict, List, Tuple
+
+# prefix of all indexes managed here, other indexes are never touched
+INDEX_PREFIX = "beacon_search_"
+
+# compound indexes matching the predicates of each query type of beacon2-search.py
+# query type -> (collection, [(index name, keys)])
+# equality predicates come first, range predicates (start/end positions) last
+SEARCH_INDEXES: Dict[str, Tuple[str, List[Tuple[str, List[str]]]]] = {
+    "sequence": ("genomicVariations", [
+        ("sequence", ["variation.location.sequence_id", "variation.location.interval.start.value",
+                      "variation.referenceBases", "variation.alternateBases"]),
+        ("biosample", ["caseLevelData.biosampleId"]),
+    ]),
+    "range": ("genomicVariations", [
+        ("range", ["variation.location.sequence_id", "variation.location.interval.start.value",
+                   "variation.location.interval.end.value"]),
+    ]),
+    "bracket": ("genomicVariations", [
+        ("bracket", ["variation.location.sequence_id", "variation.variantType",
+                     "variation.location.interval.start.value", "variation.location.interval.end.value"]),
+    ]),
+    "gene": ("genomicVariations", [
+        ("gene", ["molecularAttributes.geneIds", "variation.variantType", "variation.alternateBases"]),
+    ]),
+    "cnv": ("genomicVariations", [
+        ("cnv", ["definitions.Location.chromosome", "definitions.Location.start", "definitions.Location.end"]),
+        ("cnv_individual", ["individualId", "analysisId"]),
+    ]),
+    "analyses": ("analyses", [
+        ("analyses_id", ["id"]),
+        ("analyses_biosample", ["biosampleId"]),
+        ("analyses_individual", ["individualId"]),
+        ("analyses_run", ["runId"]),
+    ]),
+    "biosamples": ("biosamples", [
+        ("biosamples_id", ["id"]),
+        ("biosamples_status", ["biosampleStatus.label", "sampleOriginType.label"]),
+    ]),
+    "cohorts": ("cohorts", [
+        ("cohorts_id", ["id"]),
+    ]),
+    "datasets": ("datasets", [
+        ("datasets_id", ["id"]),
+    ]),
+    "individuals": ("individuals", [
+        ("individuals_id", ["id"]),
+        ("individuals_sex", ["sex.label", "ethnicity.label"]),
+        ("individuals_disease", ["diseases.diseaseCode.label"]),
+    ]),
+    "runs": ("runs", [
+        ("runs_id", ["id"]),
+        ("runs_individual", ["individualId"]),
+    ]),
+}
+
+
+def _collections(query_types: List[str] = None, collection: str = "") -> Dict[str, list]:
+    """
+    Groups the indexes of the given query types (all by default) by collection
+
+        Parameters:
+            query_types (List[str]): query types whose indexes to use
+            collection (str): create the indexes on this collection instead of the default one
+
+        Returns:
+            index models by collection name
+    """
+    # imported here, beacon2-search.py imports this module also when it forwards queries without using pymongo
+    from pymongo import ASCENDING, IndexModel
+
+    models: Dict[str, list] = {}
+    for query_type in query_types or SEARCH_INDEXES:
+        default_collection, indexes = SEARCH_INDEXES[query_type]
+        for name, keys in indexes:
+            models.setdefault(collection or default_collection, []).append(
+                IndexModel([(key, ASCENDING) for key in keys], name=INDEX_PREFIX + name))
+    return models
+
+
+def create_indexes(database, query_types: List[str] = None, collection: str = "", prefix: str = "") -> List[str]:
+    """
+    Creates the search indexes on the collections of a beacon database
+
+    Indexes that exist already are left unchanged. Collections that do not exist are skipped, since MongoDB would
+    create them empty.
+
+        Parameters:
+            database (Database): the beacon database
+            query_types (List[str]): query types to create indexes for, all by default
+            collection (str): create the indexes on this collection instead of the default one
+            prefix (str): prefix of the collection names (e.g. of the staging collections of a shadow rebuild)
+
+        Returns:
+            names of the indexes by collection ("collection.index")
+    """
+    existing = set(database.list_collection_names())
+    created = []
+    for collection_name, models in _collections(query_types, collection).items():
+        collection_name = prefix + collection_name
+        if collection_name not in existing:
+            logging.info(f"Not indexing missing collection {collection_name}")
+            continue
+        logging.info(f"Creating {len(models)} indexes on {collection_name}")
+        for name in database[collection_name].create_indexes(models):
+            created.append(f"{collection_name}.{name}")
+    return created
+
+
+def list_indexes(database) -> List[Tuple[str, str, List[str]]]:
+    """
+    Lists the search indexes of a beacon database
+
+        Returns:
+            list of (collection, index name, keys) tuples
+    """
+    indexes = []
+    for collection_name in sorted(database.list_collection_names()):
+        for index in database[collection_name].list_indexes():
+            if index["name"].startswith(INDEX_PREFIX):
+                indexes.append((collection_name, index["name"], list(index["key"].keys())))
+    return indexes
+
+
+def drop_indexes(database, query_types: List[str] = None, collection: str = "") -> List[str]:
+    """
+    Drops the search indexes of the given query types (all by default) from a beacon database
+
+        Returns:
+            names of the dropped indexes by collection ("collection.index")
+    """
+    dropped = []
+    wanted = {model.document["name"] for models in _collections(query_types, collection).values() for model in models}
+    for collection_name, name, _ in list_indexes(database):
+        if collection and collection_name != collection:
+            continue
+        if name in wanted:
+            database[collection_name].drop_index(name)
+            dropped.append(f"{collection_name}.{name}")
+    return dropped
@@ -0,0 +1,251 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+# prefix of all metrics written to the prometheus textfile
+PROMETHEUS_PREFIX = "beacon_import"
+
+
+class StageMetrics:
+    """
+    Timings and counters of one stage of an import run
+
+    Stages run concurrently in several workers, so busy is the sum of the time spent in the stage by all workers
+    while wall is the time from the first start to the last end of the stage.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.busy = 0.0
+        self.first_start: Optional[float] = None
+        self.last_end: Optional[float] = None
+        self.counters: Counter = Counter()
+
+    @property
+    def wall(self) -> float:
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Returns each counter per second of wall time
+        """
+        wall = self.wall
+        return {name: value / wall for name, value in self.counters.items()} if wall else {}
+
+
+class RunMetrics:
+    """
+    Metrics of an import run: time spent in each stage, what the stages processed and calls to galaxy and the database
+
+    All methods can be called from concurrent workers.
+
+        Usage:
+            metrics = RunMetrics("rebuild", "beacon2")
+            with metrics.stage("download"):
+                ...
+            metrics.add("download", bytes=size, datasets=1)
+            metrics.instrument(gi, "galaxy", ["make_get_request"])
+
+    Note:
+        Only the calling process is measured, work done by process pools (e.g. the region workers of
+        beacon-import.py) is only seen as time spent in the stage that waits for it.
+    """
+
+    def __init__(self, command: str = "", schema: str = ""):
+        """
+            Parameters:
+                command (str): the command being measured (rebuild or sync)
+                schema (str): the beacon version being imported to (beacon or beacon2)
+        """
+        self.command = command
+        self.schema = schema
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.success: Optional[bool] = None
+        self.stages: Dict[str, StageMetrics] = {}
+        self.calls: Counter = Counter()
+        self._start = time.perf_counter()
+        self._duration: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _stage(self, name: str) -> StageMetrics:
+        # must be called with the lock held
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics()
+        return stage
+
+    def record(self, name: str, start: float, end: float) -> None:
+        """
+        Records that a stage ran from start to end (as returned by time.perf_counter)
+        """
+        with self._lock:
+            stage = self._stage(name)
+            stage.runs += 1
+            stage.busy += end - start
+            stage.first_start = start if stage.first_start is None else min(stage.first_start, start)
+            stage.last_end = end if stage.last_end is None else max(stage.last_end, end)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the time spent in the enclosed block as time of the given stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def iterate(self, name: str, items: Iterable) -> Iterator:
+        """
+        Yields the given items, measuring the time spent producing them as time of the given stage
+
+        Useful for lazy sources like galaxy discovery or parsers, whose work happens while they are consumed.
+        """
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(name, start, time.perf_counter())
+                return
+            self.record(name, start, time.perf_counter())
+            yield item
+
+    def add(self, name: str, **counters: int) -> None:
+        """
+        Adds to the counters of a stage, e.g. add("download", bytes=1024, datasets=1)
+        """
+        with self._lock:
+            self._stage(name).counters.update(counters)
+
+    def count_call(self, kind: str, call: str, count: int = 1) -> None:
+        """
+        Counts a call to galaxy or the database
+        """
+        with self._lock:
+            self.calls[(kind, call)] += count
+
+    def instrument(self, target: Any, kind: str, calls: List[str]) -> None:
+        """
+        Counts every call of the given methods of an object (e.g. a GalaxyInstance or a database connection)
+
+        The methods are replaced on this object only. Coroutine methods are counted when they are called.
+        """
+        for call in calls:
+            method = getattr(target, call, None)
+            if method is None:
+                continue
+
+            def counted(*args, method=method, call=call, **kwargs):
+                self.count_call(kind, call)
+                return method(*args, **kwargs)
+            setattr(target, call, counted)
+
+    def finish(self, success: bool) -> None:
+        """
+        Ends the run
+        """
+        self.finished = time.time()
+        self.success = success
+        self._duration = time.perf_counter() - self._start
+
+    @property
+    def duration(self) -> float:
+        return self._duration if self._duration is not None else time.perf_counter() - self._start
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Returns the metrics as a JSON serializable dictionary
+        """
+        with self._lock:
+            return {
+                "command": self.command,
+                "schema": self.schema,
+                "started": self.started,
+                "finished": self.finished,
+                "success": self.success,
+                "duration": self.duration,
+                "stages": {
+                    name: {"runs": stage.runs, "wall": stage.wall, "busy": stage.busy,
+                           "counters": dict(stage.counters), "per_second": stage.rates()}
+                    for name, stage in self.stages.items()
+                },
+                "calls": [{"kind": kind, "call": call, "count": count}
+                          for (kind, call), count in sorted(self.calls.items())],
+            }
+
+    def summary(self) -> str:
+        """
+        Returns a human readable summary of the run
+        """
+        report = self.report()
+        status = {True: "succeeded", False: "FAILED", None: "running"}[report["success"]]
+        lines = [f"{self.command} {status} after {report['duration']:.1f}s"]
+        for name, stage in report["stages"].items():
+            counters = ", ".join(f"{value:,} {counter} ({stage['per_second'].get(counter, 0):,.0f}/s)"
+                                 for counter, value in sorted(stage["counters"].items()))
+            lines.append(f"  {name:<10} wall {stage['wall']:8.1f}s  busy {stage['busy']:8.1f}s"
+                         + (f"  {counters}" if counters else ""))
+        calls: Counter = Counter()
+        for call in report["calls"]:
+            calls[call["kind"]] += call["count"]
+        if calls:
+            lines.append("  calls      " + ", ".join(f"{count:,} {kind}" for kind, count in sorted(calls.items())))
+        return "\n".join(lines)
+
+    def write_json(self, path: str) -> None:
+        """
+        Writes the report as JSON
+        """
+        _write_atomically(path, json.dumps(self.report(), indent=2) + "\n")
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Writes the metrics in the format of the node exporter's textfile collector
+
+        The file is replaced atomically, so the collector never reads a partial file.
+        """
+        report = self.report()
+        run = f'command="{self.command}",schema="{self.schema}"'
+        metrics = [
+            ("last_run_timestamp_seconds", "gauge", "end of the last run", [(run, report["finished"] or time.time())]),
+            ("last_run_success", "gauge", "1 if the last run succeeded", [(run, int(bool(report["success"])))]),
+            ("last_run_duration_seconds", "gauge", "wall time of the last run", [(run, report["duration"])]),
+            ("stage_wall_seconds", "gauge", "wall time of each stage in the last run",
+             [(f'{run},stage="{name}"', stage["wall"]) for name, stage in report["stages"].items()]),
+            ("stage_busy_seconds", "gauge", "time all workers spent in each stage in the last run",
+             [(f'{run},stage="{name}"', stage["busy"]) for name, stage in report["stages"].items()]),
+            ("stage_items", "gauge", "items processed by each stage in the last run",
+             [(f'{run},stage="{name}",item="{counter}"', value)
+              for name, stage in report["stages"].items() for counter, value in stage["counters"].items()]),
+            ("stage_items_per_second", "gauge", "throughput of each stage in the last run",
+             [(f'{run},stage="{name}",item="{counter}"', value)
+              for name, stage in report["stages"].items() for counter, value in stage["per_second"].items()]),
+            ("calls", "gauge", "calls to galaxy and the database in the last run",
+             [(f'{run},kind="{call["kind"]}",call="{call["call"]}"', call["count"]) for call in report["calls"]]),
+        ]
+
+        lines = []
+        for name, metric_type, help_text, samples in metrics:
+            if not samples:
+                continue
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}")
+            lines += [f"{PROMETHEUS_PREFIX}_{name}{{{labels}}} {value}" for labels, value in samples]
+        _write_atomically(path, "\n".join(lines) + "\n")
+
+
+def _write_atomically(path: str, content: str) -> None:
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    with open(temp_path, "w") as file:
+        file.write(content)
+    os.replace(temp_path, path)
@@ -0,0 +1,186 @@
+import json
+import sqlite3
+import threading
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# number of variants per lookup query, stays below the parameter limit of old sqlite versions
+LOOKUP_BATCH_SIZE = 500
+
+
+class OriginsStore:
+    """
+    Local store linking the variants in beacon to the galaxy datasets they stem from
+
+    Variants are identified by their beacon index (beacon 1) or the binary ObjectId of their document (beacon 2).
+    Each origin can carry details of the variant (e.g. its position and bases), kept as JSON and, with compress,
+    deflated with zlib. Dataset ids are stored once and referenced by number, so every origin takes a few bytes
+    next to its details.
+
+    Origins are clustered by variant (a WITHOUT ROWID table keyed by variant and dataset) and indexed by dataset, so
+    looking up a variant and removing or listing a dataset both take milliseconds instead of a scan over all
+    origins. Writes are batched, each call of add is one transaction.
+
+    Note:
+        Like the sync manifest, the store is a local file and not part of the beacon database, so nothing in beacon
+        can be used to link variants back to an actual file uploaded to galaxy.
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        """
+        Opens (or creates) the store at the given path
+
+            Parameters:
+                path (str): full file path of the sqlite database holding the origins
+                compress (bool): deflate the details of added origins (existing origins are read either way)
+        """
+        self.path = path
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self._create_tables()
+        except sqlite3.DatabaseError as e:
+            self._conn.close()
+            # earlier versions appended the origins to a text file
+            raise ValueError(f"{path} is not an origins store ({e}), origins files of earlier versions are plain "
+                             f"text and have to be recreated with --store-origins") from e
+        self._dataset_numbers: Dict[str, int] = {
+            dataset_id: number for number, dataset_id in self._conn.execute("SELECT id, dataset_id FROM datasets")}
+
+    def _create_tables(self) -> None:
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (
+                id INTEGER PRIMARY KEY,
+                dataset_id TEXT UNIQUE
+            );
+            CREATE TABLE IF NOT EXISTS origins (
+                variant,
+                dataset INTEGER,
+                details,
+                PRIMARY KEY (variant, dataset)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS origins_dataset ON origins (dataset);
+        """)
+        self._conn.commit()
+
+    def _encode(self, details: Optional[Dict[str, Any]]) -> Any:
+        if details is None:
+            return None
+        text = json.dumps(details, separators=(",", ":"))
+        # compressed details are stored as blob, plain ones as text, so both can be told apart when reading
+        return zlib.compress(text.encode(), 9) if self.compress else text
+
+    @staticmethod
+    def _decode(details: Any) -> Optional[Dict[str, Any]]:
+        if details is None:
+            return None
+        if isinstance(details, bytes):
+            details = zlib.decompress(details).decode()
+        return json.loads(details)
+
+    def _dataset_number(self, dataset_id: str) -> int:
+        # called with the lock held
+        number = self._dataset_numbers.get(dataset_id)
+        if number is None:
+            self._conn.execute("INSERT OR IGNORE INTO datasets (dataset_id) VALUES (?)", (dataset_id,))
+            number = self._conn.execute("SELECT id FROM datasets WHERE dataset_id = ?", (dataset_id,)).fetchone()[0]
+            self._dataset_numbers[dataset_id] = number
+        return number
+
+    def add(self, dataset_id: str, variants: Iterable[Any],
+            details: Iterable[Optional[Dict[str, Any]]] = None) -> None:
+        """
+        Records that the given variants stem from a dataset, in a single transaction
+
+            Parameters:
+                dataset_id (str): galaxy id of the dataset
+                variants (Iterable): beacon indices or binary document ids of the variants
+                details (Iterable[Dict]): details of each variant, in the same order (optional)
+        """
+        variants = list(variants)
+        details = list(details) if details is not None else [None] * len(variants)
+        with self._lock:
+            number = self._dataset_number(dataset_id)
+            # a variant found twice in a dataset (e.g. by a bulk lookup) keeps one origin
+            self._conn.executemany("INSERT OR IGNORE INTO origins (variant, dataset, details) VALUES (?, ?, ?)",
+                                   ((variant, number, self._encode(detail))
+                                    for variant, detail in zip(variants, details)))
+            self._conn.commit()
+
+    def lookup(self, variants: Iterable[Any]) -> Dict[Any, List[Tuple[str, Optional[Dict[str, Any]]]]]:
+        """
+        Returns the origins of the given variants
+
+            Parameters:
+                variants (Iterable): beacon indices or binary document ids of the variants
+
+            Returns:
+                origins (Dict): maps each variant with origins to a list of (dataset_id, details) tuples
+        """
+        wanted = list(dict.fromkeys(variants))
+        origins: Dict[Any, List[Tuple[str, Optional[Dict[str, Any]]]]] = {}
+        with self._lock:
+            for offset in range(0, len(wanted), LOOKUP_BATCH_SIZE):
+                batch = wanted[offset:offset + LOOKUP_BATCH_SIZE]
+                rows = self._conn.execute(f"""
+                    SELECT origins.variant, datasets.dataset_id, origins.details
+                    FROM origins JOIN datasets ON datasets.id = origins.dataset
+                    WHERE origins.variant IN ({', '.join('?' * len(batch))})
+                """, batch).fetchall()
+                for variant, dataset_id, details in rows:
+                    origins.setdefault(variant, []).append((dataset_id, self._decode(details)))
+        return origins
+
+    def dataset_variants(self, dataset_id: str) -> Iterator[Tuple[Any, Optional[Dict[str, Any]]]]:
+        """
+        Yields (variant, details) of all variants stemming from the given dataset, ordered by variant
+        """
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT origins.variant, origins.details
+                FROM origins JOIN datasets ON datasets.id = origins.dataset
+                WHERE datasets.dataset_id = ?
+                ORDER BY origins.variant
+            """, (dataset_id,)).fetchall()
+        for variant, details in rows:
+            yield variant, self._decode(details)
+
+    def dataset_counts(self) -> Dict[str, int]:
+        """
+        Returns the number of variants recorded for each dataset
+        """
+        with self._lock:
+            rows = self._conn.execute("""
+                SELECT datasets.dataset_id, COUNT(*)
+                FROM origins JOIN datasets ON datasets.id = origins.dataset
+                GROUP BY origins.dataset
+            """).fetchall()
+        return dict(rows)
+
+    def remove_datasets(self, dataset_ids: Iterable[str]) -> None:
+        """
+        Removes the origins of the given datasets
+        """
+        with self._lock:
+            for dataset_id in dataset_ids:
+                number = self._dataset_numbers.pop(dataset_id, None)
+                if number is None:
+                    continue
+                self._conn.execute("DELETE FROM origins WHERE dataset = ?", (number,))
+                self._conn.execute("DELETE FROM datasets WHERE id = ?", (number,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        """
+        Removes all origins
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM origins")
+            self._conn.execute("DELETE FROM datasets")
+            self._conn.commit()
+            self._dataset_numbers.clear()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,162 @@
+import logging
+import os
+import queue
+import threading
+from typing import Any, Callable, Iterable, Optional
+
+# marks the end of a queue
+_DONE = object()
+
+
+def remove_file(item: Any, path: str) -> None:
+    """
+    Default release step of the pipeline, removes a processed file
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def skip_release(item: Any, path: str) -> None:
+    """
+    Release step of the pipeline for items that are read from their source instead of a local file
+    """
+
+
+def _put(target: queue.Queue, value: Any, stop: threading.Event) -> bool:
+    """
+    Puts a value into a bounded queue, giving up once the pipeline is stopped
+
+        Returns:
+            True if the value has been queued
+    """
+    while not stop.is_set():
+        try:
+            target.put(value, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_pipeline(items: Iterable,
+                 download: Callable[[Any], Optional[str]],
+                 process: Callable[[Any, str], bool],
+                 download_workers: int = 1,
+                 import_workers: int = 1,
+                 queue_size: int = 1,
+                 release: Callable[[Any, str], None] = remove_file,
+                 setup: Callable[[], None] = None,
+                 teardown: Callable[[], None] = None) -> bool:
+    """
+    Downloads and imports items with overlapping stages
+
+    download_workers threads download items to local files and hand them to import_workers threads through a queue
+    holding at most queue_size files. Once the queue is full, downloads pause until an import worker picks up the
+    next file, so at most download_workers + queue_size + import_workers files exist at the same time.
+
+        Parameters:
+            items (Iterable): items to download and import, consumed lazily
+            download (Callable): downloads an item, returns the local path or None if the download failed (an
+                exception aborts the pipeline)
+            process (Callable): imports a downloaded item, returns False to abort the pipeline
+            download_workers (int): number of concurrent downloads
+            import_workers (int): number of concurrent imports
+            queue_size (int): number of downloaded files that may wait for an import worker
+            release (Callable): called with each downloaded file once it is no longer needed, removes it by default
+            setup (Callable): called by each import worker before its first import (e.g. to open a db connection)
+            teardown (Callable): called by each import worker after its last import
+
+        Returns:
+            True if all items have been processed, False if the pipeline was aborted
+    """
+    stop = threading.Event()
+    pending: queue.Queue = queue.Queue(maxsize=max(download_workers, 1))
+    downloaded: queue.Queue = queue.Queue(maxsize=max(queue_size, 1))
+
+    # errors are caught as BaseException, threads would silently discard a SystemExit and the pipeline would succeed
+    def feed():
+        try:
+            for item in items:
+                if not _put(pending, item, stop):
+                    return
+        except BaseException:
+            logging.exception("failed to list items for the pipeline")
+            stop.set()
+        finally:
+            for _ in range(download_workers):
+                _put(pending, _DONE, stop)
+
+    def download_worker():
+        while not stop.is_set():
+            try:
+                item = pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            try:
+                path = download(item)
+            except BaseException:
+                # download returns None for failures it has handled, anything else aborts the pipeline
+                logging.exception(f"failed to download {item}")
+                stop.set()
+                return
+            if path is None:
+                continue
+            if not _put(downloaded, (item, path), stop):
+                release(item, path)
+
+    def import_worker():
+        try:
+            if setup is not None:
+                setup()
+        except BaseException:
+            logging.exception("failed to set up import worker")
+            stop.set()
+            return
+
+        try:
+            while not stop.is_set():
+                try:
+                    entry = downloaded.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if entry is _DONE:
+                    return
+                item, path = entry
+                try:
+                    if not process(item, path):
+                        stop.set()
+                except BaseException:
+                    logging.exception(f"failed to import {item}")
+                    stop.set()
+                finally:
+                    release(item, path)
+        finally:
+            if teardown is not None:
+                teardown()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    downloaders = [threading.Thread(target=download_worker, daemon=True) for _ in range(download_workers)]
+    importers = [threading.Thread(target=import_worker, daemon=True) for _ in range(import_workers)]
+
+    for thread in [feeder] + downloaders + importers:
+        thread.start()
+
+    feeder.join()
+    for thread in downloaders:
+        thread.join()
+    for _ in importers:
+        _put(downloaded, _DONE, stop)
+    for thread in importers:
+        thread.join()
+
+    # release files that were downloaded but not imported because the pipeline was aborted
+    while not downloaded.empty():
+        entry = downloaded.get()
+        if entry is not _DONE:
+            release(*entry)
+
+    return not stop.is_set()
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+# collection holding the generation marker, beacon2-import.py replaces the marker whenever the data changes
+GENERATION_COLLECTION = "searchCacheGeneration"
+
+# share of max_disk_size the on-disk tier is trimmed to, so that not every following write has to trim again
+DISK_TRIM_RATIO = 0.9
+
+
+def bump_generation(database) -> str:
+    """
+    Replaces the generation marker of a beacon database, invalidating all cached query results
+
+        Parameters:
+            database (Database): the beacon database
+
+        Returns:
+            the new generation
+    """
+    generation = uuid.uuid4().hex
+    database[GENERATION_COLLECTION].replace_one({"_id": "generation"}, {"_id": "generation", "value": generation},
+                                               upsert=True)
+    return generation
+
+
+def read_generation(database) -> str:
+    """
+    Returns the generation marker of a beacon database (empty if it has never been bumped)
+    """
+    marker = database[GENERATION_COLLECTION].find_one({"_id": "generation"})
+    return marker["value"] if marker else ""
+
+
+class QueryCache:
+    """
+    Cache of query results with an in-memory LRU tier and an optional on-disk tier
+
+    Results are keyed by the normalized query together with database, collection, projection and paging, and the
+    generation marker of the database. Entries expire after ttl seconds, and the oldest entries are evicted once
+    either tier is full. Results with more than max_results documents are not cached.
+
+    The generation marker is read from the database at most every generation_interval seconds, so a rebuild
+    invalidates all entries within that time.
+
+    The size of the on-disk tier is tracked as entries are written. The directory is only scanned (to evict the
+    least recently used entries) once the size exceeds max_disk_size, and to remove expired entries and correct
+    the size (the directory may be shared by several processes) at most every ttl seconds.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 300, directory: str = "", max_disk_size: int = 0,
+                 max_results: int = 10000, generation_interval: float = 5):
+        """
+            Parameters:
+                max_entries (int): number of results kept in memory
+                ttl (float): seconds until a result expires
+                directory (str): directory of the on-disk tier, empty to disable it
+                max_disk_size (int): size in bytes the on-disk tier is trimmed to, 0 for no limit
+                max_results (int): largest number of documents of a cached result
+                generation_interval (float): seconds between two reads of the generation marker
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self.max_results = max_results
+        self.generation_interval = generation_interval
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        # size of the on-disk tier as of the last scan plus the entries written since, None until the first scan
+        self._disk_size: Optional[int] = None
+        self._last_trim = 0.0
+        self.hits = 0
+        self.misses = 0
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def generation(self, name: str, read: Callable[[], str]) -> str:
+        """
+        Returns the generation marker of a database, reading it with read() once it is older than generation_interval
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._generations.get(name)
+            if cached is not None and now - cached[1] < self.generation_interval:
+                return cached[0]
+        value = read()
+        with self._lock:
+            self._generations[name] = (value, now)
+        return value
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        """
+        Builds a cache key from the given parts (query, collection, projection, ...)
+
+        Parts are serialized with sorted keys, so equal queries give equal keys regardless of their key order.
+        """
+        from bson import json_util
+        return hashlib.sha256(json_util.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        """
+        Returns the cached result for a key or None if there is no valid entry
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        entry = self._read_disk(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, entry["expires"], entry["result"])
+        return entry["result"]
+
+    def put(self, key: str, result: List[dict]) -> None:
+        """
+        Caches a result in memory and on disk
+        """
+        if len(result) > self.max_results:
+            return
+        expires = time.time() + self.ttl
+        self._remember(key, expires, result)
+        self._write_disk(key, expires, result)
+
+    def _remember(self, key: str, expires: float, result: List[dict]) -> None:
+        with self._lock:
+            self._entries[key] = (expires, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _read_disk(self, key: str, now: float) -> Optional[dict]:
+        if not self.directory:
+            return None
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            with open(path) as entry_file:
+                from bson import json_util
+                entry = json_util.loads(entry_file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry["expires"] <= now:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        os.utime(path)
+        return entry
+
+    def _write_disk(self, key: str, expires: float, result: List[dict]) -> None:
+        if not self.directory:
+            return
+        from bson import json_util
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        temp_path = f"{path}.tmp-{threading.get_ident()}"
+        with open(temp_path, "w") as entry_file:
+            entry_file.write(json_util.dumps({"expires": expires, "result": result}))
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._disk_size is not None:
+                self._disk_size += size - replaced
+            trim = (self._disk_size is None or time.monotonic() - self._last_trim >= self.ttl
+                    or (self.max_disk_size and self._disk_size > self.max_disk_size))
+        if trim:
+            self._trim_disk()
+
+    def _trim_disk(self) -> None:
+        # Removes expired entries and, beyond max_disk_size, the least recently used ones
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_disk_size * DISK_TRIM_RATIO if total > self.max_disk_size else self.max_disk_size
+        for mtime, size, path in sorted(entries):
+            # entries are written with expires = mtime + ttl and only get younger when read
+            if mtime + self.ttl > now and (not self.max_disk_size or total <= limit):
+                continue
+            logging.debug(f"Evicting {path} from the query cache")
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        with self._lock:
+            self._disk_size = total
+            self._last_trim = time.monotonic()
@@ -0,0 +1,209 @@
+import logging
+import os
+from typing import List
+
+# collections of a shadow rebuild of beacon v2 are named "{prefix}{collection}" next to the live ones
+STAGING_PREFIX = "staging_"
+PREVIOUS_PREFIX = "previous_"
+ROLLBACK_PREFIX = "rollback_"
+SHADOW_PREFIXES = (STAGING_PREFIX, PREVIOUS_PREFIX, ROLLBACK_PREFIX)
+# journal of a running swap, see swap_collections
+SWAP_COLLECTION = "shadowSwap"
+
+
+def live_collections(database, skip: List[str] = ()) -> List[str]:
+    """
+    Returns the names of the live collections of a beacon database (without staging and previous copies)
+
+        Parameters:
+            database (Database): the beacon database
+            skip (List[str]): collections that are never swapped (e.g. the query cache generation)
+    """
+    return sorted(name for name in database.list_collection_names()
+                  if not name.startswith(SHADOW_PREFIXES) and not name.startswith("system.")
+                  and name != SWAP_COLLECTION and name not in skip)
+
+
+def prefixed_collections(database, prefix: str) -> List[str]:
+    """
+    Returns the names (without prefix) of the collections with the given prefix
+    """
+    return sorted(name[len(prefix):] for name in database.list_collection_names() if name.startswith(prefix))
+
+
+def drop_collections(database, prefix: str) -> None:
+    """
+    Drops all collections with the given prefix, e.g. the leftovers of an interrupted shadow rebuild
+    """
+    for name in prefixed_collections(database, prefix):
+        logging.info(f"Dropping {prefix}{name}")
+        database[prefix + name].drop()
+
+
+def copy_indexes(database, source: str, target: str) -> List[str]:
+    """
+    Creates the indexes of a collection on another one
+
+        Parameters:
+            database (Database): the beacon database
+            source (str): collection whose indexes to copy (skipped if it does not exist)
+            target (str): collection to create the indexes on
+
+        Returns:
+            names of the created indexes
+    """
+    # imported here like in indexes.py, so the module can be imported without pymongo
+    from pymongo import IndexModel
+
+    if source not in database.list_collection_names():
+        return []
+    models = []
+    for index in database[source].list_indexes():
+        if index["name"] == "_id_":
+            continue
+        options = {key: value for key, value in index.items() if key not in ("v", "key", "ns")}
+        models.append(IndexModel(list(index["key"].items()), **options))
+    return database[target].create_indexes(models) if models else []
+
+
+def _rename(database, source: str, target: str) -> None:
+    # renameCollection within a database only changes metadata, replacing the target in one atomic step
+    database.client.admin.command("renameCollection", f"{database.name}.{source}", to=f"{database.name}.{target}",
+                                  dropTarget=True)
+
+
+def swap_interrupted(database) -> bool:
+    """
+    Returns True if the last swap_collections stopped before all collections were swapped
+    """
+    return database[SWAP_COLLECTION].find_one({"_id": "swap"}) is not None
+
+
+def swap_collections(database, keep_previous: bool = True, skip: List[str] = ()) -> List[str]:
+    """
+    Replaces the live collections of a beacon database with the staging ones of a shadow rebuild
+
+    Collections are swapped one at a time, each staging collection replaces its live counterpart with
+    renameCollection(dropTarget). The swap is atomic per collection only: a search running meanwhile may see the
+    old data in one collection and the new data in another. Live collections without a staging counterpart are
+    removed, as a rebuild would have cleared them.
+
+    With keep_previous, the live collections are first renamed to previous_{name} (replacing the copy of an
+    earlier rebuild), so rollback_collections can restore them. Between the two renames the collection is missing
+    for the duration of a metadata operation. Without keep_previous, each collection is replaced in a single step
+    and the copy of an earlier rebuild is dropped.
+
+    The collections still to swap are journaled in SWAP_COLLECTION, so rollback_collections can undo a swap that
+    stopped halfway.
+
+        Parameters:
+            database (Database): the beacon database
+            keep_previous (bool): keep the replaced collections for rollback_collections
+            skip (List[str]): collections that are never swapped
+
+        Returns:
+            names of the swapped collections
+    """
+    staged = prefixed_collections(database, STAGING_PREFIX)
+    live = live_collections(database, skip)
+    # the copy of an earlier rebuild is replaced or, without keep_previous, would restore outdated data
+    drop_collections(database, PREVIOUS_PREFIX)
+
+    swapped = sorted(set(staged) | set(live))
+    journal = database[SWAP_COLLECTION]
+    journal.replace_one({"_id": "swap"}, {"_id": "swap", "pending": swapped}, upsert=True)
+    for name in swapped:
+        if name in live and keep_previous:
+            _rename(database, name, PREVIOUS_PREFIX + name)
+        if name in staged:
+            _rename(database, STAGING_PREFIX + name, name)
+        elif name in live and not keep_previous:
+            database[name].drop()
+        journal.update_one({"_id": "swap"}, {"$pull": {"pending": name}})
+        logging.info(f"Swapped collection {name}")
+    journal.drop()
+    return swapped
+
+
+def rollback_collections(database, skip: List[str] = ()) -> List[str]:
+    """
+    Restores the collections replaced by the last swap_collections, the replacing ones become the previous copy
+
+    Like the swap, the rollback replaces one collection at a time. If the swap stopped halfway (see
+    swap_interrupted), only the collections it got to are restored, the others still hold the old data and keep
+    their staging copies.
+
+        Returns:
+            names of the restored collections
+
+        Raises:
+            RuntimeError if there is no previous copy
+    """
+    previous = prefixed_collections(database, PREVIOUS_PREFIX)
+    if not previous:
+        raise RuntimeError(f"no previous collections to roll back to in {database.name}")
+    live = live_collections(database, skip)
+    journal = database[SWAP_COLLECTION].find_one({"_id": "swap"})
+    pending = set(journal["pending"]) if journal else set()
+
+    drop_collections(database, ROLLBACK_PREFIX)
+    restored = []
+    for name in sorted(set(previous) | set(live)):
+        if name in pending:
+            # the swap stopped after renaming the live collection, before its staging copy took its place
+            if name in previous and name not in live:
+                _rename(database, PREVIOUS_PREFIX + name, name)
+                restored.append(name)
+                logging.info(f"Restored collection {name}")
+            continue
+        if name in live:
+            _rename(database, name, ROLLBACK_PREFIX + name)
+        if name in previous:
+            _rename(database, PREVIOUS_PREFIX + name, name)
+        if name in live:
+            _rename(database, ROLLBACK_PREFIX + name, PREVIOUS_PREFIX + name)
+        restored.append(name)
+        logging.info(f"Restored collection {name}")
+    database[SWAP_COLLECTION].drop()
+    return restored
+
+
+def staging_path(path: str) -> str:
+    """
+    Returns where a shadow rebuild writes a local file (e.g. the variant origins) until it is published
+    """
+    return f"{path}.staging"
+
+
+def previous_path(path: str) -> str:
+    """
+    Returns where a published file keeps the copy it replaced
+    """
+    return f"{path}.previous"
+
+
+def publish_file(path: str, keep_previous: bool = True) -> None:
+    """
+    Replaces a file with its staging copy, keeping the replaced file as previous copy
+    """
+    if not keep_previous and os.path.exists(previous_path(path)):
+        os.remove(previous_path(path))
+    if not os.path.exists(staging_path(path)):
+        return
+    if keep_previous and os.path.exists(path):
+        os.replace(path, previous_path(path))
+    os.replace(staging_path(path), path)
+
+
+def rollback_file(path: str) -> None:
+    """
+    Swaps a file with its previous copy (if there is one)
+    """
+    if not os.path.exists(previous_path(path)):
+        return
+    if os.path.exists(path):
+        os.replace(path, staging_path(path))
+        os.replace(previous_path(path), path)
+        os.replace(staging_path(path), previous_path(path))
+    else:
+        os.replace(previous_path(path), path)
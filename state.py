@@ -0,0 +1,280 @@
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils import GalaxyDataset
+
+# stages of a dataset recorded in the manifest, in the order an import passes them
+STAGE_DISCOVERED = "discovered"
+STAGE_DOWNLOADED = "downloaded"
+STAGE_IMPORTING = "importing"
+STAGE_IMPORTED = "imported"
+STAGE_COMPLETE = "complete"
+# the download failed, the dataset is retried by the next sync or resumed rebuild
+STAGE_FAILED = "failed"
+
+
+class SyncState:
+    """
+    Local manifest of the galaxy datasets that are currently imported to beacon
+
+    For each galaxy dataset the manifest keeps uuid, update_time and size (used to detect changes) and the
+    database rows (beacon indices or document ids) that were created from it.
+
+    The manifest doubles as checkpoint journal of rebuilds: the stage of each dataset (discovered, downloaded,
+    importing, imported, complete once its origins are written) is recorded as the import proceeds, so an interrupted
+    rebuild can be resumed. Only complete datasets are kept by diff_datasets, everything else is cleaned up and
+    imported again.
+
+    Note:
+        Rows are tagged with their source dataset in this local file and not in the beacon database, so nothing in
+        beacon can be used to link variants back to an actual file uploaded to galaxy.
+    """
+
+    def __init__(self, path: str):
+        """
+        Opens (or creates) the manifest at the given path
+
+            Parameters:
+                path (str): full file path of the sqlite database holding the manifest
+        """
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS datasets (
+                id TEXT PRIMARY KEY,
+                uuid TEXT,
+                update_time TEXT,
+                size INTEGER,
+                collection TEXT,
+                complete INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS dataset_rows (
+                dataset_id TEXT,
+                row TEXT
+            );
+            CREATE INDEX IF NOT EXISTS dataset_rows_dataset ON dataset_rows (dataset_id);
+            CREATE INDEX IF NOT EXISTS dataset_rows_row ON dataset_rows (row);
+        """)
+
+        # manifests written before the checkpoint journal lack the stage columns
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(datasets)")}
+        if "stage" not in columns:
+            self._conn.execute(f"ALTER TABLE datasets ADD COLUMN stage TEXT DEFAULT '{STAGE_DISCOVERED}'")
+            self._conn.execute("UPDATE datasets SET stage = CASE WHEN complete THEN ? ELSE ? END",
+                               (STAGE_COMPLETE, STAGE_IMPORTING))
+        if "watermark" not in columns:
+            self._conn.execute("ALTER TABLE datasets ADD COLUMN watermark INTEGER")
+        self._conn.commit()
+
+    def datasets(self) -> Dict[str, Tuple[str, str, int, bool]]:
+        """
+        Returns all known datasets
+
+            Returns:
+                datasets (Dict): maps dataset id to a tuple of (uuid, update_time, size, complete)
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id, uuid, update_time, size, complete FROM datasets").fetchall()
+        return {row[0]: (row[1], row[2], row[3], bool(row[4])) for row in rows}
+
+    def collection(self, dataset_id: str) -> str:
+        """
+        Returns the collection a dataset has been imported to (empty for beacon v1)
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT collection FROM datasets WHERE id = ?", (dataset_id,)).fetchone()
+        return row[0] if row else ""
+
+    def is_empty(self) -> bool:
+        """
+        Returns True if no dataset has been recorded so far
+        """
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM datasets").fetchone()[0] == 0
+
+    def stages(self) -> Dict[str, int]:
+        """
+        Returns the number of datasets in each stage
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT stage, COUNT(*) FROM datasets GROUP BY stage").fetchall()
+        return dict(rows)
+
+    def failed_datasets(self) -> List[str]:
+        """
+        Returns the IDs of the datasets whose download failed
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM datasets WHERE stage = ?", (STAGE_FAILED,)).fetchall()
+        return [row[0] for row in rows]
+
+    def discover_dataset(self, dataset: GalaxyDataset, collection: str = "") -> None:
+        """
+        Records a dataset found in galaxy, unless it is already known
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO datasets (id, uuid, update_time, size, collection, complete, stage) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (dataset.id, dataset.uuid, dataset.update_time, dataset.size, collection, STAGE_DISCOVERED))
+            self._conn.commit()
+
+    def set_stage(self, dataset_id: str, stage: str) -> None:
+        """
+        Records the stage a known dataset has reached
+        """
+        with self._lock:
+            self._conn.execute("UPDATE datasets SET stage = ? WHERE id = ?", (stage, dataset_id))
+            self._conn.commit()
+
+    def fail_dataset(self, dataset: GalaxyDataset, collection: str = "") -> None:
+        """
+        Records that a dataset could not be downloaded
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO datasets (id, uuid, update_time, size, collection, complete, stage) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (dataset.id, dataset.uuid, dataset.update_time, dataset.size, collection, STAGE_FAILED))
+            self._conn.commit()
+
+    def start_dataset(self, dataset: GalaxyDataset, collection: str = "", watermark: Optional[int] = None) -> None:
+        """
+        Records a dataset before its import starts
+
+        The dataset stays incomplete until finish_dataset is called, so an interrupted import will be cleaned up and
+        repeated by the next sync.
+
+            Parameters:
+                dataset (GalaxyDataset): the dataset about to be imported
+                collection (str): collection the dataset is imported to (empty for beacon v1)
+                watermark (int): highest beacon index before the import (beacon v1), see incomplete_watermark
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO datasets (id, uuid, update_time, size, collection, complete, stage, watermark) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+                (dataset.id, dataset.uuid, dataset.update_time, dataset.size, collection, STAGE_IMPORTING, watermark))
+            self._conn.commit()
+
+    def finish_dataset(self, dataset_id: str) -> None:
+        """
+        Marks a dataset as completely imported
+        """
+        with self._lock:
+            self._conn.execute("UPDATE datasets SET complete = 1, stage = ? WHERE id = ?", (STAGE_COMPLETE, dataset_id))
+            self._conn.commit()
+
+    def incomplete_watermark(self) -> Optional[int]:
+        """
+        Returns the lowest watermark of the datasets whose import started but did not complete (beacon v1)
+
+        Rows above it that are not tagged with a complete dataset have been left behind by interrupted imports,
+        see complete_rows_above.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(watermark) FROM datasets WHERE complete = 0").fetchone()
+        return row[0]
+
+    def complete_rows_above(self, watermark: int) -> List[int]:
+        """
+        Returns the beacon indices above the watermark that are tagged with a complete dataset (beacon v1)
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT CAST(r.row AS INTEGER) AS row FROM dataset_rows r "
+                "JOIN datasets d ON d.id = r.dataset_id WHERE d.complete = 1 AND CAST(r.row AS INTEGER) > ?",
+                (watermark,)).fetchall()
+        return [row[0] for row in rows]
+
+    def add_rows(self, dataset_id: str, rows: Iterable) -> None:
+        """
+        Tags database rows (beacon indices or document ids) with the dataset they were imported from
+        """
+        with self._lock:
+            self._conn.executemany("INSERT INTO dataset_rows (dataset_id, row) VALUES (?, ?)",
+                                   ((dataset_id, str(row)) for row in rows))
+            self._conn.commit()
+
+    def orphaned_rows(self, dataset_id: str, batch_size: int = 10000) -> Iterator[List[str]]:
+        """
+        Yields batches of rows that stem from the given dataset and from no other dataset
+
+        Beacon v1 imports every variant only once per beacon dataset, so a row may be shared by several galaxy
+        datasets. Those rows have to stay in the database as long as any of its datasets is still imported.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT r.row FROM dataset_rows r WHERE r.dataset_id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM dataset_rows o WHERE o.row = r.row AND o.dataset_id != r.dataset_id)",
+                (dataset_id,)).fetchall()
+
+        for i in range(0, len(rows), batch_size):
+            yield [row[0] for row in rows[i:i + batch_size]]
+
+    def row_datasets(self, rows: Iterable) -> List[Tuple[str, str]]:
+        """
+        Returns (row, dataset id) for every dataset the given rows stem from
+        """
+        rows = [str(row) for row in rows]
+        result: List[Tuple[str, str]] = []
+        with self._lock:
+            # stay below sqlite's limit of host parameters per statement
+            for i in range(0, len(rows), 500):
+                batch = rows[i:i + 500]
+                result += self._conn.execute(
+                    f"SELECT row, dataset_id FROM dataset_rows WHERE row IN ({','.join('?' * len(batch))})",
+                    batch).fetchall()
+        return result
+
+    def forget_dataset(self, dataset_id: str) -> None:
+        """
+        Removes a dataset and all of its rows from the manifest
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM dataset_rows WHERE dataset_id = ?", (dataset_id,))
+            self._conn.execute("DELETE FROM datasets WHERE id = ?", (dataset_id,))
+            self._conn.commit()
+
+    def clear(self) -> None:
+        """
+        Removes all datasets and rows from the manifest
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM dataset_rows")
+            self._conn.execute("DELETE FROM datasets")
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def diff_datasets(current: Dict[str, GalaxyDataset],
+                  known: Dict[str, Tuple[str, str, int, bool]]) -> Tuple[List[GalaxyDataset], List[str]]:
+    """
+    Compares the datasets currently shared in galaxy with the ones recorded in a SyncState
+
+        Parameters:
+            current (Dict[str, GalaxyDataset]): datasets found in galaxy by their id
+            known (Dict): datasets as returned by SyncState.datasets
+
+        Returns:
+            to_import (List[GalaxyDataset]): new, changed or incompletely imported datasets
+            to_remove (List[str]): IDs of datasets whose rows have to be removed from beacon
+                (deleted, unshared, changed or incompletely imported datasets)
+    """
+    to_import: List[GalaxyDataset] = []
+    to_remove: List[str] = []
+
+    for dataset_id, (uuid, update_time, size, complete) in known.items():
+        dataset = current.get(dataset_id)
+        if dataset is None or not complete or (dataset.uuid, dataset.update_time, dataset.size) != (uuid, update_time, size):
+            to_remove.append(dataset_id)
+
+    removed = set(to_remove)
+    for dataset_id, dataset in current.items():
+        if dataset_id not in known or dataset_id in removed:
+            to_import.append(dataset)
+
+    return to_import, to_remove
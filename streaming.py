@@ -0,0 +1,130 @@
+import gzip
+import io
+import os
+import threading
+from typing import BinaryIO, Callable, Optional
+
+# first bytes of gzip (and bgzip) compressed data
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class MeteredReader(io.RawIOBase):
+    """
+    Reads from a file-like object, reporting the number of bytes read
+    """
+
+    def __init__(self, raw, on_bytes: Optional[Callable[[int], None]] = None):
+        """
+            Parameters:
+                raw: object with a read(size) method, e.g. the raw body of an HTTP response
+                on_bytes (Callable): called with the size of every chunk read (optional)
+        """
+        self._raw = raw
+        self._on_bytes = on_bytes
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._raw.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        if size and self._on_bytes is not None:
+            self._on_bytes(size)
+        return size
+
+
+def open_stream(response, on_bytes: Optional[Callable[[int], None]] = None,
+                buffer_size: int = 1 << 20) -> BinaryIO:
+    """
+    Returns the body of a streamed HTTP response (requests.get(..., stream=True)) as binary file
+
+    Bodies compressed with gzip or bgzip (a series of gzip members) are decompressed while they are read, like
+    any content encoding applied by the server.
+
+        Parameters:
+            response (Response): the response, its body not consumed yet
+            on_bytes (Callable): called with the number of bytes received, before decompression (optional)
+            buffer_size (int): bytes read from the connection at once
+
+        Returns:
+            file object reading the decompressed body
+    """
+    response.raw.decode_content = True
+    stream = io.BufferedReader(MeteredReader(response.raw, on_bytes), buffer_size=buffer_size)
+    if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+class PipeStream:
+    """
+    Feeds the body of a streamed HTTP response into a pipe, for parsers that only read from paths
+
+    A background thread copies the body into the pipe while the parser reads it through /dev/fd, so a download is
+    parsed while it is received and never written to disk. Compressed bodies are passed on as they are (htslib
+    detects and decompresses bgzip and gzip itself).
+
+        Usage:
+            with PipeStream(response) as path:
+                for variant in VCF(path):
+                    ...
+
+    Note:
+        If the download fails, the parser sees the end of the file early. The error is raised when the block is
+        left, so whatever was parsed from the incomplete body has to be treated as failed import.
+    """
+
+    def __init__(self, response, on_bytes: Optional[Callable[[int], None]] = None, chunk_size: int = 1 << 20):
+        """
+            Parameters:
+                response (Response): the response, its body not consumed yet
+                on_bytes (Callable): called with the number of bytes received (optional)
+                chunk_size (int): bytes copied into the pipe at once
+        """
+        self._response = response
+        self._on_bytes = on_bytes
+        self._chunk_size = chunk_size
+        self._stop = threading.Event()
+        self._read_fd = -1
+        self._write_fd = -1
+        self._thread: Optional[threading.Thread] = None
+        self.error: Optional[Exception] = None
+
+    def _copy(self) -> None:
+        try:
+            with os.fdopen(self._write_fd, "wb") as pipe:
+                for chunk in self._response.iter_content(self._chunk_size):
+                    if self._stop.is_set():
+                        return
+                    pipe.write(chunk)
+                    if self._on_bytes is not None:
+                        self._on_bytes(len(chunk))
+        except BrokenPipeError:
+            # the parser stopped reading
+            pass
+        except Exception as e:
+            if not self._stop.is_set():
+                self.error = e
+
+    def __enter__(self) -> str:
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._copy, daemon=True)
+        self._thread.start()
+        return f"/dev/fd/{self._read_fd}"
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self._stop.set()
+        self._response.close()
+
+        # a parser that stopped early leaves the copying thread blocked on a full pipe, drain it so the thread ends
+        os.set_blocking(self._read_fd, False)
+        while self._thread.is_alive():
+            try:
+                os.read(self._read_fd, 1 << 16)
+            except BlockingIOError:
+                self._thread.join(0.05)
+        os.close(self._read_fd)
+
+        if self.error is not None and exc_type is None:
+            raise IOError(f"download failed - {self.error}") from self.error
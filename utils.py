@@ -1,9 +1,12 @@
 from bioblend.galaxy import GalaxyInstance
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List
 from requests import Response
+from galaxy_client import GalaxyClient
 import logging
 import json
+import threading
 
 
 
@@ -15,6 +18,13 @@ class MissingFieldException(Exception):
     pass
 
 
+class GalaxyRequestException(Exception):
+    """
+    Exception for a request to the galaxy api that did not succeed
+    """
+    pass
+
+
 #This is shared 
 @dataclass
 class GalaxyDataset:
@@ -29,6 +39,8 @@ class GalaxyDataset:
     uuid: str
     extension: str
     reference_name: str
+    update_time: str
+    size: int
 
     def __init__(self, info: Dict):
         """
@@ -47,9 +59,14 @@ class GalaxyDataset:
         self.extension = info["extension"]
         self.reference_name = info["metadata_dbkey"]
 
+        # optional attributes, only used to detect changed datasets
+        self.update_time = info.get("update_time", "")
+        self.size = info.get("file_size") or 0
+
 
 ## This is Shared
-def set_up_galaxy_instance(galaxy_url: str, galaxy_key: str) -> GalaxyInstance:
+def set_up_galaxy_instance(galaxy_url: str, galaxy_key: str, pool_size: int = 16, timeout: float = 60.0,
+                           retries: int = 5, rate: float = 0.0) -> GalaxyInstance:
     """
     Returns a galaxy instance with the given URL and api key.
     Exits immediately if either connection or authentication to galaxy fails.
@@ -57,16 +74,21 @@ def set_up_galaxy_instance(galaxy_url: str, galaxy_key: str) -> GalaxyInstance:
         Parameters:
             galaxy_url (str): Base URL of a galaxy instance
             galaxy_key (str): API key with admin privileges
+            pool_size (int): number of connections to galaxy shared by all threads
+            timeout (float): seconds to wait for galaxy to answer a request
+            retries (int): how often requests failing with connection errors or 5xx statuses are repeated
+            rate (float): maximum number of requests per second, 0 for no limit
 
         Returns:
-            gi (GalaxyInstance): Galaxy instance with confirmed admin access to the given galaxy instance
+            gi (GalaxyInstance): Galaxy instance with confirmed admin access to the given galaxy instance,
+                see GalaxyClient for how it sends requests
     """
 
     logging.info(f"trying to connect to galaxy at {galaxy_url}")
 
     # configure a galaxy instance with galaxy_url and api_key
     try:
-        gi = GalaxyInstance(galaxy_url, key=galaxy_key)
+        gi = GalaxyClient(galaxy_url, galaxy_key, pool_size=pool_size, timeout=timeout, retries=retries, rate=rate)
     except Exception as e:
         # if galaxy_url does not follow the scheme <protocol>://<host>:<port>, GalaxyInstance attempts guessing the URL
         # this exception is thrown when neither "http://<galaxy_url>:80" nor "https://<galaxy_url>:443" are accessible
@@ -98,6 +120,77 @@ def set_up_galaxy_instance(galaxy_url: str, galaxy_key: str) -> GalaxyInstance:
     # resp = gi.make_get_request(galaxy_url + "/api/configuration?keys=allow_user_deletion").content
     return gi
 
+#This is Shared
+def iter_json_documents(f, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """
+    Incrementally parses JSON documents from a text file
+
+    Accepts a top level JSON array as well as JSON Lines (or any other sequence of concatenated JSON documents).
+    Only a few chunks of the file are held in memory at a time instead of the whole file.
+
+        Parameters:
+            f (TextIO): file opened in text mode
+            chunk_size (int): number of characters to read at once
+
+        Returns:
+            Iterator over the parsed documents
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+    array = None
+
+    def refill():
+        # keep the unparsed rest of the buffer and append the next chunk
+        nonlocal buffer, position, eof
+        chunk = f.read(max(chunk_size, len(buffer) - position))
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    while True:
+        if not eof and len(buffer) - position < chunk_size:
+            refill()
+
+        # skip whitespace and, inside an array, the separating commas
+        while position < len(buffer) and (buffer[position].isspace() or (array and buffer[position] == ",")):
+            position += 1
+
+        if position == len(buffer):
+            if eof:
+                return
+            refill()
+            continue
+
+        # the first character tells whether the file holds an array or a sequence of documents
+        if array is None:
+            array = buffer[position] == "["
+            if array:
+                position += 1
+            continue
+
+        if array and buffer[position] == "]":
+            return
+
+        try:
+            document, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # the document continues in the next chunk
+            refill()
+            continue
+
+        # numbers and literals may continue in the next chunk as well
+        if end == len(buffer) and not eof:
+            refill()
+            continue
+
+        position = end
+        yield document
+
+
 #This is Shared
 def string_as_bool(string: Any) -> bool:
     """
@@ -110,6 +203,91 @@ def string_as_bool(string: Any) -> bool:
     else:
         return False
 
+def iter_history_datasets(gi: GalaxyInstance, history_id: str, extensions: List[str], limit: int = 500,
+                          workers: int = 4) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the datasets of a history with all fields needed for GalaxyDataset
+
+    The history contents api returns the requested keys of each dataset, so no request per dataset is needed.
+    After the first page, further pages are fetched concurrently in rounds of *workers* pages. Paging stops at the
+    first page that is not full.
+
+        Parameters:
+            gi (GalaxyInstance): galaxy instance to be used for the requests
+            history_id (str): (encoded) ID of the galaxy history
+            extensions (List[str]): datatypes of the datasets to fetch
+            limit (int): number of datasets per page
+            workers (int): maximum number of concurrent page requests
+
+        Returns:
+            Iterator over dataset dictionaries as returned by the galaxy api
+
+        Raises:
+            GalaxyRequestException if a page can not be fetched
+    """
+    keys = "id,name,uuid,extension,metadata_dbkey,update_time,file_size"
+    url = (f"{gi.base_url}/api/histories/{history_id}/contents?v=dev&keys={keys}"
+           f"&q=history_content_type&qv=dataset&q=deleted&qv=false&q=purged&qv=false"
+           f"&q=extension-in&qv={','.join(extensions)}")
+
+    def get_page(offset: int) -> List[Dict[str, Any]]:
+        response: Response = gi.make_get_request(f"{url}&limit={limit}&offset={offset}")
+        if response.status_code != 200:
+            # iterators run in import pipelines, where exiting would go unnoticed
+            raise GalaxyRequestException(f"failed to get datasets of history {history_id} from galaxy - got status "
+                                         f"{response.status_code} with content {response.content}")
+        return json.loads(response.content)
+
+    # most histories fit into a single page
+    page = get_page(0)
+    yield from page
+    if len(page) < limit:
+        return
+
+    offset = limit
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            pages = [executor.submit(get_page, offset + i * limit) for i in range(workers)]
+            offset += workers * limit
+            for page in pages:
+                entries = page.result()
+                yield from entries
+                if len(entries) < limit:
+                    return
+
+
+class UserCache:
+    """
+    Per-run cache of galaxy user details
+
+    Each user is fetched only once, concurrent lookups of the same user wait for the first one.
+    """
+
+    def __init__(self, gi: GalaxyInstance):
+        self._gi = gi
+        self._lock = threading.Lock()
+        self._users: Dict[str, Future] = {}
+
+    def get(self, user_id: str) -> Dict[str, Any]:
+        """
+        Returns the details of a galaxy user as returned by the galaxy api
+        """
+        with self._lock:
+            future = self._users.get(user_id)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._users[user_id] = future
+
+        if owner:
+            try:
+                future.set_result(self._gi.users.show_user(user_id))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
 def get_beacon_histories(gi: GalaxyInstance) -> List[str]:
     """
     Fetches beacon history IDs from galaxy
@@ -120,32 +298,56 @@ def get_beacon_histories(gi: GalaxyInstance) -> List[str]:
         Returns:
             beacon_histories (List[str]): IDs of all histories that should be imported to beacon
     """
-    # history ids will be collected in this lsit
-    history_ids: List[str] = []
+    return list(iter_beacon_histories(gi))
+
+
+def iter_beacon_histories(gi: GalaxyInstance, workers: int = 8, users: UserCache = None) -> Iterator[str]:
+    """
+    Yields beacon history IDs from galaxy as soon as they are confirmed
+
+    History and user details are fetched concurrently, user details only once per user.
+
+        Parameters:
+            gi (GalaxyInstance): galaxy instance from which to fetch history IDs
+            workers (int): maximum number of concurrent requests to galaxy
+            users (UserCache): cache of user details, a new one is used for each call by default
+
+        Returns:
+            Iterator over IDs of all histories that should be imported to beacon (in no particular order)
+
+        Raises:
+            GalaxyRequestException if the histories can not be fetched
+    """
+    if users is None:
+        users = UserCache(gi)
 
     # get histories from galaxy api
     # URL is used because the name filter is not supported by bioblend as of now
-    response: Response = gi.make_get_request(f"{gi.base_url}/api/histories?q=name&qv=Beacon%20Export%20%F0%9F%93%A1&all=true&deleted=false")
+    # the owner is requested along with the id, which saves fetching the history details
+    response: Response = gi.make_get_request(f"{gi.base_url}/api/histories?q=name&qv=Beacon%20Export%20%F0%9F%93%A1&all=true&deleted=false&keys=id,user_id")
 
     # check if the reuest was successful
     if response.status_code != 200:
-        logging.critical("failed to get histories from galaxy")
-        logging.critical(f"got status {response.status_code} with content {response.content}")
-        exit(2)
+        raise GalaxyRequestException(f"failed to get histories from galaxy - got status {response.status_code} "
+                                     f"with content {response.content}")
 
     # retrieve histories from response body
     histories: List[Dict] = json.loads(response.content)
 
-    # for each history double check if the user has beacon sharing enabled
-    for history in histories:
-        history_details: Dict[str, Any] = gi.histories.show_history(history["id"])
-        user_details: Dict[str, Any] = gi.users.show_user(history_details["user_id"])
+    def is_beacon_enabled(history: Dict[str, Any]) -> bool:
+        # galaxy versions without support for "keys" only return the default fields
+        user_id = history.get("user_id")
+        if user_id is None:
+            user_id = gi.histories.show_history(history["id"])["user_id"]
+        user_details: Dict[str, Any] = users.get(user_id)
 
         # skip adding the history if beacon_enabled is not set for the owner account
         history_user_preferences: Dict[str, str] = user_details["preferences"]
-        if "beacon_enabled" not in history_user_preferences or not string_as_bool(history_user_preferences["beacon_enabled"]):
-            continue
-
-        history_ids.append(history["id"])
+        return "beacon_enabled" in history_user_preferences and string_as_bool(history_user_preferences["beacon_enabled"])
 
-    return history_ids
\ No newline at end of file
+    # for each history double check if the user has beacon sharing enabled
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(is_beacon_enabled, history): history["id"] for history in histories}
+        for future in as_completed(futures):
+            if future.result():
+                yield futures[future]
\ No newline at end of file